@@ -1,12 +1,33 @@
+import asyncio
 import asyncpg
+import orjson
 import os
 import logging
 
 logger = logging.getLogger("db_init")
 
+LISTEN_RECONNECT_SECONDS = 5
+
+
+def _json_dumps(value):
+    # asyncpg's text codec wants str; default=str covers Decimal / datetime inside payloads
+    return orjson.dumps(value, default=str).decode()
+
+
+async def _init_connection(conn):
+    """
+    Runs once per pooled connection: json / jsonb columns come back as Python objects
+    (and parameters go in as Python objects). No json.loads at the call sites.
+    """
+    for typename in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typename, schema="pg_catalog", encoder=_json_dumps, decoder=orjson.loads, format="text"
+        )
+
 class Database:
     def __init__(self):
         self.pool = None
+        self._listeners = {}  # channel -> [callback(payload)]
 
     async def connect(self):
         db_url = os.getenv("DATABASE_URL")
@@ -31,7 +52,8 @@ class Database:
                 timeout=60.0,            
                 command_timeout=30.0,
                 ssl='require',           # 🚨 THE MAGIC STRING
-                server_settings={'tcp_keepalives_idle': '60'} # Keep AWS Load Balancer awake
+                server_settings={'tcp_keepalives_idle': '60'}, # Keep AWS Load Balancer awake
+                init=_init_connection    # JSON / JSONB codecs
             )
             logger.info("✅ DB Pool Established. Ready for traffic.")
             
@@ -44,4 +66,54 @@ class Database:
             logger.info("🛑 Closing Database Pool...")
             await self.pool.close()
 
-db = Database()
\ No newline at end of file
+    # ==========================================================================
+    # LISTEN / NOTIFY
+    # ==========================================================================
+    def add_listener(self, channel, callback):
+        """
+        Registers callback(payload) for a NOTIFY channel. Must be called before listen_loop() starts.
+        On every (re)connect the callback also gets payload=None: events may have been missed,
+        so caches should drop everything.
+        """
+        self._listeners.setdefault(channel, []).append(callback)
+
+    def _dispatch(self, channel, payload):
+        for callback in self._listeners.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"🔥 Listener for '{channel}' failed: {e}")
+
+    async def listen_loop(self):
+        """
+        Keeps ONE dedicated connection subscribed to every registered channel.
+        LISTEN needs a session, which PgBouncer in transaction mode can't give us, so this
+        uses DATABASE_DIRECT_URL (Supabase direct / session-mode port) when it is set.
+        """
+        dsn = os.getenv("DATABASE_DIRECT_URL") or os.getenv("DATABASE_URL")
+        dsn = dsn.replace("?sslmode=require", "").replace("&sslmode=require", "")
+
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn=dsn, ssl='require', statement_cache_size=0, timeout=60.0)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _conn: lost.set())
+
+                for channel in self._listeners:
+                    await conn.add_listener(channel, lambda _c, _pid, ch, payload: self._dispatch(ch, payload))
+                    self._dispatch(channel, None)
+                logger.info(f"👂 Listening on {', '.join(self._listeners) or 'nothing'}")
+
+                await lost.wait()
+                logger.warning("⚠️ LISTEN connection lost. Reconnecting...")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"🔥 LISTEN connection failed: {type(e).__name__} - {e}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(LISTEN_RECONNECT_SECONDS)
+
+db = Database()
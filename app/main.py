@@ -5,11 +5,25 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 from app.core.database import db
 from app.services.recovery_service import cart_recovery_loop
 from app.services.delivery_service import delivery_watchdog_loop
+from app.services.tracking_service import tracking_flush_loop
+from app.services.reconciliation_service import payment_reconciliation_loop
+from app.services.related_service import related_items_loop
+from app.services.reservation_service import reservation_sweeper_loop
+from app.services.flash_drop_service import flash_drops, flash_drop_loop, FLASH_DROPS_CHANGED_CHANNEL
+from app.services.storefront_cache import storefront_cache, STOREFRONT_INVALIDATE_CHANNEL
+from app.services.search_service import prefix_indexes, ITEMS_CHANGED_CHANNEL
+from app.services.catalog_cache import item_catalog
+from app.services.shop_resolver import shop_resolver, SHOP_SLUGS_CHANGED_CHANNEL
+from app.services.address_service import address_cache, ADDRESS_CHANGED_CHANNEL
+from app.services.razorpay_service import on_razorpay_keys_changed, RAZORPAY_KEYS_CHANGED_CHANNEL
+from app.utils.checkout_token import checkout_tokens, CHECKOUT_TOKEN_REVOKED_CHANNEL
+from app.utils.metrics import render_metrics
+from app.utils.razorpay_gateway import close_gateway
 from app.routers import checkout, webhook, admin, payment, storefront, dashboard
 
 logging.basicConfig(level=logging.INFO)
@@ -26,6 +40,22 @@ async def background_startup_sequence():
         logger.info("⏳ [BACKGROUND STAGE 2] Starting Background Engines...")
         background_tasks.append(asyncio.create_task(cart_recovery_loop()))
         background_tasks.append(asyncio.create_task(delivery_watchdog_loop()))
+        background_tasks.append(asyncio.create_task(tracking_flush_loop()))
+        background_tasks.append(asyncio.create_task(payment_reconciliation_loop()))
+        background_tasks.append(asyncio.create_task(related_items_loop()))
+        background_tasks.append(asyncio.create_task(reservation_sweeper_loop()))
+        background_tasks.append(asyncio.create_task(flash_drop_loop()))
+
+        # Cross-worker cache invalidation (DB triggers -> NOTIFY -> every worker)
+        db.add_listener(STOREFRONT_INVALIDATE_CHANNEL, storefront_cache.on_notify)
+        db.add_listener(ITEMS_CHANGED_CHANNEL, prefix_indexes.on_notify)
+        db.add_listener(ITEMS_CHANGED_CHANNEL, item_catalog.on_notify)
+        db.add_listener(SHOP_SLUGS_CHANGED_CHANNEL, shop_resolver.on_notify)
+        db.add_listener(CHECKOUT_TOKEN_REVOKED_CHANNEL, checkout_tokens.on_notify)
+        db.add_listener(ADDRESS_CHANGED_CHANNEL, address_cache.on_notify)
+        db.add_listener(FLASH_DROPS_CHANGED_CHANNEL, flash_drops.on_notify)
+        db.add_listener(RAZORPAY_KEYS_CHANGED_CHANNEL, on_razorpay_keys_changed)
+        background_tasks.append(asyncio.create_task(db.listen_loop()))
         logger.info("✅ [BACKGROUND STAGE 2 COMPLETE] Background Engines Running.")
     except Exception as e:
         logger.critical(f"🔥 Background Startup Failed: {e}")
@@ -44,6 +74,9 @@ async def lifespan(app: FastAPI):
     master_startup_task.cancel()
     for task in background_tasks:
         task.cancel()
+    # Let the loops finish their cleanup (e.g. the tracking flusher's final flush) while the pool is still open
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_gateway()
     await db.disconnect()
     logger.info("🛑 Database Disconnected. Server Offline.")
 
@@ -82,4 +115,10 @@ async def root_health_check():
             "database": "connected" if db.pool else "disconnected"
         },
         status_code=200
-    )
\ No newline at end of file
+    )
+
+
+@app.get("/metrics", tags=["System"])
+async def metrics():
+    """Prometheus scrape endpoint (per-worker in-process metrics)."""
+    return PlainTextResponse(render_metrics())
@@ -2,12 +2,15 @@ from fastapi import APIRouter, Request, HTTPException, BackgroundTasks, Body
 from app.core.database import db
 from app.schemas import BroadcastRequest, StatusUpdate
 from app.utils.whatsapp import send_whatsapp_message
+from app.utils.crypto import decrypt_data
 from app.utils.shiprocket import get_shiprocket_token, create_shiprocket_order, generate_shipping_label
-import json
 from fastapi import UploadFile, File
 import pandas as pd
 import io
 from app.services.order_service import schedule_image_deletion
+from app.services.reservation_service import commit_order_stock, release_order_stock
+from app.services.shipping_service import ORDER_LINES_JSON, build_ship_data
+from app.services.storefront_cache import storefront_cache
 
 router = APIRouter()
 COST_PER_MSG = 1.20
@@ -42,11 +45,14 @@ async def get_analytics(shop_id: int):
         """, shop_id)
         
         # 3. Top 3 Selling Items
+        # Units per item from the order lines (not per free-text order name)
         top_items = await conn.fetch("""
-            SELECT item_name, COUNT(*) as qty_sold 
-            FROM orders 
-            WHERE shop_id = $1 
-            GROUP BY item_name 
+            SELECT COALESCE(MAX(i.name), MAX(oi.name)) as item_name, SUM(oi.qty)::int as qty_sold 
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            LEFT JOIN items i ON i.id = oi.item_id
+            WHERE o.shop_id = $1 
+            GROUP BY COALESCE(oi.item_id::text, oi.name)
             ORDER BY qty_sold DESC 
             LIMIT 3
         """, shop_id)
@@ -121,7 +127,7 @@ async def send_broadcast(payload: BroadcastRequest):
 async def notify_order_update(update: StatusUpdate, background_tasks: BackgroundTasks):
     async with db.pool.acquire() as conn:
         order = await conn.fetchrow("""
-            SELECT customer_phone, item_name, quantity, total_amount, shop_id 
+            SELECT customer_phone, shop_id 
             FROM orders WHERE id = $1
         """, update.order_id)
         
@@ -130,13 +136,15 @@ async def notify_order_update(update: StatusUpdate, background_tasks: Background
     # STOCK DECREMENT (Only on PAID)
     if update.new_status == "paid":
         async with db.pool.acquire() as conn:
-            # Simple stock decrement (Enhancement: In future, decrement specific variant stock)
-            await conn.execute("""
-                UPDATE items SET stock_count = stock_count - $1 
-                WHERE name = $2 AND shop_id = $3
-            """, order['quantity'], order['item_name'].split('(')[0].strip(), order['shop_id'])
+            # Held stock becomes a sale (lines without a live hold are taken now)
+            await commit_order_stock(conn, [update.order_id])
+        # Other workers hear about it via the items trigger (NOTIFY storefront_invalidate)
+        storefront_cache.invalidate_shop(order['shop_id'])
             
         background_tasks.add_task(schedule_image_deletion, update.order_id)
+    elif update.new_status == "rejected":
+        async with db.pool.acquire() as conn:
+            await release_order_stock(conn, [update.order_id])
 
     messages = {
         "paid": f"✅ *Payment Verified!* Order #{update.order_id} is confirmed.",
@@ -193,38 +201,32 @@ async def ship_manual(
 async def ship_via_rocket(request: Request):
     data = await request.json()
     order_id = data.get('order_id')
+    weight = float(data.get('weight') or 0.5)
     
     async with db.pool.acquire() as conn:
-        # 1. Fetch Order & Shop
-        order = await conn.fetchrow("SELECT * FROM orders WHERE id = $1", order_id)
-        shop = await conn.fetchrow("SELECT * FROM shops WHERE id = $1", order['shop_id'])
+        # 1. Fetch Order, its line items & the shop's Shiprocket account
+        order = await conn.fetchrow(f"""
+            SELECT o.*, s.shiprocket_email, s.shiprocket_password, s.pickup_address,
+                   {ORDER_LINES_JSON}
+            FROM orders o
+            JOIN shops s ON o.shop_id = s.id
+            WHERE o.id = $1
+        """, order_id)
+        if not order:
+            return {"status": "error", "message": "Order not found"}
         
         # 2. VALIDATION (Guardrails)
         if not order['delivery_pincode']:
             return {"status": "error", "message": "Missing Pincode! Edit order manually."}
         
-        if not shop['shiprocket_email'] or not shop['shiprocket_password']:
+        if not order['shiprocket_email'] or not order['shiprocket_password']:
              return {"status": "error", "message": "Seller missing Shiprocket credentials."}
 
-        # 3. CONSTRUCT PAYLOAD
-        ship_data = {
-            "id": order['id'],
-            "items": json.loads(order['items']),
-            "total_amount": float(order['total_amount']),
-            "status": order['status'],
-            
-            # The "Smart Address" Mapping
-            "address": order['delivery_address'], 
-            "city": order['delivery_city'],
-            "pincode": order['delivery_pincode'],
-            "state": order['delivery_state'],
-            "customer_phone": order['customer_phone'],
-            "customer_name": "Valued Customer",
-            "pickup_location_name": shop.get('pickup_address', 'Primary')
-        }
+        # 3. CONSTRUCT PAYLOAD: one Shiprocket item per order line, same as the dashboard and bulk paths
+        ship_data = build_ship_data(order, weight)
 
         # 4. EXECUTE SHIPMENT
-        token = get_shiprocket_token(shop['shiprocket_email'], shop['shiprocket_password'])
+        token = get_shiprocket_token(order['shiprocket_email'], decrypt_data(order['shiprocket_password']))
         if not token: 
             return {"status": "error", "message": "Shiprocket Login Failed"}
         
@@ -250,7 +252,8 @@ async def ship_via_rocket(request: Request):
                 shipping_label_url = $3,  -- Saved for re-printing
                 shipping_awb = $4,
                 status = 'SHIPPED',
-                delivery_status = 'shipped'
+                delivery_status = 'shipped',
+                shipped_at = NOW()
                 WHERE id = $5
             """, shipment_id, response['order_id'], label_url, awb_code, order['id'])
             
@@ -336,6 +339,9 @@ async def bulk_upload_items(
                 print(f"⚠️ Skipped Row {index}: {e}")
                 continue
 
+    if success_count:
+        storefront_cache.invalidate_shop(shop_id)
+
     return {
         "status": "success", 
         "message": f"Imported {success_count} items successfully!",
@@ -349,6 +355,10 @@ async def toggle_review_public(
     is_public: bool = Body(...)
 ):
     async with db.pool.acquire() as conn:
-        await conn.execute("UPDATE reviews SET is_public = $1 WHERE id = $2", is_public, review_id)
+        shop_id = await conn.fetchval(
+            "UPDATE reviews SET is_public = $1 WHERE id = $2 RETURNING shop_id", is_public, review_id
+        )
+    if shop_id is not None:
+        storefront_cache.invalidate_shop(shop_id)
     return {"status": "success"}
 
@@ -1,10 +1,11 @@
 from fastapi import APIRouter, HTTPException, Response
 from pydantic import BaseModel
-import uuid
-import json
 import logging
-from datetime import datetime, timedelta, timezone
 from app.core.database import db
+from app.services.address_service import save_address, address_cache
+from app.utils.checkout_token import (
+    checkout_tokens, CheckoutTokenExpired, CheckoutTokenInvalid, CHECKOUT_TOKEN_REVOKED_CHANNEL
+)
 import os
 
 
@@ -15,30 +16,26 @@ class AddressSubmit(BaseModel):
     session_id: str
     address: dict
 
-# --- 1. GENERATE LINK (Simple & Robust) ---
+# --- 1. GENERATE LINK (Signed, no DB write) ---
 async def create_checkout_url(phone: str) -> str:
-    session_uuid = str(uuid.uuid4())
-    
+    # Clean phone
+    clean_phone = phone.strip().replace("+", "").replace(" ", "")
+
+    # The token itself carries phone + issue time, signed. Nothing to store.
+    token = checkout_tokens.issue(clean_phone)
+    logger.info(f"✅ Link Created for {clean_phone}")
+    return f"https://copit.in/checkout/{token}"
+
+def _verify_or_raise(session_id: str, invalid_status: int, invalid_detail: str):
+    """Pure CPU: signature, expiry (10 min) and this worker's set of spent links."""
     try:
-        async with db.pool.acquire() as conn:
-            # Clean phone
-            clean_phone = phone.strip().replace("+", "").replace(" ", "")
-            
-            # Store ONLY the UUID. We use 'created_at' for expiry.
-            # We force 'created_at = NOW()' on conflict to reset the timer.
-            await conn.execute("""
-                INSERT INTO users (phone_number, magic_token, created_at) 
-                VALUES ($1, $2, NOW())
-                ON CONFLICT (phone_number) 
-                DO UPDATE SET magic_token = $2, created_at = NOW()
-            """, clean_phone, session_uuid)
-            
-        logger.info(f"✅ Link Created for {clean_phone}: {session_uuid}")
-        return f"https://copit.in/checkout/{session_uuid}"
-        
-    except Exception as e:
-        logger.error(f"🔥 DB Error: {e}")
-        return "Error_Generating_Link"
+        return checkout_tokens.verify(session_id)
+    except CheckoutTokenExpired:
+        logger.warning("⏳ Checkout link expired")
+        raise HTTPException(status_code=400, detail="Link expired")
+    except CheckoutTokenInvalid as e:
+        logger.error(f"❌ Checkout link rejected: {e}")
+        raise HTTPException(status_code=invalid_status, detail=invalid_detail)
 
 # --- 2. VERIFY SESSION (No Parsing Needed) ---
 @router.get("/session/{session_id}")
@@ -47,36 +44,16 @@ async def get_session_data(session_id: str, response: Response):
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     
     clean_id = session_id.strip().replace("/", "")
-    logger.info(f"🔍 Lookup Session: {clean_id}")
+    phone, _, _ = _verify_or_raise(clean_id, 404, "Link invalid or used")
 
+    # Only the prefill needs the DB (primary key lookup)
     async with db.pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT phone_number, saved_addresses, created_at 
-            FROM users WHERE magic_token = $1
-        """, clean_id)
-    
-    if not row:
-        logger.error(f"❌ Token Not Found: {clean_id}")
-        raise HTTPException(status_code=404, detail="Link invalid or used")
+        saved_addresses = await conn.fetchval(
+            "SELECT saved_addresses FROM users WHERE phone_number = $1", phone
+        )
 
-    # Time Check (10 Minutes) using DB Timestamp
-    created_at = row['created_at']
-    # Ensure created_at is aware of timezone (Postgres returns aware datetime)
-    now = datetime.now(created_at.tzinfo) 
-    
-    if now > (created_at + timedelta(minutes=10)):
-        logger.warning(f"⏳ Token Expired. Age: {now - created_at}")
-        raise HTTPException(status_code=400, detail="Link expired")
-
-    # Success
-    phone = row['phone_number']
-    saved_address = None
-    if row['saved_addresses']:
-        data = row['saved_addresses']
-        try:
-            saved_address = json.loads(data) if isinstance(data, str) else data
-        except:
-            saved_address = {}
+    # JSONB arrives already decoded (pool codec)
+    saved_address = saved_addresses or None
 
     return {"phone": phone, "saved_address": saved_address}
 
@@ -84,24 +61,28 @@ async def get_session_data(session_id: str, response: Response):
 @router.post("/confirm-address")
 async def confirm_address(data: AddressSubmit):
     clean_id = data.session_id.strip().replace("/", "")
+    phone, nonce, expires_at = _verify_or_raise(clean_id, 400, "Invalid Session")
+    addr = data.address
 
     async with db.pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT phone_number FROM users WHERE magic_token = $1", clean_id)
-        
-        if not row:
-            raise HTTPException(status_code=400, detail="Invalid Session")
-        
-        phone = row['phone_number']
-        addr = data.address
-        
-        # Save Address
-        await conn.execute("""
-            INSERT INTO addresses (user_id, pincode, house_no, area, landmark, city, state, is_default, created_at)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, TRUE, NOW())
-        """, phone, addr.get("pincode"), addr.get("house_no"), addr.get("area"), 
-             addr.get("landmark"), addr.get("city"), addr.get("state"))
+        async with conn.transaction():
+            # Spend the link: the primary key lets only ONE confirm through, on any worker
+            spent = await conn.fetchval("""
+                INSERT INTO checkout_token_revocations (nonce, expires_at)
+                VALUES ($1, to_timestamp($2))
+                ON CONFLICT (nonce) DO NOTHING
+                RETURNING nonce
+            """, nonce, expires_at)
+            if spent is None:
+                raise HTTPException(status_code=400, detail="Invalid Session")
 
-        # Invalidate Token
-        await conn.execute("UPDATE users SET magic_token = NULL WHERE phone_number = $1", phone)
-    
-    return {"redirect_url": f"https://wa.me/{os.getenv('BOT_NUMBER')}?text=Address_Confirmed_for_{clean_id}"}
\ No newline at end of file
+            # Save Address (an unchanged address reuses its row) and make it the default
+            await save_address(conn, phone, addr)
+
+            # Other workers reject the link without asking the DB; expired nonces are no longer needed
+            await conn.execute("SELECT pg_notify($1, $2)", CHECKOUT_TOKEN_REVOKED_CHANNEL, nonce)
+            await conn.execute("DELETE FROM checkout_token_revocations WHERE expires_at < NOW()")
+
+    checkout_tokens.revoke(nonce)
+    address_cache.invalidate(phone)
+    return {"redirect_url": f"https://wa.me/{os.getenv('BOT_NUMBER')}?text=Address_Confirmed_for_{clean_id}"}
@@ -5,8 +5,23 @@ import secrets
 from app.core.database import db
 from app.utils.whatsapp import send_whatsapp_message
 from app.utils.crypto import encrypt_data, decrypt_data
-from typing import Optional
+from typing import Optional, List
 from app.utils.shiprocket import get_shiprocket_token, create_shiprocket_order, generate_shipping_label
+from app.services.shipping_service import (
+    ORDER_LINES_JSON,
+    build_ship_data,
+    describe_shiprocket_error,
+    save_created_shipment,
+    shipped_message,
+    start_bulk_ship_job,
+    get_bulk_ship_job
+)
+from app.services.razorpay_service import invalidate_shop_razorpay
+from app.services.reservation_service import commit_order_stock, release_order_stock
+from app.services.key_rotation_service import reencrypt_shop_secrets, rotation_status
+from app.services.flash_drop_service import end_drop
+from datetime import datetime
+import asyncio
 import json
 
 
@@ -30,6 +45,13 @@ class ShipOrderRequest(BaseModel):
     order_id: int
     weight:float = 0.5  # Default weight for serviceability check
 
+class BulkShipRequest(BaseModel):
+    order_ids: List[int]
+    weight: float = 0.5
+
+# Batches up to this size are answered inline; bigger ones return a job to poll
+BULK_SHIP_INLINE_LIMIT = 20
+
 # 2. Secure Gatekeeper
 async def verify_admin(x_admin_secret: str = Header(..., alias="x-admin-secret")):
     # Load secret inside function to ensure env vars are loaded
@@ -67,7 +89,10 @@ async def verify_payment(
             raise HTTPException(404, "Order not found")
 
         if decision == "APPROVE":
-            await conn.execute("UPDATE orders SET payment_status = 'paid', status = 'processing' WHERE id = $1", order_id)
+            # Paid flag and stock sale commit together
+            async with conn.transaction():
+                await conn.execute("UPDATE orders SET payment_status = 'paid', status = 'processing' WHERE id = $1", order_id)
+                await commit_order_stock(conn, [order_id])
             msg = (
                 f"🎉 *Payment Verified!*\n"
                 f"Your Order #{order_id} with {order['shop_name']} is confirmed. We are packing it now! 📦\n\n"
@@ -75,7 +100,9 @@ async def verify_payment(
                 f"https://copit.in/shop/{order['shop_slug']}"
             )
         else:
-            await conn.execute("UPDATE orders SET payment_status = 'failed', status = 'cancelled' WHERE id = $1", order_id)
+            async with conn.transaction():
+                await conn.execute("UPDATE orders SET payment_status = 'failed', status = 'cancelled' WHERE id = $1", order_id)
+                await release_order_stock(conn, [order_id])
             msg = f"⚠️ Payment Rejected for Order #{order_id}."
             
         # 🚨 THE AWARE NOTIFICATION BLOCK
@@ -124,6 +151,8 @@ async def update_razorpay_keys(
                 WHERE id = $3
             """, encrypted_key_id, encrypted_key_secret, data.shop_id)
 
+        invalidate_shop_razorpay(data.shop_id)
+
         return {"status": "success", "message": "Razorpay keys encrypted and secured."}
         
     except Exception as e:
@@ -172,10 +201,103 @@ async def update_payment_settings(
         """
         
         await conn.execute(query, *values)
+
+    if body.rzp_key or body.rzp_secret:
+        invalidate_shop_razorpay(body.shop_id)
         
     return {"status": "success"}
 
 
+# Strong reference: the event loop only keeps a weak one, a running rotation must not be collected
+_rotation_task = None
+
+
+def _report_rotation_failure(task):
+    if not task.cancelled() and task.exception():
+        print(f"🔥 Key rotation failed: {task.exception()!r}")
+
+
+@router.post("/dashboard/security/rotate-encryption")
+async def rotate_encryption_keys(authorized: bool = Depends(verify_admin)):
+    """Starts re-encrypting every shop secret under the newest master key (runs in the background)."""
+    global _rotation_task
+    if rotation_status["running"] or (_rotation_task and not _rotation_task.done()):
+        return {"status": "running", **rotation_status}
+
+    _rotation_task = asyncio.create_task(reencrypt_shop_secrets())
+    _rotation_task.add_done_callback(_report_rotation_failure)
+    return {"status": "started"}
+
+
+@router.get("/dashboard/security/rotate-encryption")
+async def get_rotation_progress(authorized: bool = Depends(verify_admin)):
+    return {"status": "success", **rotation_status}
+
+
+class FlashDropRequest(BaseModel):
+    item_id: int
+    starts_at: Optional[datetime] = None    # default: now
+    ends_at: Optional[datetime] = None
+    lease_size: int = 5                     # units a worker takes off the stock per DB round trip
+    max_per_buyer: int = 1
+    admit_per_second: Optional[float] = None  # set to turn on the waiting room
+
+@router.post("/dashboard/drops")
+async def start_flash_drop(
+    body: FlashDropRequest,
+    authorized: bool = Depends(verify_admin)
+):
+    """Puts an item (without variants) in drop mode, or updates a running drop. Workers reload via NOTIFY."""
+    async with db.pool.acquire() as conn:
+        item = await conn.fetchrow("SELECT attributes->'variants' AS variants FROM items WHERE id = $1", body.item_id)
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
+        if item['variants']:
+            raise HTTPException(status_code=400, detail="Drop mode only covers items without variants")
+
+        await conn.execute("""
+            INSERT INTO flash_drops (item_id, starts_at, ends_at, lease_size, max_per_buyer, admit_per_second)
+            VALUES ($1, COALESCE($2, NOW()), $3, $4, $5, $6)
+            ON CONFLICT (item_id) DO UPDATE SET
+                starts_at = EXCLUDED.starts_at, ends_at = EXCLUDED.ends_at, lease_size = EXCLUDED.lease_size,
+                max_per_buyer = EXCLUDED.max_per_buyer, admit_per_second = EXCLUDED.admit_per_second,
+                -- Re-scheduled: the waiting room starts over (workers drop their positions on reload)
+                queue_tail = CASE WHEN flash_drops.starts_at = EXCLUDED.starts_at THEN flash_drops.queue_tail ELSE 0 END
+        """, body.item_id, body.starts_at, body.ends_at, body.lease_size, body.max_per_buyer, body.admit_per_second)
+
+    return {"status": "success"}
+
+
+@router.get("/dashboard/drops/{item_id}")
+async def get_flash_drop(item_id: int, authorized: bool = Depends(verify_admin)):
+    """Where the drop's units are: on the shelf, leased to workers, held in checkouts, sold."""
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT d.starts_at, d.ends_at, d.queue_tail, i.stock_count,
+                   (SELECT COALESCE(SUM(units), 0) FROM flash_drop_leases WHERE item_id = d.item_id) AS leased,
+                   (SELECT COUNT(*) FROM flash_drop_leases WHERE item_id = d.item_id) AS workers,
+                   COALESCE(SUM(r.qty) FILTER (WHERE r.status = 'held'), 0) AS held,
+                   COALESCE(SUM(r.qty) FILTER (WHERE r.status = 'sold'), 0) AS sold
+            FROM flash_drops d
+            JOIN items i ON i.id = d.item_id
+            LEFT JOIN stock_reservations r ON r.item_id = d.item_id AND r.created_at >= d.starts_at
+            WHERE d.item_id = $1
+            GROUP BY d.item_id, i.stock_count
+        """, item_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Item is not in drop mode")
+
+    return {"status": "success", **dict(row)}
+
+
+@router.delete("/dashboard/drops/{item_id}")
+async def end_flash_drop(item_id: int, authorized: bool = Depends(verify_admin)):
+    """Ends the drop: unclaimed leased units go back to the item's stock."""
+    if not await end_drop(item_id):
+        raise HTTPException(status_code=404, detail="Item is not in drop mode")
+    return {"status": "success"}
+
+
 @router.post("/dashboard/resend-receipt")
 async def resend_receipt(
     body: ResendRequest, 
@@ -222,8 +344,9 @@ async def process_shipment(
 ):
     async with db.pool.acquire() as conn:
         # 1. Fetch Order and Shop Details
-        order = await conn.fetchrow("""
-            SELECT o.*, s.shiprocket_email, s.shiprocket_password, s.pickup_address, s.name as shop_name , s.slug as shop_slug
+        order = await conn.fetchrow(f"""
+            SELECT o.*, s.shiprocket_email, s.shiprocket_password, s.pickup_address, s.name as shop_name , s.slug as shop_slug,
+                   {ORDER_LINES_JSON}
             FROM orders o
             JOIN shops s ON o.shop_id = s.id
             WHERE o.id = $1
@@ -248,37 +371,24 @@ async def process_shipment(
             raise HTTPException(status_code=500, detail="Shiprocket Login Failed. Check credentials.")
 
         # 4. Format Data for Shiprocket
-        # We need to construct a dummy "items" list since our DB stores a flat string for item_name
-        # In a strict Enterprise system, you'd store JSON line items.
-        ship_data = dict(order)
-        ship_data['items'] = [{
-            "name": order['item_name'],
-            "qty": order['quantity'],
-            "price": order['total_amount'] / order['quantity'] if order['quantity'] > 0 else order['total_amount'],
-            "weight": body.weight
-        }]
-        ship_data['pickup_location_name'] = order['pickup_address'] or "Primary"
-        ship_data['customer_name'] = "Customer" # Can be updated if you collect names later
-
-        # 5. Create Order in Shiprocket
-        sr_response = create_shiprocket_order(token, ship_data)
-        
-        if sr_response.get("status_code") in [400, 422] or "error" in sr_response:
-            # Extract Shiprocket's exact complaint (e.g., "Insufficient balance")
-            error_msg = sr_response.get("message", "Shiprocket rejected the order.")
-            
-            if "balance" in error_msg.lower():
-                raise HTTPException(status_code=402, detail="⚠️ Insufficient Shiprocket Wallet Balance. Please recharge your Shiprocket account.")
-            elif "pincode" in error_msg.lower():
-                raise HTTPException(status_code=400, detail="⚠️ Unserviceable Pincode. Courier cannot deliver here.")
-            else:
-                raise HTTPException(status_code=400, detail=f"Shiprocket Error: {error_msg}")
-
-        shipment_id = sr_response.get("shipment_id")
-        awb_code = sr_response.get("awb_code")
-        
+        ship_data = build_ship_data(order, body.weight)
+
+        # 5. Create Order in Shiprocket (unless an earlier attempt already did, and only the label failed)
+        shipment_id = order['shiprocket_shipment_id']
+        awb_code = order['awb_code']
         if not shipment_id:
-            raise HTTPException(status_code=500, detail="Shiprocket did not return a Shipment ID.")
+            sr_response = create_shiprocket_order(token, ship_data)
+
+            failure = describe_shiprocket_error(sr_response)
+            if failure:
+                raise HTTPException(status_code=failure[0], detail=failure[1])
+
+            shipment_id = sr_response.get("shipment_id")
+            awb_code = sr_response.get("awb_code")
+
+            if not shipment_id:
+                raise HTTPException(status_code=500, detail="Shiprocket did not return a Shipment ID.")
+            await save_created_shipment(order['id'], shipment_id, awb_code)
 
         # 6. Generate Shipping Label PDF
         label_url = None
@@ -295,20 +405,16 @@ async def process_shipment(
             SET delivery_status = 'shipped', 
                 awb_code = $1, 
                 tracking_url = $2, 
-                shipping_label_url = $3 
-            WHERE id = $4
-        """, awb_code, tracking_url, label_url, order['id'])
+                shipping_label_url = $3,
+                shipping_provider = 'Shiprocket',
+                shiprocket_shipment_id = $4,
+                shipped_at = NOW()
+            WHERE id = $5
+        """, awb_code, tracking_url, label_url, shipment_id, order['id'])
 
         # 8. Dispatch WhatsApp Notification
         if tracking_url:
-            wa_msg = (
-                f"🎉 *Great news! Your order has been shipped.*\n\n"
-                f"📦 *Item:* {order['item_name']}\n"
-                f"🏪 *From:* {order['shop_name']}\n\n"
-                f"📍 *Track your package live here:*\n{tracking_url}\n\n"
-                f"🛍️ *Shop again:*\n"
-                f"https://copit.in/shop/{order['shop_slug']}"
-            )
+            wa_msg = shipped_message(order, tracking_url)
             try:
                 await send_whatsapp_message(order['customer_phone'], wa_msg)
             except Exception as e:
@@ -324,6 +430,39 @@ async def process_shipment(
 
 
 
+@router.post("/dashboard/ship-orders/bulk")
+async def process_bulk_shipment(
+    body: BulkShipRequest,
+    authorized: bool = Depends(verify_admin)
+):
+    """Ships many orders at once. Small batches return results inline, large ones return a job_id to poll."""
+    if not body.order_ids:
+        raise HTTPException(status_code=400, detail="No orders selected.")
+
+    job, task = start_bulk_ship_job(body.order_ids, body.weight)
+
+    if len(job.order_ids) <= BULK_SHIP_INLINE_LIMIT:
+        await asyncio.shield(task)
+        return {"status": "success", **job.snapshot()}
+
+    return {"status": "accepted", **job.snapshot(include_results=False)}
+
+
+@router.get("/dashboard/ship-orders/bulk/{job_id}")
+async def get_bulk_shipment_progress(
+    job_id: str,
+    include_results: bool = False,
+    authorized: bool = Depends(verify_admin)
+):
+    """Cheap progress poll: counters only, unless results are requested or the job is finished."""
+    job = get_bulk_ship_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Bulk shipping job not found")
+
+    return {"status": "success", **job.snapshot(include_results=include_results or job.done)}
+
+
+
 @router.post("/dashboard/ship-manual")
 async def process_manual_shipment(
     body: ManualShipRequest, 
@@ -1,20 +1,21 @@
-from fastapi import APIRouter, Request, HTTPException
-import razorpay
+from fastapi import APIRouter, Request, HTTPException, BackgroundTasks
 import json
 import os
 from app.core.database import db
 from datetime import datetime, timedelta
 import logging
 
-from app.utils.whatsapp import send_whatsapp_message
-from app.utils.crypto import decrypt_data  # 🔐 ADDED ENCRYPTION UTILITY
+from app.services.razorpay_service import get_shop_razorpay, notify_payment_captured  # 🔐 Cached, decrypted shop credentials
+from app.services.payment_intent_service import get_or_create_order_intent
+from app.services.reservation_service import commit_order_stock
+from app.services.tracking_service import tracking_buffer
+from app.utils.razorpay_gateway import create_order, verify_webhook_signature
 
 router = APIRouter()
 
 # Setup Platform Razorpay Client (For your own SaaS billing)
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
-client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
 logger = logging.getLogger("drop_bot")
 
 # ==============================================================================
@@ -86,7 +87,7 @@ async def create_payment_order(request: Request):
                 "is_new_user": "true" if shop_id == 0 else "false"
             }
         }
-        order = client.order.create(data=order_data)
+        order = await create_order(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET, order_data)
         return {
             "status": "success",
             "order_id": order['id'],
@@ -106,11 +107,9 @@ async def razorpay_webhook(request: Request):
     body_bytes = await request.body()
     body_str = body_bytes.decode()
 
-    try:
-        webhook_secret = os.getenv("RAZORPAY_WEBHOOK_SECRET", "YOUR_WEBHOOK_SECRET")
-        client.utility.verify_webhook_signature(body_str, signature, webhook_secret)
-    except Exception as e:
-        logger.error(f"⚠️ Platform Webhook Signature Failed: {e}")
+    webhook_secret = os.getenv("RAZORPAY_WEBHOOK_SECRET", "YOUR_WEBHOOK_SECRET")
+    if not verify_webhook_signature(body_bytes, signature, webhook_secret):
+        logger.error("⚠️ Platform Webhook Signature Failed")
         raise HTTPException(status_code=400, detail="Invalid Signature")
 
     event = json.loads(body_str)
@@ -147,8 +146,8 @@ async def create_customer_order(request: Request):
 
     async with db.pool.acquire() as conn:
         order = await conn.fetchrow("""
-            SELECT o.total_amount, o.status, o.payment_status, s.id as shop_id, s.razorpay_key_id, s.razorpay_key_secret 
-            FROM orders o JOIN shops s ON o.shop_id = s.id WHERE o.id = $1
+            SELECT total_amount, status, payment_status, shop_id 
+            FROM orders WHERE id = $1
         """, int(order_id))
 
         if not order:
@@ -157,44 +156,41 @@ async def create_customer_order(request: Request):
         # ⚠️ FIX 2: Check proper payment_status
         if order['payment_status'] == 'paid' or order['status'] in ['processing', 'shipped']:
             raise HTTPException(status_code=400, detail="Order already paid")
-            
-        if not order['razorpay_key_id'] or not order['razorpay_key_secret']:
-            raise HTTPException(status_code=400, detail="Shop has not configured Razorpay")
 
-        # 🔓 1. DECRYPT IN MEMORY (Safe)
-        decrypted_key_id = decrypt_data(order['razorpay_key_id'])
-        decrypted_key_secret = decrypt_data(order['razorpay_key_secret'])
+        # 🔓 Cached, already-decrypted credentials for this shop
+        shop_rzp = await get_shop_razorpay(order['shop_id'], conn)
+        if not shop_rzp:
+            raise HTTPException(status_code=400, detail="Shop has not configured Razorpay")
 
-        # 2. Initialize Shop's Razorpay Client
-        shop_client = razorpay.Client(auth=(decrypted_key_id, decrypted_key_secret))
-        
-        try:
-            rzp_order = shop_client.order.create({
-                "amount": int(float(order['total_amount']) * 100),
-                "currency": "INR",
-                "receipt": f"order_{order_id}",
-                "notes": {
-                    "type": "customer_order",
-                    "order_id": order_id,
-                    "shop_id": order['shop_id']
-                }
-            })
-            
-            return {
-                "order_id": rzp_order['id'],
-                "amount": rzp_order['amount'],
-                "key_id": decrypted_key_id # ✅ CORRECT: Returning decrypted public key
+    # Connection released: never hold a pool slot while waiting on Razorpay
+    try:
+        # ♻️ Reuse the live Razorpay order for this checkout unless it expired or the amount changed
+        intent, _ = await get_or_create_order_intent(
+            shop_rzp,
+            order_id,
+            int(float(order['total_amount']) * 100),
+            {
+                "type": "customer_order",
+                "order_id": order_id,
+                "shop_id": order['shop_id']
             }
-        except Exception as e:
-            logger.error(f"Customer Razorpay Creation Failed: {e}")
-            raise HTTPException(status_code=500, detail="Failed to initiate gateway")
+        )
+        
+        return {
+            "order_id": intent['gateway_id'],
+            "amount": intent['amount_paise'],
+            "key_id": shop_rzp.key_id # ✅ CORRECT: Returning decrypted public key
+        }
+    except Exception as e:
+        logger.error(f"Customer Razorpay Creation Failed: {e}")
+        raise HTTPException(status_code=500, detail="Failed to initiate gateway")
 
 
 # ==============================================================================
 # 5. UNIVERSAL CUSTOMER WEBHOOK (Customer Payment Auto-Verify)
 # ==============================================================================
 @router.post("/webhooks/razorpay/universal")   
-async def universal_razorpay_webhook(request: Request):
+async def universal_razorpay_webhook(request: Request, background_tasks: BackgroundTasks):
     """ONE Webhook URL for ALL sellers to paste into their Razorpay Dashboards"""
     signature = request.headers.get('x-razorpay-signature')
     body_bytes = await request.body()
@@ -218,67 +214,49 @@ async def universal_razorpay_webhook(request: Request):
         logger.error(f"Webhook Parsing Error: {e}")
         raise HTTPException(status_code=400, detail="Malformed payload")
 
-    async with db.pool.acquire() as conn:
-        # 🚨 THE FIX: Fetch payment_status, phone, AND item_name in one single query from YOUR schema
-        order = await conn.fetchrow("""
-            SELECT payment_status, customer_phone, item_name 
-            FROM orders 
-            WHERE id = $1
-        """, db_order_id)
-        
-        if not order:
-            return {"status": "ignored"}
-            
-        # ⚠️ IDEMPOTENCY CHECK
-        if order['payment_status'] == 'paid':
-            logger.info(f"Webhook Duplicate Ignored: Order #{db_order_id} already paid.")
-            return {"status": "ok"} 
-
-        # Fetch Shop Secrets
-        shop = await conn.fetchrow("SELECT razorpay_key_secret FROM shops WHERE id = $1", shop_id)
-        if not shop or not shop['razorpay_key_secret']:
-            raise HTTPException(status_code=404, detail="Shop misconfigured")
-
-        # 🔓 DECRYPT THE SELLER'S WEBHOOK SECRET
-        decrypted_secret = decrypt_data(shop['razorpay_key_secret'])
-
-        # VERIFY SIGNATURE
-        try:
-            client = razorpay.Client(auth=("dummy", decrypted_secret))
-            client.utility.verify_webhook_signature(body_str, signature, decrypted_secret)
-        except Exception as e:
-            logger.error(f"🔥 Invalid Signature for Shop {shop_id}: {e}")
-            raise HTTPException(status_code=400, detail="Invalid Signature")
-            
-        # Auto-Approve Order in DB
-        await conn.execute("""
-            UPDATE orders 
-            SET payment_status = 'paid', status = 'processing', transaction_id = $1
-            WHERE id = $2
-        """, payment['id'], db_order_id)
-
-        # 5. The Single Notification System (Now using your schema's item_name)
-        try:
-            purchased_item = order['item_name'] or "your item"
-            msg = f"🎉 *Payment Successful!*\n\nYour order for *{purchased_item}* (Order #{db_order_id}) has been verified and is now processing. 📦"
-            
-            await send_whatsapp_message(order['customer_phone'], msg)
-            
-            # Mark as Sent
-            await conn.execute("UPDATE orders SET notification_status = 'sent' WHERE id = $1", db_order_id)
-        except Exception as wa_error:
-            logger.error(f"WhatsApp Failed for Order {db_order_id}: {wa_error}")
-            # ⚠️ THE FAILSAFE: Mark as Failed so the Dashboard knows!
-            await conn.execute("UPDATE orders SET notification_status = 'failed' WHERE id = $1", db_order_id)
+    # 🔐 VERIFY SIGNATURE FIRST (secret comes from the credential cache, no order reads yet)
+    shop_rzp = await get_shop_razorpay(shop_id)
+    if not shop_rzp:
+        raise HTTPException(status_code=404, detail="Shop misconfigured")
 
-    return {"status": "ok"}
+    if not verify_webhook_signature(body_bytes, signature, shop_rzp.key_secret):
+        logger.error(f"🔥 Invalid Signature for Shop {shop_id}")
+        raise HTTPException(status_code=400, detail="Invalid Signature")
 
+    # ⚡ ATOMIC CAPTURE: the conditional UPDATE is both the idempotency check and the write.
+    # Two simultaneous deliveries can't both win; the loser simply gets no row back.
+    # The paid flag and the stock sale commit together: if the sale fails, the redelivery retries both.
+    async with db.pool.acquire() as conn:
+        async with conn.transaction():
+            order = await conn.fetchrow("""
+                UPDATE orders 
+                SET payment_status = 'paid', status = 'processing', transaction_id = $1
+                WHERE id = $2 AND shop_id = $3 AND payment_status IS DISTINCT FROM 'paid'
+                RETURNING customer_phone, item_name
+            """, payment['id'], db_order_id, shop_id)
+            if order:
+                await commit_order_stock(conn, [db_order_id])
+
+    if not order:
+        logger.info(f"Webhook Duplicate Ignored: Order #{db_order_id} already paid or unknown.")
+        return {"status": "ok"}
+
+    # 5. The Single Notification System: runs after the response, off the pool
+    background_tasks.add_task(notify_payment_captured, db_order_id, order['customer_phone'], order['item_name'])
+    return {"status": "ok"}
 
 
 @router.post("/webhooks/shiprocket/universal")
 async def shiprocket_webhook(request: Request):
+    """
+    Acknowledges Shiprocket instantly. Pushes are buffered and coalesced per AWB;
+    the tracking flusher applies the newest status in one batched statement.
+    """
     # Shiprocket sends a massive JSON payload when tracking status changes
-    payload = await request.json()
+    try:
+        payload = await request.json()
+    except Exception:
+        return {"status": "ignored"}
     
     # We only care about the specific tracking update
     awb = payload.get('awb')
@@ -287,33 +265,5 @@ async def shiprocket_webhook(request: Request):
     if not awb or not current_status:
         return {"status": "ignored"}
 
-    status_lower = current_status.lower()
-
-    # Map Shiprocket statuses to your Supabase schema
-    db_status = 'shipped'
-    if status_lower == 'delivered':
-        db_status = 'delivered'
-    elif status_lower in ['rto initiated', 'rto delivered', 'returned']:
-        db_status = 'returned'
-    elif status_lower in ['out for delivery']:
-        db_status = 'out_for_delivery'
-
-    async with db.pool.acquire() as conn:
-        # Update the database using the AWB tracking number
-        order = await conn.fetchrow("""
-            UPDATE orders 
-            SET delivery_status = $1 
-            WHERE awb_code = $2
-            RETURNING id, customer_phone, item_name
-        """, db_status, awb)
-
-        # Optional: Send WhatsApp when Out for Delivery!
-        if order and db_status == 'out_for_delivery':
-            wa_msg = f"🚚 *Out for Delivery!*\n\nYour order '{order['item_name']}' is out for delivery today. Please keep your phone reachable."
-            try:
-                await send_whatsapp_message(order['customer_phone'], wa_msg)
-            except Exception as e:
-                pass # Silent fail for tracking updates
-
+    tracking_buffer.add(str(awb), current_status, payload.get('current_timestamp'))
     return {"status": "success"}
-
@@ -1,70 +1,122 @@
-import json # 🚨 THE FIX: Required to parse Postgres JSONB
-from fastapi import APIRouter, Query, HTTPException
+from decimal import Decimal
+from typing import List, Optional
+from fastapi import APIRouter, Query, HTTPException, Request, Response
 from app.core.database import db
+from app.services.storefront_cache import (
+    storefront_cache, storefront_cache_requests, etag_matches, STOREFRONT_CACHE_CONTROL
+)
+from app.services.storefront_service import (
+    build_storefront_page, build_storefront_first_page, build_product_page, build_product_list_page,
+    parse_fields, decode_cursor, PageNotFound, PRODUCT_PAGE_DEFAULT_LIMIT, PRODUCT_PAGE_MAX_LIMIT
+)
+from app.services.search_service import (
+    search_items, typeahead, SEARCH_DEFAULT_LIMIT, TYPEAHEAD_DEFAULT_LIMIT
+)
+from app.services.shop_resolver import shop_resolver
 from app.utils.crypto import decrypt_data
 from app.utils.shiprocket import get_shiprocket_token, check_serviceability
 
 router = APIRouter()
 
 @router.get("/storefront/{slug}")
-async def get_storefront(slug: str):
-    async with db.pool.acquire() as conn:
-        # 1. Fetch Shop Details
-        shop = await conn.fetchrow("""
-            SELECT id, name, phone_number, plan_type, logo_url, slug, username, return_policy, instagram_handle
-            FROM shops 
-            WHERE slug = $1 OR username = $1
-        """, slug)
-        
-        if not shop:
-            return {"status": "error", "message": "Shop not found"}
-
-        shop_id = shop['id']
-        
-        # 🚨 FIX 1: Removed 'AND stock_count > 0'. 
-        # If we filter by stock here, complex items with 0 base stock but high variant stock get permanently hidden.
-        items = await conn.fetch("""
-            SELECT id, name, price, image_url, category, description, stock_count, attributes
-            FROM items 
-            WHERE shop_id = $1
-            ORDER BY category, name
-        """, shop_id)
-
-        # 3. Fetch ONLY Public 4-5 Star Reviews
-        reviews = await conn.fetch("""
-            SELECT rating, comment, customer_name, created_at 
-            FROM reviews 
-            WHERE shop_id = $1 AND is_public = TRUE 
-            ORDER BY rating DESC, created_at DESC 
-            LIMIT 5
-        """, shop_id)
-
-    # Convert Record objects to dicts explicitly
-    items_list = []
-    for i in items:
-        item_dict = dict(i)
-        item_dict['stock_count'] = item_dict.get('stock_count') or 0
-        
-        # 🚨 FIX 2: The JSONB Parser
-        # asyncpg returns JSONB as a raw string. We MUST parse it into a Python dict 
-        # so FastAPI sends actual JSON to Next.js instead of a stringified mess.
-        attr = item_dict.get('attributes')
-        if isinstance(attr, str):
-            try:
-                item_dict['attributes'] = json.loads(attr)
-            except Exception:
-                item_dict['attributes'] = {}
-        elif attr is None:
-            item_dict['attributes'] = {}
-            
-        items_list.append(item_dict)
-
-    return {
-        "status": "success",
-        "shop": dict(shop),
-        "products": items_list,
-        "reviews": [dict(r) for r in reviews]
-    }
+async def get_storefront(
+    slug: str,
+    request: Request,
+    page_size: Optional[int] = Query(None, ge=1, le=PRODUCT_PAGE_MAX_LIMIT),
+    fields: Optional[str] = None
+):
+    """
+    Without page_size: the full catalog (legacy clients).
+    With page_size: only the first product page + next_cursor + per-category counts;
+    the grid fetches the rest from /storefront/{slug}/products.
+    """
+    if page_size is None:
+        # ⚡ Served from the per-worker cache; identical misses share one rebuild
+        page = await storefront_cache.get_or_build(slug, lambda: build_storefront_page(slug))
+    else:
+        wanted = _parse_fields_or_400(fields)
+        page = await storefront_cache.get_or_build(
+            f"{slug}?page_size={page_size}&fields={','.join(wanted)}",
+            lambda: build_storefront_first_page(slug, wanted, page_size)
+        )
+    if page is None:
+        return {"status": "error", "message": "Shop not found"}
+    return _page_response(request, page)
+
+
+@router.get("/storefront/{slug}/products")
+async def list_products(
+    slug: str,
+    request: Request,
+    category: Optional[List[str]] = Query(None),
+    after: Optional[str] = None,
+    limit: int = Query(PRODUCT_PAGE_DEFAULT_LIMIT, ge=1, le=PRODUCT_PAGE_MAX_LIMIT),
+    fields: Optional[str] = None
+):
+    """
+    Keyset-paginated catalog: ?category=Tops&category=Caps&fields=id,name,price,image_url&limit=24
+    Pass the returned next_cursor as ?after= for the next page (null = last page).
+    """
+    wanted = _parse_fields_or_400(fields)
+    categories = sorted(set(category)) if category else None
+    try:
+        cursor = decode_cursor(after) if after else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    build = lambda: build_product_list_page(slug, wanted, categories, cursor, limit)
+    if cursor is None:
+        # First pages are what everyone loads, cache them like the storefront
+        key = f"{slug}/products?category={','.join(categories or [])}&limit={limit}&fields={','.join(wanted)}"
+        page = await storefront_cache.get_or_build(key, build)
+    else:
+        page = await build()
+
+    if page is None:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    return _page_response(request, page)
+
+
+@router.get("/storefront/{slug}/search")
+async def search_products(
+    slug: str,
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=50)
+):
+    """Full search over name, category and description (typo tolerant, Postgres trigram)."""
+    shop_id = await shop_resolver.resolve(slug)
+    if shop_id is None:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    return {"status": "success", "results": await search_items(shop_id, q, limit)}
+
+
+@router.get("/storefront/{slug}/typeahead")
+async def typeahead_products(
+    slug: str,
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(TYPEAHEAD_DEFAULT_LIMIT, ge=1, le=20)
+):
+    """As-you-type suggestions from the in-process prefix index (name + category words)."""
+    shop_id = await shop_resolver.resolve(slug)
+    if shop_id is None:
+        raise HTTPException(status_code=404, detail="Shop not found")
+    return {"status": "success", "results": await typeahead(shop_id, q, limit)}
+
+
+def _parse_fields_or_400(fields):
+    try:
+        return parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _page_response(request: Request, page):
+    """Pre-serialized bytes straight to the client, or a bodyless 304 if their copy is current."""
+    headers = {"ETag": page.etag, "Cache-Control": STOREFRONT_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), page.etag):
+        storefront_cache_requests.inc(result="not_modified")
+        return Response(status_code=304, headers=headers)
+    return Response(content=page.body, media_type="application/json", headers=headers)
 
 
 # --- REVIEWS API ---
@@ -80,19 +132,19 @@ async def get_reviews(shop_id: int):
             ORDER BY created_at DESC
         """, shop_id)
         
-        # Fetch stats
+        # Stats: one row, maintained by the reviews trigger (migrations/009)
         stats = await conn.fetchrow("""
             SELECT 
-                COUNT(*) as total_count,
-                COALESCE(AVG(rating), 0)::numeric(10,1) as avg_rating,
-                COUNT(CASE WHEN rating >= 4 THEN 1 END) as positive_count
-            FROM reviews WHERE shop_id = $1
+                review_count as total_count,
+                COALESCE(rating_sum::numeric / NULLIF(rated_count, 0), 0)::numeric(10,1) as avg_rating,
+                positive_count
+            FROM review_summaries WHERE shop_id = $1
         """, shop_id)
 
     return {
         "status": "success",
         "reviews": [dict(r) for r in rows],
-        "stats": dict(stats)
+        "stats": dict(stats) if stats else {"total_count": 0, "avg_rating": Decimal("0.0"), "positive_count": 0}
     }
 
 
@@ -123,54 +175,13 @@ async def check_pincode(shop_id: int, pincode: str):
 
 
 @router.get("/storefront/{shop_slug}/products/{product_slug}")
-async def get_public_item(shop_slug: str, product_slug: str):
-    async with db.pool.acquire() as conn:
-        # 1. Validate the Shop
-        shop = await conn.fetchrow("""
-            SELECT id, name, phone_number, logo_url, slug, instagram_handle 
-            FROM shops WHERE slug = $1 OR username = $1
-        """, shop_slug)
-        
-        if not shop:
-            raise HTTPException(status_code=404, detail="Shop not found")
-
-        # 2. 🚨 THE FIX: Explicitly name public columns. Never use SELECT *.
-        item = await conn.fetchrow("""
-            SELECT id, name, price, description, category, image_url, stock_count, attributes, slug 
-            FROM items 
-            WHERE shop_id = $1 AND slug = $2
-        """, shop['id'], product_slug)
-
-        if not item:
-            raise HTTPException(status_code=404, detail="Item not found")
-
-        # 3. Fetch 4 "More from this shop" items
-        more_items = await conn.fetch("""
-            SELECT id, name, price, image_url, slug
-            FROM items 
-            WHERE shop_id = $1 AND id != $2
-            LIMIT 4
-        """, shop['id'], item['id'])
-
-    # 4. 🚨 THE FIX: Bulletproof Serialization
-    item_dict = dict(item)
-    
-    # Guard against NULL stock in the database
-    item_dict['stock_count'] = item_dict.get('stock_count') or 0
-    
-    # Safely Parse Postgres JSONB string into a Python Dictionary
-    attr = item_dict.get('attributes')
-    if isinstance(attr, str):
-        try:
-            item_dict['attributes'] = json.loads(attr)
-        except Exception:
-            item_dict['attributes'] = {}
-    elif attr is None:
-        item_dict['attributes'] = {}
-
-    return {
-        "status": "success",
-        "shop": dict(shop),
-        "item": item_dict,
-        "more_items": [dict(i) for i in more_items]
-    }
\ No newline at end of file
+async def get_public_item(shop_slug: str, product_slug: str, request: Request):
+    # Same cache as the storefront: any item / shop write invalidates the shop's product pages too
+    try:
+        page = await storefront_cache.get_or_build(
+            f"{shop_slug}/products/{product_slug}",
+            lambda: build_product_page(shop_slug, product_slug)
+        )
+    except PageNotFound as e:
+        raise HTTPException(status_code=404, detail=f"{e} not found")
+    return _page_response(request, page)
@@ -24,6 +24,9 @@ from app.services.order_service import (
     handle_web_handoff, 
     handle_bulk_handoff 
 )
+from app.services.search_service import handle_catalog_search, handle_search_pick, whatsapp_search_query
+from app.services.address_service import get_default_address
+from app.services.reservation_service import commit_order_stock, release_order_stock, release_cart
 
 router = APIRouter()
 logger = logging.getLogger("drop_bot")
@@ -120,11 +123,16 @@ async def receive_message(request: Request):
                         cust_phone = order['customer_phone']
 
                         if action == "YES":
-                            await conn.execute("UPDATE orders SET payment_status = 'paid', status = 'processing' WHERE id = $1", order_id)
+                            # Paid flag and stock sale commit together
+                            async with conn.transaction():
+                                await conn.execute("UPDATE orders SET payment_status = 'paid', status = 'processing' WHERE id = $1", order_id)
+                                await commit_order_stock(conn, [order_id])
                             await send_whatsapp_message(phone, f"✅ Order #{order_id} marked as PAID.")
                             await send_whatsapp_message(cust_phone, f"🎉 *Payment Verified!* \nOrder #{order_id} is confirmed. We are packing it now! 📦")
                         else:
-                            await conn.execute("UPDATE orders SET payment_status = 'failed', status = 'cancelled' WHERE id = $1", order_id)
+                            async with conn.transaction():
+                                await conn.execute("UPDATE orders SET payment_status = 'failed', status = 'cancelled' WHERE id = $1", order_id)
+                                await release_order_stock(conn, [order_id])
                             await send_whatsapp_message(phone, f"❌ Order #{order_id} rejected.")
                             await send_whatsapp_message(cust_phone, f"⚠️ *Payment Rejected.*\nThe seller could not verify your payment for Order #{order_id}. Please contact support.")
                     return {"status": "ok"}
@@ -170,8 +178,8 @@ async def receive_message(request: Request):
                     
                     addr_id = current_data.get("address_id")
                     if not addr_id:
-                        async with db.pool.acquire() as conn:
-                            addr_id = await conn.fetchval("SELECT id FROM addresses WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1", phone)
+                        default = await get_default_address(phone)
+                        addr_id = default['id'] if default else None
                     
                     if addr_id:
                         await finalize_order(phone, current_data, addr_id)
@@ -180,6 +188,7 @@ async def receive_message(request: Request):
                     return {"status": "ok"}
 
                 if selection_id == "recover_cancel":
+                    await release_cart(phone)
                     await state_manager.clear_state(phone)
                     await send_whatsapp_message(phone, "❌ Cart cleared.")
                     return {"status": "ok"}
@@ -194,8 +203,9 @@ async def receive_message(request: Request):
 
             # --- ADDRESS RETURN FROM WEB ---
             if "Address_Confirmed_for_" in text:
-                async with db.pool.acquire() as conn:
-                    addr_id = await conn.fetchval("SELECT id FROM addresses WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1", phone)
+                # The form may have been submitted through another worker: read past the cache
+                default = await get_default_address(phone, fresh=True)
+                addr_id = default['id'] if default else None
 
                 if addr_id:
                     await state_manager.update_state(phone, {"address_confirmed": True, "address_id": addr_id})
@@ -265,6 +275,7 @@ async def receive_message(request: Request):
                     upsell_item = current_data.get('upsell_item', {})
                     new_order = {
                         "phone": phone, "shop_id": current_data.get('shop_id'),
+                        "item_id": upsell_item.get('id'),
                         "total": upsell_item.get('price', 0),
                         "item_name": upsell_item.get('name', 'Add-on'), 
                         "qty": 1, "payment_method": "COD"
@@ -276,6 +287,17 @@ async def receive_message(request: Request):
                 await state_manager.clear_state(phone)
                 return {"status": "ok"}
 
+            # --- CATALOG SEARCH ---
+            if state == "awaiting_search_pick" and text.isdigit():
+                await handle_search_pick(phone, int(text), current_data)
+                return {"status": "ok"}
+
+            # "search <name>" while chatting with a shop (never a reply to one of the bot's prompts)
+            query = whatsapp_search_query(text, state)
+            if query and current_data.get("shop_id"):
+                await handle_catalog_search(phone, current_data["shop_id"], query)
+                return {"status": "ok"}
+
     except Exception as e:
         logger.error(f"🔥 Webhook Error: {e}", exc_info=True)
         
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import os
+import re
+
+from app.core.database import db
+from app.utils.cache import TTLCache, MISSING
+
+logger = logging.getLogger("drop_bot")
+
+# Entries live until a confirm invalidates them; the TTL is only a safety net for missed NOTIFYs
+ADDRESS_CACHE_TTL_SECONDS = float(os.getenv("ADDRESS_CACHE_TTL_SECONDS", "600"))
+ADDRESS_CACHE_MAX_ENTRIES = int(os.getenv("ADDRESS_CACHE_MAX_ENTRIES", "10000"))
+
+ADDRESS_CHANGED_CHANNEL = "address_changed"
+
+ADDRESS_FIELDS = ("house_no", "area", "landmark", "city", "state", "pincode")
+_COLUMNS = "id, " + ", ".join(ADDRESS_FIELDS)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# The user's default, or their latest address if no default was recorded (migrations/012)
+DEFAULT_ADDRESS_SQL = f"""
+    (SELECT {_COLUMNS} FROM addresses
+     WHERE id = (SELECT default_address_id FROM users WHERE phone_number = $1) AND user_id = $1)
+    UNION ALL
+    (SELECT {_COLUMNS} FROM addresses WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1)
+    LIMIT 1
+"""
+
+
+def normalize_address(addr: dict) -> dict:
+    """Trimmed, single-spaced fields; pincode digits only. Missing fields become ''."""
+    clean = {f: _WHITESPACE_RE.sub(" ", str(addr.get(f) or "")).strip() for f in ADDRESS_FIELDS}
+    clean["pincode"] = re.sub(r"\D", "", clean["pincode"])
+    return clean
+
+
+def address_hash(clean: dict) -> str:
+    """Same address, same hash: case and extra whitespace don't matter."""
+    key = "\x1f".join(clean[f].casefold() for f in ADDRESS_FIELDS)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def format_address(addr) -> str:
+    return f"{addr['house_no']}, {addr['area']}, {addr['city']} - {addr['pincode']}"
+
+
+class AddressCache:
+    """Per-worker phone -> default address (or None). Dropped on confirm, on every worker."""
+
+    def __init__(self, ttl_seconds, maxsize):
+        self._defaults = TTLCache(ttl_seconds=ttl_seconds, maxsize=maxsize)
+
+    def get(self, phone):
+        return self._defaults.get(phone)
+
+    def set(self, phone, address):
+        self._defaults.set(phone, address)
+
+    def invalidate(self, phone):
+        self._defaults.invalidate(phone)
+
+    def on_notify(self, payload):
+        """LISTEN callback. payload = phone; None after a (re)connect: drop everything."""
+        if payload is None:
+            self._defaults.clear()
+        else:
+            self.invalidate(payload)
+
+
+address_cache = AddressCache(ADDRESS_CACHE_TTL_SECONDS, ADDRESS_CACHE_MAX_ENTRIES)
+
+
+async def get_default_address(phone, fresh=False):
+    """
+    The address to offer first, as a dict (id + ADDRESS_FIELDS), or None.
+    fresh=True skips the cache (e.g. right after the web form, which may have run on another worker).
+    """
+    if not fresh:
+        cached = address_cache.get(phone)
+        if cached is not MISSING:
+            return cached
+
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(DEFAULT_ADDRESS_SQL, phone)
+    address = dict(row) if row else None
+    address_cache.set(phone, address)
+    return address
+
+
+async def get_address(phone, address_id):
+    """One of the user's addresses by id (None if it isn't theirs). The default is served from cache."""
+    cached = address_cache.get(phone)
+    if cached is not MISSING and cached is not None and cached['id'] == int(address_id):
+        return cached
+
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(
+            f"SELECT {_COLUMNS} FROM addresses WHERE id = $1 AND user_id = $2", int(address_id), phone
+        )
+    return dict(row) if row else None
+
+
+async def save_address(conn, phone, addr: dict):
+    """
+    Stores the address (or finds the identical one already saved) and makes it the default.
+    Runs on the caller's connection / transaction. Returns the address id.
+    Every worker's cached default for `phone` is dropped when the transaction commits.
+    """
+    clean = normalize_address(addr)
+    address_id = await conn.fetchval("""
+        INSERT INTO addresses (user_id, pincode, house_no, area, landmark, city, state, is_default, content_hash, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, TRUE, $8, NOW())
+        ON CONFLICT (user_id, content_hash) WHERE content_hash IS NOT NULL
+        DO UPDATE SET created_at = NOW()
+        RETURNING id
+    """, phone, clean["pincode"] or None, clean["house_no"] or None, clean["area"] or None,
+         clean["landmark"] or None, clean["city"] or None, clean["state"] or None, address_hash(clean))
+
+    await conn.execute("""
+        INSERT INTO users (phone_number, default_address_id) VALUES ($1, $2)
+        ON CONFLICT (phone_number) DO UPDATE SET default_address_id = EXCLUDED.default_address_id
+    """, phone, address_id)
+    await conn.execute("SELECT pg_notify($1, $2)", ADDRESS_CHANGED_CHANNEL, phone)
+    return address_id
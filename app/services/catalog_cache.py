@@ -0,0 +1,118 @@
+import logging
+import os
+import time
+
+from app.core.database import db
+from app.utils.cache import TTLCache, MISSING
+from app.utils.metrics import Counter
+
+logger = logging.getLogger("drop_bot")
+
+# Short on purpose: stock moves. NOTIFY drops changed items right away, the TTL covers missed ones.
+ITEM_CACHE_TTL_SECONDS = float(os.getenv("ITEM_CACHE_TTL_SECONDS", "30"))
+ITEM_CACHE_MAX_ENTRIES = int(os.getenv("ITEM_CACHE_MAX_ENTRIES", "20000"))
+
+item_catalog_requests = Counter(
+    "item_catalog_total",
+    "Item lookups for WhatsApp handoffs by result (hit, miss)",
+    labelnames=("result",),
+)
+
+ITEMS_BY_ID_SQL = """
+    SELECT id, name, price, COALESCE(stock_count, 0) AS stock_count, image_url, description, shop_id, attributes
+    FROM items
+    WHERE id = ANY($1::bigint[])
+"""
+
+
+def _item_from_row(row):
+    attributes = row['attributes'] if isinstance(row['attributes'], dict) else {}
+    return {
+        "id": row['id'],
+        "name": row['name'],
+        "price": float(row['price'] or 0),
+        "stock_count": row['stock_count'],
+        "image_url": row['image_url'],
+        "description": row['description'],
+        "shop_id": row['shop_id'],
+        "variants": attributes.get("variants") or [],
+    }
+
+
+class ItemCatalog:
+    """
+    Per-worker cache of the item fields the bot needs (id -> dict).
+    Misses are fetched together: one `id = ANY($1)` query per call, however many ids.
+    Invalidated by the items_changed NOTIFY (migrations/007); a fetch that started before an
+    invalidation for its shop is returned but not stored.
+    """
+
+    def __init__(self, ttl_seconds, maxsize):
+        self._items = TTLCache(ttl_seconds=ttl_seconds, maxsize=maxsize)
+        self._ids_by_shop = {}      # shop_id -> {item ids}
+        self._invalidated_at = {}   # shop_id -> monotonic time of last invalidation
+        self._cleared_at = 0.0
+
+    async def get_many(self, item_ids):
+        """{item_id: item} for the ids that exist. At most one DB round trip."""
+        found, missing = {}, []
+        for item_id in dict.fromkeys(int(i) for i in item_ids):
+            item = self._items.get(item_id)
+            if item is MISSING:
+                missing.append(item_id)
+            else:
+                found[item_id] = item
+        if found:
+            item_catalog_requests.inc(len(found), result="hit")
+        if not missing:
+            return found
+
+        item_catalog_requests.inc(len(missing), result="miss")
+        started = time.monotonic()
+        async with db.pool.acquire() as conn:
+            rows = await conn.fetch(ITEMS_BY_ID_SQL, missing)
+        for row in rows:
+            item = _item_from_row(row)
+            found[item['id']] = item
+            self._store(item, started)
+        return found
+
+    async def get(self, item_id):
+        return (await self.get_many([item_id])).get(int(item_id))
+
+    def _store(self, item, started):
+        shop_id = item['shop_id']
+        if self._cleared_at > started or self._invalidated_at.get(shop_id, 0.0) > started:
+            return
+        self._items.set(item['id'], item)
+        self._ids_by_shop.setdefault(shop_id, set()).add(item['id'])
+
+    def invalidate(self, shop_id, item_ids=None):
+        """Drops the given items, or every cached item of the shop."""
+        self._invalidated_at[shop_id] = time.monotonic()
+        cached = self._ids_by_shop.get(shop_id, set())
+        for item_id in (cached.copy() if item_ids is None else item_ids):
+            self._items.invalidate(item_id)
+            cached.discard(item_id)
+
+    def clear(self):
+        self._cleared_at = time.monotonic()
+        self._items.clear()
+        self._ids_by_shop.clear()
+        self._invalidated_at.clear()
+
+    def on_notify(self, payload):
+        """LISTEN callback for 'items_changed': 'shop_id:id,id,...' or 'shop_id:*'. None = reconnect."""
+        if payload is None:
+            self.clear()
+            return
+        shop_part, _, ids_part = payload.partition(":")
+        if not shop_part.isdigit():
+            return
+        if ids_part == "*" or not ids_part:
+            self.invalidate(int(shop_part))
+        else:
+            self.invalidate(int(shop_part), [int(i) for i in ids_part.split(",") if i.isdigit()])
+
+
+item_catalog = ItemCatalog(ITEM_CACHE_TTL_SECONDS, ITEM_CACHE_MAX_ENTRIES)
@@ -1,62 +1,191 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+
 from app.core.database import db
+from app.utils.crypto import decrypt_data
 from app.utils.shiprocket import get_shiprocket_token, check_shiprocket_status
 from app.utils.whatsapp import send_whatsapp_message
-import asyncio
 from app.utils.state_manager import state_manager
 
+logger = logging.getLogger("drop_bot")
+
+# 🚦 Concurrency limits for upstream tracking calls.
+# Global caps total in-flight Shiprocket requests, per-seller protects each seller's API quota.
+TRACKING_GLOBAL_CONCURRENCY = int(os.getenv("TRACKING_GLOBAL_CONCURRENCY", "20"))
+TRACKING_SELLER_CONCURRENCY = int(os.getenv("TRACKING_SELLER_CONCURRENCY", "4"))
+
+# 📡 Push-first tracking: Shiprocket webhooks are the source of truth.
+# We only reconcile shipments that have had NO tracking event for this long.
+TRACKING_STALENESS_HOURS = float(os.getenv("TRACKING_STALENESS_HOURS", "12"))
+TRACKING_EXPECTED_TRANSIT_DAYS = float(os.getenv("TRACKING_EXPECTED_TRANSIT_DAYS", "4"))
+WATCHDOG_INTERVAL_SECONDS = int(os.getenv("WATCHDOG_INTERVAL_SECONDS", "900"))
+
+
+def tracking_poll_interval(age: timedelta) -> timedelta:
+    """
+    How often a quiet shipment should be reconciled, based on time since it shipped.
+    Slow in the first days (parcel is just moving through hubs), fast around the
+    expected delivery date, and back off for long-stuck parcels.
+    """
+    expected = timedelta(days=TRACKING_EXPECTED_TRANSIT_DAYS)
+    if age < expected - timedelta(days=1):
+        return timedelta(hours=12)
+    if age < expected + timedelta(days=2):
+        return timedelta(hours=1)
+    return timedelta(hours=6)
+
+
+async def _load_stale_shipments():
+    """
+    Find in-transit Shiprocket orders whose last webhook event is older than the staleness
+    window, then keep only those whose age-based poll interval has elapsed.
+    """
+    async with db.pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT o.id, o.shiprocket_shipment_id, o.customer_phone, o.shop_id,
+                   COALESCE(o.shipped_at, o.created_at) AS shipped_at, o.last_tracking_poll_at, NOW() AS db_now,
+                   s.shiprocket_email, s.shiprocket_password
+            FROM orders o
+            JOIN shops s ON o.shop_id = s.id
+            WHERE o.delivery_status IN ('shipped', 'out_for_delivery')
+              AND o.shipping_provider = 'Shiprocket'
+              AND (o.last_tracking_event_at IS NULL
+                   OR o.last_tracking_event_at < NOW() - make_interval(secs => $1))
+        """, TRACKING_STALENESS_HOURS * 3600)
+
+    due = []
+    for row in rows:
+        now = row['db_now']
+        last_poll = row['last_tracking_poll_at']
+        if last_poll is None or now - last_poll >= tracking_poll_interval(now - row['shipped_at']):
+            due.append(row)
+    return due
+
+
+async def _record_polled(order_ids):
+    """Stamps last_tracking_poll_at for every shipment we just reconciled (one statement)."""
+    async with db.pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE orders SET last_tracking_poll_at = NOW()
+            WHERE id = ANY($1::bigint[])
+        """, order_ids)
+
+
+async def _poll_seller(email, password, orders, global_limit):
+    """
+    Logs in ONCE for a seller and checks all their shipments with bounded concurrency.
+    Returns the orders Shiprocket reports as DELIVERED.
+    """
+    seller_limit = asyncio.Semaphore(TRACKING_SELLER_CONCURRENCY)
+
+    async with global_limit:
+        token = await asyncio.to_thread(get_shiprocket_token, email, decrypt_data(password))
+
+    if not token:
+        logger.warning(f"⚠️ Watchdog: Shiprocket login failed for {email}, skipping {len(orders)} shipments.")
+        return []
+
+    async def _check(order):
+        # Seller slot first: a seller queued on its own limit must not sit on global slots others could use
+        async with seller_limit, global_limit:
+            status = await asyncio.to_thread(check_shiprocket_status, token, order['shiprocket_shipment_id'])
+        return order, status
+
+    results = await asyncio.gather(*(_check(o) for o in orders))
+    return [order for order, status in results if status == "DELIVERED"]
+
+
+async def _mark_delivered(order_ids):
+    """Applies all delivered transitions in ONE statement. Returns only rows that actually moved."""
+    async with db.pool.acquire() as conn:
+        return await conn.fetch("""
+            UPDATE orders
+            SET delivery_status = 'delivered', status = 'DELIVERED', is_review_requested = TRUE
+            WHERE id = ANY($1::bigint[]) AND delivery_status IN ('shipped', 'out_for_delivery')
+            RETURNING id, customer_phone, shop_id
+        """, order_ids)
+
+
+async def _request_review(order):
+    """TRIGGER REVIEW REQUEST (Strategy 3): ask for a rating and capture the reply."""
+    msg = (
+        f"📦 *Delivered!* We hope you love your order.\n\n"
+        f"⭐ How would you rate your experience?\n"
+        f"Reply with a number *1 to 5*."
+    )
+    try:
+        await send_whatsapp_message(order['customer_phone'], msg)
+    except Exception as e:
+        logger.error(f"WhatsApp review request failed for Order #{order['id']}: {e}")
+
+    await state_manager.set_state(order['customer_phone'], {
+        "state": "awaiting_review_rating",
+        "shop_id": order['shop_id'],
+        "order_id": order['id']
+    })
+
+
+async def run_tracking_cycle():
+    """
+    One reconciliation pass: load quiet shipments that are due, poll Shiprocket grouped by seller,
+    apply deliveries in bulk. No pool connection is held while waiting on Shiprocket.
+    """
+    started = time.perf_counter()
+    orders = await _load_stale_shipments()
+
+    # 1. Group shipments by seller credentials (one login per seller per cycle)
+    by_seller = defaultdict(list)
+    for order in orders:
+        if order['shiprocket_email'] and order['shiprocket_password'] and order['shiprocket_shipment_id']:
+            by_seller[(order['shiprocket_email'], order['shiprocket_password'])].append(order)
+
+    # 2. Poll all sellers concurrently under a shared global limit
+    global_limit = asyncio.Semaphore(TRACKING_GLOBAL_CONCURRENCY)
+    seller_results = await asyncio.gather(
+        *(_poll_seller(email, password, seller_orders, global_limit)
+          for (email, password), seller_orders in by_seller.items()),
+        return_exceptions=True
+    )
+
+    delivered_ids = []
+    for result in seller_results:
+        if isinstance(result, Exception):
+            logger.error(f"🔥 Watchdog seller poll failed: {result}")
+            continue
+        delivered_ids.extend(order['id'] for order in result)
+
+    polled_ids = [order['id'] for seller_orders in by_seller.values() for order in seller_orders]
+    if polled_ids:
+        await _record_polled(polled_ids)
+
+    # 3. Batched DB update + notifications (connection already released)
+    delivered = await _mark_delivered(delivered_ids) if delivered_ids else []
+    for order in delivered:
+        logger.info(f"🎉 Order #{order['id']} is Delivered!")
+    await asyncio.gather(*(_request_review(order) for order in delivered))
+
+    # 4. Metrics
+    polled = len(polled_ids)
+    duration = time.perf_counter() - started
+    rate = polled / duration if duration > 0 else 0.0
+    logger.info(
+        f"📊 Watchdog cycle: sellers={len(by_seller)} shipments={polled} delivered={len(delivered)} "
+        f"duration={duration:.2f}s throughput={rate:.1f} shipments/s"
+    )
+    return {"sellers": len(by_seller), "shipments": polled, "delivered": len(delivered), "duration": duration}
+
+
 async def delivery_watchdog_loop():
     print("🐶 Delivery Watchdog Started...")
     while True:
         try:
-            async with db.pool.acquire() as conn:
-                # 1. Find orders that are SHIPPED but not yet DELIVERED (and used Shiprocket)
-                orders = await conn.fetch("""
-                    SELECT o.id, o.shiprocket_shipment_id, o.customer_phone, o.shop_id,
-                           s.shiprocket_email, s.shiprocket_password
-                    FROM orders o
-                    JOIN shops s ON o.shop_id = s.id
-                    WHERE o.delivery_status = 'shipped' 
-                      AND o.shipping_provider = 'Shiprocket'
-                """)
-
-                for order in orders:
-                    # 2. Get Token (In production, cache this!)
-                    token = get_shiprocket_token(order['shiprocket_email'], order['shiprocket_password'])
-                    
-                    if token:
-                        # 3. Check Status
-                        status = check_shiprocket_status(token, order['shiprocket_shipment_id'])
-                        
-                        if status == "DELIVERED":
-                            print(f"🎉 Order #{order['id']} is Delivered!")
-                            
-                            # 4. Update Database
-                            await conn.execute("""
-                                UPDATE orders 
-                                SET delivery_status = 'delivered', status = 'DELIVERED', is_review_requested = TRUE
-                                WHERE id = $1
-                            """, order['id'])
-                            
-                            # 5. TRIGGER REVIEW REQUEST (Strategy 3)
-                            # We send a text message asking for a rating immediately.
-                            
-                            msg = (
-                                f"📦 *Delivered!* We hope you love your order.\n\n"
-                                f"⭐ How would you rate your experience?\n"
-                                f"Reply with a number *1 to 5*."
-                            )
-                            send_whatsapp_message(order['customer_phone'], msg)
-                            
-                            # 6. Set State to Capture Rating
-                            await state_manager.set_state(order['customer_phone'], {
-                                "state": "awaiting_review_rating", 
-                                "shop_id": order['shop_id'],
-                                "order_id": order['id']
-                            })
-
-            # Sleep for 1 hour to avoid hitting API limits too hard
-            await asyncio.sleep(3600) 
-            
+            await run_tracking_cycle()
         except Exception as e:
             print(f"🔥 Watchdog Error: {e}")
-            await asyncio.sleep(3600)
\ No newline at end of file
+
+        # Short tick: the per-shipment interval decides who actually gets polled
+        await asyncio.sleep(WATCHDOG_INTERVAL_SECONDS)
@@ -0,0 +1,419 @@
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+
+import asyncpg
+
+from app.core.database import db
+from app.services.reservation_service import RELEASE_CART_SQL, RESERVATION_HOLD_SECONDS, stock_reservations
+from app.utils.metrics import Counter
+
+logger = logging.getLogger("drop_bot")
+
+FLASH_DROPS_CHANGED_CHANNEL = "flash_drops_changed"
+
+DROP_FLUSH_SECONDS = float(os.getenv("DROP_FLUSH_SECONDS", "2"))
+# Leased units nobody claimed for this long go back to items (other workers / the storefront see them)
+DROP_IDLE_RETURN_SECONDS = float(os.getenv("DROP_IDLE_RETURN_SECONDS", "10"))
+# A worker that hasn't heartbeat its leases for this long is presumed dead; its units are returned
+DROP_LEASE_STALE_SECONDS = int(os.getenv("DROP_LEASE_STALE_SECONDS", "60"))
+# Once the pool is empty, each worker looks again at most this often (expired holds flow back)
+DROP_POOL_RECHECK_SECONDS = float(os.getenv("DROP_POOL_RECHECK_SECONDS", "1"))
+# Waiting-room positions fetched per round trip
+DROP_TICKET_BLOCK = int(os.getenv("DROP_TICKET_BLOCK", "20"))
+
+# Unique per process, also across restarts that reuse the pid
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+flash_drop_claims = Counter(
+    "flash_drop_claims_total",
+    "Flash drop checkout attempts by result (held, sold_out, queued, not_started, limit)",
+    labelnames=("result",),
+)
+# Scales with the stock and the number of workers, not with the number of buyers
+flash_drop_transactions = Counter(
+    "flash_drop_db_transactions_total",
+    "Database transactions issued by flash drops by kind (load, lease, hold, tickets, return, flush)",
+    labelnames=("kind",),
+)
+
+LOAD_DROPS_SQL = """
+    SELECT item_id, starts_at, ends_at, lease_size, max_per_buyer, admit_per_second
+    FROM flash_drops
+    WHERE ($1::bigint[] IS NULL OR item_id = ANY($1::bigint[]))
+"""
+
+# Lease, return, reap and end lock the item rows with this first, in a statement of their own: a row
+# locked and updated in one statement can deadlock against a queued locker (the UPDATE re-waits for the
+# newer row version), and taking items before flash_drop_leases everywhere keeps the lock order fixed.
+# No KEY UPDATE lets the FK checks of concurrent hold INSERTs through.
+LOCK_ITEMS_SQL = """
+    SELECT id, COALESCE(stock_count, 0) AS stock_count
+    FROM items
+    WHERE id = ANY($1::bigint[])
+    ORDER BY id
+    FOR NO KEY UPDATE
+"""
+
+# $1 = item id, $2 = worker id, $3 = units (no more than the locked stock_count).
+# Moves units off items.stock_count into this worker's lease.
+LEASE_SQL = """
+    WITH taken AS (
+        UPDATE items SET stock_count = stock_count - $3::int WHERE id = $1 RETURNING id
+    )
+    INSERT INTO flash_drop_leases (item_id, worker_id, units)
+    SELECT id, $2, $3::int FROM taken
+    ON CONFLICT (item_id, worker_id)
+    DO UPDATE SET units = flash_drop_leases.units + EXCLUDED.units, heartbeat_at = NOW()
+"""
+
+# $1 = phone, $2 = item id, $3 = drop start. Units of this drop the buyer has already ordered.
+ORDERED_FROM_DROP_SQL = """
+    SELECT COALESCE(SUM(qty), 0)
+    FROM stock_reservations
+    WHERE phone = $1 AND item_id = $2 AND order_id IS NOT NULL
+      AND status IN ('held', 'sold') AND created_at >= $3
+"""
+
+# $1 = phone, $2 = item id, $3 = worker id, $4 = qty, $5 = hold seconds.
+# Moves $4 units from the lease into a stock hold: the lease row is the DB-side twin of the in-memory counter.
+# Returns 'held', or 'no_lease' (lease reaped / drop ended).
+SPEND_LEASE_SQL = """
+    WITH spent AS (
+        UPDATE flash_drop_leases
+        SET units = units - $4::int, heartbeat_at = NOW()
+        WHERE item_id = $2 AND worker_id = $3 AND units >= $4::int
+        RETURNING item_id
+    ),
+    held AS (
+        INSERT INTO stock_reservations (phone, item_id, variant_key, qty, expires_at)
+        SELECT $1, item_id, '', $4::int, NOW() + make_interval(secs => $5::int) FROM spent
+        RETURNING id
+    )
+    SELECT CASE WHEN EXISTS (SELECT 1 FROM held) THEN 'held' ELSE 'no_lease' END
+"""
+
+# $1 = item id, $2 = worker id, $3 = units. Gives unclaimed units back to items.
+RETURN_LEASE_SQL = """
+    WITH returned AS (
+        UPDATE flash_drop_leases
+        SET units = units - $3::int, heartbeat_at = NOW()
+        WHERE item_id = $1 AND worker_id = $2 AND units >= $3::int
+        RETURNING item_id
+    )
+    UPDATE items SET stock_count = COALESCE(stock_count, 0) + $3::int
+    WHERE id IN (SELECT item_id FROM returned)
+"""
+
+# $1 = item id, $2 = block size. Returns the last position of the block.
+TICKETS_SQL = "UPDATE flash_drops SET queue_tail = queue_tail + $2 WHERE item_id = $1 RETURNING queue_tail"
+
+HEARTBEAT_SQL = "UPDATE flash_drop_leases SET heartbeat_at = NOW() WHERE worker_id = $1"
+
+# $1 = worker id, $2 = stale seconds. Items with leases to reap: drop ended, or the worker went away.
+REAP_CANDIDATES_SQL = """
+    SELECT item_id FROM flash_drops WHERE ends_at <= NOW()
+    UNION
+    SELECT item_id FROM flash_drop_leases
+    WHERE worker_id <> $1 AND heartbeat_at < NOW() - make_interval(secs => $2::int)
+"""
+
+# $1 = worker id, $2 = stale seconds, $3 = locked item ids. Hands back the units of workers that went
+# away and closes drops whose ends_at has passed (all their leases back to items).
+REAP_SQL = """
+    WITH ended AS (
+        DELETE FROM flash_drops WHERE ends_at <= NOW() AND item_id = ANY($3::bigint[]) RETURNING item_id
+    ),
+    gone AS (
+        DELETE FROM flash_drop_leases l
+        WHERE l.item_id = ANY($3::bigint[])
+          AND ((l.worker_id <> $1 AND l.heartbeat_at < NOW() - make_interval(secs => $2::int))
+               OR l.item_id IN (SELECT item_id FROM ended))
+        RETURNING l.item_id, l.units
+    ),
+    per_item AS (
+        SELECT item_id, SUM(units)::int AS units FROM gone GROUP BY item_id
+    )
+    UPDATE items i SET stock_count = COALESCE(i.stock_count, 0) + p.units
+    FROM per_item p
+    WHERE i.id = p.item_id AND p.units > 0
+"""
+
+# $1 = item id. Every lease back to items, then the drop row goes.
+END_DROP_SQL = """
+    WITH gone AS (
+        DELETE FROM flash_drop_leases WHERE item_id = $1 RETURNING units
+    ),
+    restocked AS (
+        UPDATE items SET stock_count = COALESCE(stock_count, 0) + (SELECT COALESCE(SUM(units), 0) FROM gone)
+        WHERE id = $1
+    )
+    DELETE FROM flash_drops WHERE item_id = $1 RETURNING item_id
+"""
+
+
+class DropClaim:
+    """Outcome of a checkout attempt on a drop item."""
+
+    def __init__(self, status, qty=0, ahead=None, wait_seconds=None, starts_at=None):
+        self.status = status            # held, sold_out, queued, not_started, limit
+        self.qty = qty                  # units held (capped at max_per_buyer)
+        self.ahead = ahead              # queued: people still in line before this buyer
+        self.wait_seconds = wait_seconds
+        self.starts_at = starts_at
+
+
+class Drop:
+    """One item in drop mode, as seen by this worker."""
+
+    def __init__(self, row):
+        self.item_id = row['item_id']
+        self.units = 0                  # leased to this worker, not handed out yet
+        self.pool_empty_at = None       # monotonic time the last lease came back empty
+        self.last_claim_at = time.monotonic()
+        self.lease_lock = asyncio.Lock()
+        self.ticket_lock = asyncio.Lock()
+        self.starts_at = None
+        self.configure(row)
+
+    def configure(self, row):
+        if row['starts_at'] != self.starts_at:
+            # (Re)scheduled: a new waiting room (the dashboard resets queue_tail along with starts_at)
+            self.next_ticket = 1
+            self.ticket_end = 0         # next_ticket > ticket_end: block used up
+            self.positions = {}         # phone -> waiting-room position, until let in
+        self.starts_at = row['starts_at']
+        self.ends_at = row['ends_at']
+        self.lease_size = row['lease_size']
+        self.max_per_buyer = row['max_per_buyer']
+        self.admit_per_second = row['admit_per_second']
+
+    def is_over(self, now):
+        return self.ends_at is not None and now >= self.ends_at
+
+    def admitted(self, now):
+        """Waiting-room positions let in so far."""
+        return math.floor((now - self.starts_at).total_seconds() * self.admit_per_second)
+
+    def sold_out(self):
+        return (self.units == 0 and self.pool_empty_at is not None
+                and time.monotonic() - self.pool_empty_at < DROP_POOL_RECHECK_SECONDS)
+
+
+class FlashDrops:
+    """
+    Per-worker drop counters. Buyers are answered from memory; the database sees one lease per
+    `lease_size` units, one hold per winner and one ticket block per DROP_TICKET_BLOCK shoppers.
+    Config comes from flash_drops and is reloaded on the flash_drops_changed NOTIFY (migrations/015).
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self._drops = {}            # item_id -> Drop
+        self._loaded = False
+        self._stale = set()         # item ids to reload
+        self._reload_lock = asyncio.Lock()
+
+    def on_notify(self, payload):
+        """LISTEN callback. payload = item id; None after a (re)connect: reload everything."""
+        if payload is None:
+            self._loaded = False
+        elif payload.isdigit():
+            self._stale.add(int(payload))
+
+    async def _reload(self):
+        async with self._reload_lock:
+            if self._loaded and not self._stale:
+                return
+            ids = None if not self._loaded else list(self._stale)
+            self._stale.clear()
+            async with db.pool.acquire() as conn:
+                rows = await conn.fetch(LOAD_DROPS_SQL, ids)
+            flash_drop_transactions.inc(kind="load")
+
+            found = {r['item_id']: r for r in rows}
+            for item_id in (list(self._drops) if ids is None else ids):
+                if item_id not in found:
+                    self._drops.pop(item_id, None)   # ended: its leases went back with it
+            for item_id, row in found.items():
+                if item_id in self._drops:
+                    self._drops[item_id].configure(row)
+                else:
+                    self._drops[item_id] = Drop(row)
+            self._loaded = True
+
+    def sold_out(self, item_id):
+        """Memory-only check, safe to call before any other work."""
+        if not str(item_id).isdigit():
+            return False
+        drop = self._drops.get(int(item_id))
+        return drop is not None and drop.sold_out()
+
+    async def claim(self, phone, item_id, qty):
+        """
+        Holds `qty` units (capped at the drop's max_per_buyer) of a drop item for `phone`.
+        Returns a DropClaim, or None when the item isn't in drop mode (use the regular hold).
+        """
+        if not self._loaded or self._stale:
+            await self._reload()
+        drop = self._drops.get(int(item_id))
+        now = datetime.now(timezone.utc)
+        if drop is None or drop.is_over(now):
+            return None
+        if now < drop.starts_at:
+            return self._answer(DropClaim("not_started", starts_at=drop.starts_at))
+
+        qty = min(int(qty), drop.max_per_buyer)
+
+        if drop.admit_per_second:
+            position = drop.positions.get(phone) or await self._ticket(drop, phone)
+            remaining = position - drop.admitted(now)
+            if remaining > 0:
+                wait = math.ceil(remaining / drop.admit_per_second)
+                return self._answer(DropClaim("queued", ahead=remaining - 1, wait_seconds=wait))
+            drop.positions.pop(phone, None)   # let in: the ticket is used up
+
+        if drop.units < qty and not drop.sold_out():
+            async with drop.lease_lock:
+                if drop.units < qty and not drop.sold_out():  # someone else may have leased while we waited
+                    leased = await self._lease(drop, max(drop.lease_size, qty - drop.units))
+                    if leased is None:
+                        return None
+        # No await between the check and the decrement: this is the atomic step
+        if drop.units < qty:
+            return self._answer(DropClaim("sold_out"))
+        drop.units -= qty
+        drop.last_claim_at = time.monotonic()
+
+        try:
+            result = await self._hold(drop, phone, qty)
+        except Exception:
+            drop.units += qty
+            raise
+        if result == "limit":
+            drop.units += qty
+            return self._answer(DropClaim("limit", qty=qty))
+        if result == "no_lease":
+            # Our lease was reaped or the drop closed: sell through the regular path
+            drop.units = 0
+            return None
+        return self._answer(DropClaim("held", qty=qty))
+
+    def _answer(self, claim):
+        flash_drop_claims.inc(result=claim.status)
+        return claim
+
+    async def _lease(self, drop, units):
+        """Adds up to `units` to this worker's lease. None if the drop is gone."""
+        try:
+            async with db.pool.acquire() as conn:
+                async with conn.transaction():
+                    locked = await conn.fetchrow(LOCK_ITEMS_SQL, [drop.item_id])
+                    leased = min(locked['stock_count'], units) if locked else 0
+                    if leased > 0:
+                        await conn.execute(LEASE_SQL, drop.item_id, self.worker_id, leased)
+        except asyncpg.ForeignKeyViolationError:
+            self._drops.pop(drop.item_id, None)
+            return None
+        finally:
+            flash_drop_transactions.inc(kind="lease")
+        drop.units += leased
+        drop.pool_empty_at = time.monotonic() if leased < units else None
+        return leased
+
+    async def _hold(self, drop, phone, qty):
+        """'held', 'limit' (buyer already ordered their share; their cart hold is left alone) or 'no_lease'."""
+        released = 0
+        async with db.pool.acquire() as conn:
+            async with conn.transaction():
+                ordered = await conn.fetchval(ORDERED_FROM_DROP_SQL, phone, drop.item_id, drop.starts_at)
+                if ordered + qty > drop.max_per_buyer:
+                    result = "limit"
+                else:
+                    released = await conn.fetchval(RELEASE_CART_SQL, phone)
+                    result = await conn.fetchval(
+                        SPEND_LEASE_SQL, phone, drop.item_id, self.worker_id, qty, RESERVATION_HOLD_SECONDS
+                    )
+        flash_drop_transactions.inc(kind="hold")
+        if released:
+            stock_reservations.inc(released, result="released")
+        if result == "held":
+            stock_reservations.inc(result="held")
+        return result
+
+    async def _ticket(self, drop, phone):
+        async with drop.ticket_lock:
+            if phone in drop.positions:
+                return drop.positions[phone]
+            if drop.next_ticket > drop.ticket_end:
+                async with db.pool.acquire() as conn:
+                    tail = await conn.fetchval(TICKETS_SQL, drop.item_id, DROP_TICKET_BLOCK)
+                flash_drop_transactions.inc(kind="tickets")
+                drop.next_ticket, drop.ticket_end = tail - DROP_TICKET_BLOCK + 1, tail
+            position = drop.next_ticket
+            drop.next_ticket += 1
+            drop.positions[phone] = position
+            return position
+
+    async def _return_units(self, drop):
+        """Writes this worker's unclaimed units back to items."""
+        async with drop.lease_lock:
+            units, drop.units = drop.units, 0
+            if not units:
+                return
+            try:
+                async with db.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute(LOCK_ITEMS_SQL, [drop.item_id])
+                        await conn.execute(RETURN_LEASE_SQL, drop.item_id, self.worker_id, units)
+            except Exception:
+                drop.units += units
+                raise
+            finally:
+                flash_drop_transactions.inc(kind="return")
+
+    async def flush(self):
+        """Periodic write-through: idle / ended leases back to items, heartbeat, reap dead workers."""
+        if not self._loaded or self._stale:
+            await self._reload()
+        now = datetime.now(timezone.utc)
+        for drop in list(self._drops.values()):
+            if drop.units and (drop.is_over(now) or time.monotonic() - drop.last_claim_at > DROP_IDLE_RETURN_SECONDS):
+                await self._return_units(drop)
+
+        async with db.pool.acquire() as conn:
+            await conn.execute(HEARTBEAT_SQL, self.worker_id)
+            candidates = [r['item_id'] for r in await conn.fetch(REAP_CANDIDATES_SQL, self.worker_id, DROP_LEASE_STALE_SECONDS)]
+            if candidates:
+                async with conn.transaction():
+                    locked = [r['id'] for r in await conn.fetch(LOCK_ITEMS_SQL, candidates)]
+                    await conn.execute(REAP_SQL, self.worker_id, DROP_LEASE_STALE_SECONDS, locked)
+        flash_drop_transactions.inc(kind="flush")
+        for item_id in [i for i, d in self._drops.items() if d.is_over(now)]:
+            del self._drops[item_id]
+
+
+flash_drops = FlashDrops(WORKER_ID)
+
+
+async def end_drop(item_id):
+    """Takes an item out of drop mode: every worker's lease goes back to items. False if it wasn't one."""
+    async with db.pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(LOCK_ITEMS_SQL, [int(item_id)])
+            return await conn.fetchval(END_DROP_SQL, int(item_id)) is not None
+
+
+async def flash_drop_loop():
+    print("⚡ Flash Drop Engine Started...")
+    while True:
+        try:
+            await flash_drops.flush()
+        except Exception as e:
+            print(f"🔥 Flash Drop Error: {e}")
+        await asyncio.sleep(DROP_FLUSH_SECONDS)
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+
+from app.core.database import db
+from app.utils.vault import vault
+
+logger = logging.getLogger("drop_bot")
+
+KEY_ROTATION_BATCH_SIZE = int(os.getenv("KEY_ROTATION_BATCH_SIZE", "200"))
+# Every encrypted column on shops
+SECRET_COLUMNS = ("razorpay_key_id", "razorpay_key_secret", "shiprocket_password")
+
+rotation_status = {"running": False, "scanned": 0, "rotated": 0, "last_id": 0}
+
+
+def _rotate_row(row):
+    """Returns {column: new_ciphertext} for values still under an old key."""
+    return {
+        col: vault.rotate(row[col])
+        for col in SECRET_COLUMNS
+        if vault.needs_rotation(row[col])
+    }
+
+
+async def reencrypt_shop_secrets(batch_size=KEY_ROTATION_BATCH_SIZE):
+    """
+    Moves every shops secret onto the PRIMARY master key, online.
+    Keyset iteration (id > last_id) keeps each batch an index range scan; each batch is
+    written back with ONE statement that only touches values that haven't changed since we read them.
+    """
+    if not vault.enabled or len(vault.keys) < 2:
+        logger.info("🔐 Key rotation skipped: configure ENCRYPTION_MASTER_KEYS=new,old first.")
+        return rotation_status
+
+    rotation_status.update(running=True, scanned=0, rotated=0, last_id=0)
+    last_id = 0
+    try:
+        while True:
+            async with db.pool.acquire() as conn:
+                rows = await conn.fetch(f"""
+                    SELECT id, {', '.join(SECRET_COLUMNS)}
+                    FROM shops
+                    WHERE id > $1
+                    ORDER BY id
+                    LIMIT $2
+                """, last_id, batch_size)
+            if not rows:
+                break
+
+            last_id = rows[-1]['id']
+            rotation_status["scanned"] += len(rows)
+
+            # Fernet is CPU-bound: keep the event loop free
+            rotated = await asyncio.to_thread(lambda: [(r, _rotate_row(r)) for r in rows])
+            changed = [(r, new) for r, new in rotated if new]
+
+            if changed:
+                ids, olds, news = [], {c: [] for c in SECRET_COLUMNS}, {c: [] for c in SECRET_COLUMNS}
+                for r, new in changed:
+                    ids.append(r['id'])
+                    for col in SECRET_COLUMNS:
+                        olds[col].append(r[col])
+                        news[col].append(new.get(col, r[col]))
+
+                set_clause = ", ".join(f"{c} = u.new_{c}" for c in SECRET_COLUMNS)
+                guard = " AND ".join(f"s.{c} IS NOT DISTINCT FROM u.old_{c}" for c in SECRET_COLUMNS)
+                cols = ", ".join(f"old_{c}, new_{c}" for c in SECRET_COLUMNS)
+                params = []
+                for col in SECRET_COLUMNS:
+                    params.extend([olds[col], news[col]])
+                casts = ", ".join(f"${i}::text[]" for i in range(2, 2 + len(params)))
+
+                async with db.pool.acquire() as conn:
+                    result = await conn.execute(f"""
+                        UPDATE shops s
+                        SET {set_clause}
+                        FROM unnest($1::bigint[], {casts}) AS u(id, {cols})
+                        WHERE s.id = u.id AND {guard}
+                    """, ids, *params)
+                rotation_status["rotated"] += int(result.split()[-1])
+
+            rotation_status["last_id"] = last_id
+            logger.info(f"🔐 Key rotation progress: scanned={rotation_status['scanned']} rotated={rotation_status['rotated']} last_id={last_id}")
+    finally:
+        rotation_status["running"] = False
+
+    # Old ciphertexts are gone from the DB; drop their cached plaintexts too
+    vault.clear_cache()
+    logger.info(f"✅ Key rotation complete: {rotation_status}")
+    return rotation_status
@@ -8,6 +8,17 @@ import json
 import asyncio
 import re
 from app.core.database import db
+from app.services.address_service import get_default_address, get_address, format_address
+from app.services.catalog_cache import item_catalog
+from app.services.flash_drop_service import flash_drops
+from app.services.related_service import related_items_json_sql
+from app.services.reservation_service import (
+    RESERVATION_PAYMENT_SECONDS,
+    StockUnavailable,
+    commit_order_stock,
+    hold_order_shortfall,
+    hold_stock
+)
 from app.utils.state_manager import state_manager
 from app.utils.whatsapp import (
     send_whatsapp_message, 
@@ -28,6 +39,10 @@ async def handle_web_handoff(phone, item_id, incoming_text="", referrer=None):
         logger.warning(f"⚠️ Database still booting. Asked {phone} to wait.")
         await send_whatsapp_message(phone, "⏳ Waking up the secure server... Please tap the checkout link again in 10 seconds.")
         return
+    # ⚡ Flash drop sold out: answered from memory, before any state / DB work
+    if flash_drops.sold_out(item_id):
+        await send_whatsapp_message(phone, "😢 *Sold out!* Every unit of this drop has been claimed.")
+        return
     try:
         # 🚨 THE ZOMBIE KILLER (Idempotency Check)
         # Check if they literally just paid or are already in a checkout state
@@ -42,31 +57,40 @@ async def handle_web_handoff(phone, item_id, incoming_text="", referrer=None):
         
         variant_match = re.search(r"📦 \*(.*?)\*", incoming_text)
 
-        async with db.pool.acquire() as conn:
-            item = await conn.fetchrow("""
-                SELECT id, name, price, stock_count, image_url, description, shop_id 
-                FROM items WHERE id = $1
-            """, int(item_id))
+        # ⚡ Catalog cache: repeat taps on the same product don't hit the DB
+        item = await item_catalog.get(item_id)
         
         if not item:
             logger.error(f"❌ Item {item_id} NOT FOUND")
             await send_whatsapp_message(phone, "❌ Item discontinued or not found.")
             return
 
-        # Safe stock check against the requested quantity
-        if item['stock_count'] < quantity:
-            logger.info(f"⚠️ Item {item_id} stock insufficient for requested qty: {quantity}")
-            await send_whatsapp_message(phone, f"😢 Sorry, we only have {item['stock_count']} of *{item['name']}* left in stock.")
-            return
-
         # 2. Process dynamic data
         full_item_name = variant_match.group(1) if variant_match else item['name']
+        variant_key = _variant_key(item, full_item_name)
+
+        # ⚡ Drop-mode items are held from the worker's leased counter (plain items only)
+        claim = None if variant_key else await flash_drops.claim(phone, item['id'], quantity)
+        if claim is None:
+            # Hold the stock now (atomic, per variant); released again if checkout is abandoned
+            try:
+                await hold_stock(phone, [{"item_id": item['id'], "variant": variant_key, "qty": quantity}])
+            except StockUnavailable as e:
+                logger.info(f"⚠️ Item {item_id} stock insufficient for requested qty: {quantity}")
+                await send_whatsapp_message(phone, f"😢 Sorry, we only have {e.available} of *{full_item_name}* left in stock.")
+                return
+        elif claim.status != "held":
+            await _reply_to_drop_claim(phone, item_id, incoming_text, referrer, claim, full_item_name)
+            return
+        else:
+            quantity = claim.qty
         total_price = float(item['price']) * quantity
 
         # 3. 🚨 THE FIX: Bypass 'awaiting_qty' entirely. Save everything and move to checkout.
         await state_manager.update_state(phone, {
             "state": "active", 
             "item_id": item['id'],
+            "variant": variant_key,
             "name": full_item_name,
             "price": float(item['price']),
             "shop_id": item['shop_id'],
@@ -114,29 +138,38 @@ async def handle_bulk_handoff(phone, ref_string):
         shop_id = None
         hero_img = None 
 
-        async with db.pool.acquire() as conn:
-            for item_id_str, qty_str in pairs:
-                item_id = int(item_id_str)
-                qty = int(qty_str)
-                
-                item = await conn.fetchrow("SELECT name, price, image_url, shop_id FROM items WHERE id = $1", item_id)
-                
-                if item:
-                    line_total = float(item['price']) * qty
-                    subtotal += line_total
-                    shop_id = item['shop_id']
-                    if not hero_img: hero_img = item['image_url']
-                    
-                    cart_items.append({
-                        "name": item['name'],
-                        "qty": qty,
-                        "price": float(item['price'])
-                    })
+        # Whole cart in one lookup: cache hits + ONE `id = ANY(...)` query for the rest
+        items = await item_catalog.get_many(int(item_id_str) for item_id_str, _ in pairs)
+
+        for item_id_str, qty_str in pairs:
+            item = items.get(int(item_id_str))
+            qty = int(qty_str)
+
+            if item:
+                line_total = item['price'] * qty
+                subtotal += line_total
+                shop_id = item['shop_id']
+                if not hero_img: hero_img = item['image_url']
+
+                cart_items.append({
+                    "item_id": item['id'],
+                    "name": item['name'],
+                    "qty": qty,
+                    "price": item['price']
+                })
 
         if not cart_items:
             await send_whatsapp_message(phone, "❌ Items no longer available.")
             return
 
+        try:
+            await hold_stock(phone, [{"item_id": i['item_id'], "qty": i['qty']} for i in cart_items])
+        except StockUnavailable as e:
+            short = items[e.item_id]['name']
+            logger.info(f"⚠️ Bulk cart for {phone}: item {e.item_id} stock insufficient")
+            await send_whatsapp_message(phone, f"😢 Sorry, we only have {e.available} of *{short}* left in stock. Please update your cart.")
+            return
+
         await state_manager.set_state(phone, {
             "state": "active", "cart": cart_items, "total": subtotal, 
             "subtotal": subtotal, "shop_id": shop_id, "is_bulk": True
@@ -162,15 +195,11 @@ async def handle_bulk_handoff(phone, ref_string):
 async def check_address_before_payment(phone):
     logger.info(f"📍 Checking Address for {phone}")
     try:
-        async with db.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT id, house_no, area, city, pincode FROM addresses 
-                WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1
-            """, phone)
+        row = await get_default_address(phone)
 
         if row:
             addr_id = row['id']
-            display = f"{row['house_no']}, {row['area']}, {row['city']} - {row['pincode']}"
+            display = format_address(row)
             await send_interactive_message(phone, f"📍 *Confirm Delivery:*\n{display}", [
                 {"id": f"CONFIRM_ADDR_{addr_id}", "title": "✅ Yes, Ship Here"},
                 {"id": "CHANGE_ADDR", "title": "✏️ Change Address"}
@@ -181,6 +210,47 @@ async def check_address_before_payment(phone):
     except Exception as e:
         logger.error(f"🔥 Address Check Error: {e}", exc_info=True)
 
+# Inserts the order and its lines, attaches the buyer's stock holds (COD: sold right away) and returns
+# what the confirmation needs, shop config and cross-sell included.
+# $1-$12 = order columns ($10 = shop_id), $13 = item id to cross-sell from (NULL = none),
+# $14-$18 = line columns (_line_columns), $19 = seconds the holds wait for an online payment
+FINALIZE_ORDER_SQL = f"""
+    WITH shop AS (
+        SELECT name, slug, active_payment_method, razorpay_key_id FROM shops WHERE id = $10
+    ),
+    new_order AS (
+        INSERT INTO orders (
+            customer_phone, item_name, quantity, total_amount, payment_method,
+            delivery_address, delivery_pincode, delivery_city, delivery_state,
+            shop_id, status, payment_status, delivery_status, referrer
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, 'PENDING', $11, 'processing', $12)
+        RETURNING id, item_name, delivery_city, total_amount
+    ),
+    new_lines AS (
+        INSERT INTO order_items (order_id, line_no, item_id, variant_key, name, qty, unit_price)
+        SELECT o.id, l.line_no, l.item_id, l.variant_key, l.name, l.qty, l.unit_price
+        FROM new_order o
+        CROSS JOIN unnest($14::bigint[], $15::text[], $16::text[], $17::int[], $18::numeric[])
+             WITH ORDINALITY AS l(item_id, variant_key, name, qty, unit_price, line_no)
+    ),
+    attached AS (
+        UPDATE stock_reservations r
+        SET order_id = o.id,
+            status = CASE WHEN $5 = 'COD' THEN 'sold' ELSE 'held' END,
+            expires_at = NOW() + make_interval(secs => $19::int),
+            updated_at = NOW()
+        FROM new_order o
+        WHERE r.phone = $1 AND r.status = 'held' AND r.order_id IS NULL
+        RETURNING r.qty
+    )
+    SELECT o.id, o.item_name, o.delivery_city, o.total_amount,
+           s.name AS shop_name, s.slug AS shop_slug, s.active_payment_method, s.razorpay_key_id,
+           {related_items_json_sql('$13::bigint', '3')} AS cross_sell,
+           (SELECT COALESCE(SUM(qty), 0) FROM attached)::int AS reserved_qty
+    FROM new_order o
+    LEFT JOIN shop s ON TRUE
+"""
+
 async def finalize_order(phone, data, addr_id):
     logger.info(f"🏁 Finalizing Order for {phone} | Addr: {addr_id}")
     
@@ -194,54 +264,57 @@ async def finalize_order(phone, data, addr_id):
         pay_raw = data.get("payment_method", "pay_cod")
         payment_method = "COD" if pay_raw == "pay_cod" else "ONLINE"
 
-        async with db.pool.acquire() as conn:
-            # 1. ⚠️ THE FIX: Fetch active_payment_method and razorpay keys
-            addr = await conn.fetchrow("SELECT * FROM addresses WHERE id = $1", int(addr_id))
-            shop = await conn.fetchrow("""
-                SELECT name, upi_id, active_payment_method, razorpay_key_id 
-                FROM shops WHERE id = $1
-            """, int(shop_id))
-
-            if not addr:
-                await send_whatsapp_message(phone, "❌ Address Error. Try again.")
-                return
+        # Usually the cached default the user just confirmed
+        addr = await get_address(phone, addr_id)
+        if not addr:
+            await send_whatsapp_message(phone, "❌ Address Error. Try again.")
+            return
 
-            full_addr = f"{addr['house_no']}, {addr['area']}, {addr['city']} - {addr['pincode']}"
+        full_addr = format_address(addr)
 
-            # 2. Schema Mapping
-            if data.get("is_bulk"):
-                item_list = [f"{i['name']} (x{i['qty']})" for i in data.get("cart", [])]
-                final_item_name = ", ".join(item_list)[:500] 
-                final_qty = sum(i['qty'] for i in data.get("cart", []))
-            else:
-                final_item_name = data.get("name", "Item")
-                final_qty = int(data.get("qty", 1))
-
-            # Set payment status (Online is pending until proven otherwise)
-            pay_status = 'cod_pending' if payment_method == "COD" else 'awaiting_proof'
-
-            # 3. DB Insert
-            logger.info("💾 Inserting Order...")
-            order_id = await conn.fetchval("""
-                INSERT INTO orders (
-                    customer_phone, item_name, quantity, total_amount, payment_method, 
-                    delivery_address, delivery_pincode, delivery_city, delivery_state,
-                    shop_id, status, payment_status, delivery_status, referrer
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, 'PENDING', $11, 'processing', $12)
-                RETURNING id
-            """, 
-            phone, final_item_name, final_qty, total_amount, payment_method,
-            full_addr, addr['pincode'], addr['city'], addr['state'],
-            shop_id, pay_status, data.get("referrer")
+        # 2. Schema Mapping
+        if data.get("is_bulk"):
+            item_list = [f"{i['name']} (x{i['qty']})" for i in data.get("cart", [])]
+            final_item_name = ", ".join(item_list)[:500] 
+            final_qty = sum(i['qty'] for i in data.get("cart", []))
+        else:
+            final_item_name = data.get("name", "Item")
+            final_qty = int(data.get("qty", 1))
+
+        # Set payment status (Online is pending until proven otherwise)
+        pay_status = 'cod_pending' if payment_method == "COD" else 'awaiting_proof'
+
+        lines = _order_lines(data)
+
+        # Cross-sell only for single-item orders
+        cross_sell_item = None if data.get("is_bulk") or not data.get("item_id") else int(data["item_id"])
+
+        # 3. DB Insert: one statement, returns everything the messages below need
+        logger.info("💾 Inserting Order...")
+        try:
+            async with db.pool.acquire() as conn:
+                async with conn.transaction():
+                    order = await conn.fetchrow(FINALIZE_ORDER_SQL,
+                        phone, final_item_name, final_qty, total_amount, payment_method,
+                        full_addr, addr['pincode'], addr['city'], addr['state'],
+                        int(shop_id), pay_status, data.get("referrer"), cross_sell_item, *_line_columns(lines),
+                        RESERVATION_PAYMENT_SECONDS
+                    )
+                    # COD is a sale now. Lines whose hold had already expired are held again (or the
+                    # order is refused) so COD never sells stock that isn't there.
+                    if payment_method == "COD" and order['reserved_qty'] < sum(l['qty'] for l in lines):
+                        await hold_order_shortfall(conn, phone, order['id'], RESERVATION_PAYMENT_SECONDS)
+                        await commit_order_stock(conn, [order['id']])
+        except StockUnavailable as e:
+            short = next((l['name'] for l in lines if l['item_id'] and int(l['item_id']) == e.item_id), "an item")
+            logger.info(f"⚠️ COD order for {phone}: hold lapsed and item {e.item_id} is short now")
+            await send_whatsapp_message(
+                phone, f"😢 Sorry, *{short}* sold out while you were checking out (only {e.available} left). Please update your order."
             )
-            logger.info(f"✅ Order Created: ID {order_id}")
-
-            order = await conn.fetchrow("""
-                        SELECT o.*, s.shiprocket_email, s.shiprocket_password, s.pickup_address, s.name as shop_name, s.slug as shop_slug 
-                        FROM orders o
-                        JOIN shops s ON o.shop_id = s.id
-                        WHERE o.id = $1
-                    """, order_id)
+            return
+        order_id = order['id']
+        logger.info(f"✅ Order Created: ID {order_id}")
+
         # =========================================================
         # 4. ⚠️ THE ROUTING FIX (Razorpay vs Manual)
         # =========================================================
@@ -252,6 +325,7 @@ async def finalize_order(phone, data, addr_id):
                 f"🚚 *Shipping to:* {order['delivery_city']}\n"
                 f"💵 *Payment:* Cash on Delivery (COD)\n\n"
                 f"⚠️ *Important:* Please keep *₹{order['total_amount']}* ready at the time of delivery.\n\n"
+                f"{_cross_sell_lines(order['cross_sell'])}"
                 f"🛍️ *Explore more from {order['shop_name']}:*\n"
                 f"https://copit.in/shop/{order['shop_slug']}"
             )
@@ -261,10 +335,12 @@ async def finalize_order(phone, data, addr_id):
         else: # ONLINE PAYMENT
             
             # Check if shop uses Razorpay AND has configured their keys
-            uses_razorpay = shop and shop.get('active_payment_method') == 'razorpay' and shop.get('razorpay_key_id')
+            uses_razorpay = order['active_payment_method'] == 'razorpay' and order['razorpay_key_id']
             
             if uses_razorpay:
                 # --- RAZORPAY FLOW (PRO) ---
+                # The page gets its Razorpay order from /api/payment/customer/create (routers/payment.py):
+                # cached shop credentials, the pooled async gateway, and the checkout's reused intent
                 pay_url = f"https://copit.in/pay/online?order={order_id}"
                 msg = f"💳 *Pay Securely via Razorpay:*\n{pay_url}\n\n👇 Tap the link to pay. Your order will auto-confirm once successful."
                 await send_whatsapp_message(phone, msg)
@@ -287,6 +363,81 @@ async def finalize_order(phone, data, addr_id):
 # ==============================================================================
 # 3. UTILS & HELPERS
 # ==============================================================================
+def _variant_key(item, full_item_name):
+    """Variant title from a name like "Tee (S / Black)", if the item has that variant; else ''."""
+    match = re.search(r"\(([^()]*)\)\s*$", full_item_name or "")
+    if not match:
+        return ""
+    titles = {v.get('title') for v in item.get('variants') or [] if isinstance(v, dict)}
+    return match.group(1) if match.group(1) in titles else ""
+
+def _order_lines(data):
+    """Cart lines from the checkout state: dicts of item_id, variant, name, qty, price."""
+    if data.get("is_bulk"):
+        return [{
+            "item_id": i.get("item_id"), "variant": i.get("variant") or "",
+            "name": i['name'], "qty": int(i['qty']), "price": float(i['price'])
+        } for i in data.get("cart", [])]
+
+    qty = int(data.get("qty", 1))
+    price = data.get("price")
+    if price is None:
+        price = float(data.get("total", 0)) / qty if qty else 0
+    return [{
+        "item_id": data.get("item_id"), "variant": data.get("variant") or "",
+        "name": data.get("name", "Item"), "qty": qty, "price": float(price)
+    }]
+
+def _line_columns(lines):
+    """order_items columns as parallel arrays, for one multi-row unnest() insert."""
+    return (
+        [int(l['item_id']) if l['item_id'] else None for l in lines],
+        [l['variant'] for l in lines],
+        [l['name'] for l in lines],
+        [l['qty'] for l in lines],
+        [l['price'] for l in lines],
+    )
+
+def _cross_sell_lines(related):
+    """'You may also like' block for the confirmation message, from FINALIZE_ORDER_SQL's cross_sell."""
+    if not related:
+        return ""
+    lines = "\n".join(f"• *{r['name']}* — ₹{float(r['price']):g}" for r in related)
+    return f"✨ *You may also like:*\n{lines}\n\n"
+
+async def _reply_to_drop_claim(phone, item_id, incoming_text, referrer, claim, item_name):
+    if claim.status == "queued":
+        await send_whatsapp_message(
+            phone,
+            f"⏳ *You're in the queue for {item_name}!*\nYou're #{claim.ahead + 1} in line. "
+            f"We'll let you in automatically in about {claim.wait_seconds}s. No need to tap again."
+        )
+        # One pending retry per shopper, however often they tap
+        if phone not in _queued_drop_retries:
+            _queued_drop_retries.add(phone)
+            task = asyncio.create_task(_retry_drop_handoff(phone, item_id, incoming_text, referrer, claim.wait_seconds))
+            _drop_retry_tasks.add(task)
+            task.add_done_callback(_drop_retry_tasks.discard)
+    elif claim.status == "not_started":
+        await send_whatsapp_message(
+            phone, f"🕒 *{item_name}* drops at {claim.starts_at.strftime('%d %b, %H:%M UTC')}. Tap the link again then!"
+        )
+    elif claim.status == "limit":
+        await send_whatsapp_message(phone, f"🙌 You've already got your {claim.qty} of *{item_name}*. One per customer for this drop!")
+    else:
+        await send_whatsapp_message(phone, "😢 *Sold out!* Every unit of this drop has been claimed.")
+
+_queued_drop_retries = set()
+# Strong references: the event loop only keeps weak ones, a sleeping retry must not be collected
+_drop_retry_tasks = set()
+
+async def _retry_drop_handoff(phone, item_id, incoming_text, referrer, wait_seconds):
+    try:
+        await asyncio.sleep(wait_seconds)
+    finally:
+        _queued_drop_retries.discard(phone)
+    await handle_web_handoff(phone, item_id, incoming_text, referrer)
+
 async def handle_selection_drilldown(phone, text_or_id, current_data):
     pass # Drilldown logic placeholder
 
@@ -295,12 +446,27 @@ async def validate_coupon(shop_id, code):
         return await conn.fetchrow("SELECT * FROM coupons WHERE shop_id = $1 AND code = $2 AND is_active = TRUE", shop_id, code.upper())
 
 async def save_order_to_db(data):
-    # Used for Upsells
+    # Used for Upsells: the order + its single line in one statement
+    line = {
+        "item_id": data.get('item_id'), "variant": "", "name": data['item_name'],
+        "qty": data['qty'], "price": float(data['total']) / data['qty'] if data['qty'] else 0
+    }
     async with db.pool.acquire() as conn:
         return await conn.fetchval("""
-            INSERT INTO orders (customer_phone, item_name, quantity, total_amount, payment_method, shop_id, status)
-            VALUES ($1, $2, $3, $4, $5, $6, 'PENDING') RETURNING id
-        """, data['phone'], data['item_name'], data['qty'], data['total'], data['payment_method'], data['shop_id'])
+            WITH new_order AS (
+                INSERT INTO orders (customer_phone, item_name, quantity, total_amount, payment_method, shop_id, status)
+                VALUES ($1, $2, $3, $4, $5, $6, 'PENDING') RETURNING id
+            ),
+            new_lines AS (
+                INSERT INTO order_items (order_id, line_no, item_id, variant_key, name, qty, unit_price)
+                SELECT o.id, l.line_no, l.item_id, l.variant_key, l.name, l.qty, l.unit_price
+                FROM new_order o
+                CROSS JOIN unnest($7::bigint[], $8::text[], $9::text[], $10::int[], $11::numeric[])
+                     WITH ORDINALITY AS l(item_id, variant_key, name, qty, unit_price, line_no)
+            )
+            SELECT id FROM new_order
+        """, data['phone'], data['item_name'], data['qty'], data['total'], data['payment_method'], data['shop_id'],
+             *_line_columns([line]))
 
 async def schedule_image_deletion(order_id: int):
     """
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from app.core.database import db
+from app.utils.cache import TTLCache, MISSING
+from app.utils.razorpay_gateway import create_order, create_payment_link
+
+logger = logging.getLogger("drop_bot")
+
+# Razorpay links need expire_by at least 15 minutes out
+PAYMENT_INTENT_TTL_MINUTES = int(os.getenv("PAYMENT_INTENT_TTL_MINUTES", "30"))
+# Don't hand out an intent that is about to die under the customer
+PAYMENT_INTENT_MIN_REMAINING = timedelta(minutes=2)
+
+_intent_cache = TTLCache(ttl_seconds=PAYMENT_INTENT_TTL_MINUTES * 60, maxsize=5000)
+_intent_locks = {}
+
+
+def order_intent_key(order_id):
+    return f"order:{int(order_id)}"
+
+
+def cart_intent_key(shop_id, phone):
+    return f"cart:{int(shop_id)}:{phone}"
+
+
+def _is_reusable(intent, amount_paise, key_id):
+    # Made under other keys = another Razorpay account: never hand it out again
+    if not intent or intent['amount_paise'] != amount_paise or intent.get('key_id') != key_id:
+        return False
+    return intent['expires_at'] - datetime.now(timezone.utc) > PAYMENT_INTENT_MIN_REMAINING
+
+
+async def _load_intent(intent_key):
+    cached = _intent_cache.get(intent_key)
+    if cached is not MISSING:
+        return cached
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT gateway_id, amount_paise, short_url, expires_at, key_id
+            FROM payment_intents WHERE intent_key = $1
+        """, intent_key)
+    intent = dict(row) if row else None
+    if intent:
+        _intent_cache.set(intent_key, intent)
+    return intent
+
+
+async def _save_intent(intent_key, kind, shop_id, order_id, intent):
+    async with db.pool.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO payment_intents (intent_key, kind, shop_id, order_id, gateway_id, amount_paise, short_url, expires_at, key_id)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+            ON CONFLICT (intent_key) DO UPDATE
+            SET gateway_id = EXCLUDED.gateway_id, amount_paise = EXCLUDED.amount_paise,
+                short_url = EXCLUDED.short_url, expires_at = EXCLUDED.expires_at, key_id = EXCLUDED.key_id,
+                created_at = NOW()
+        """, intent_key, kind, int(shop_id), order_id, intent['gateway_id'], intent['amount_paise'],
+             intent['short_url'], intent['expires_at'], intent['key_id'])
+    _intent_cache.set(intent_key, intent)
+
+
+async def _get_or_create(intent_key, kind, shop_rzp, order_id, amount_paise, create_fn):
+    # One in-flight creation per checkout in this worker: double taps share the result
+    entry = _intent_locks.setdefault(intent_key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            existing = await _load_intent(intent_key)
+            if _is_reusable(existing, amount_paise, shop_rzp.key_id):
+                return existing, False
+
+            expires_at = datetime.now(timezone.utc) + timedelta(minutes=PAYMENT_INTENT_TTL_MINUTES)
+            gateway_obj = await create_fn(expires_at)
+            intent = {
+                "gateway_id": gateway_obj['id'],
+                "amount_paise": amount_paise,
+                "short_url": gateway_obj.get('short_url'),
+                "expires_at": expires_at,
+                "key_id": shop_rzp.key_id,
+            }
+            await _save_intent(intent_key, kind, shop_rzp.shop_id, order_id, intent)
+            logger.info(f"💳 New {kind} intent {intent['gateway_id']} for {intent_key}")
+            return intent, True
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _intent_locks.pop(intent_key, None)
+
+
+# ==============================================================================
+# PUBLIC API
+# ==============================================================================
+async def get_or_create_order_intent(shop_rzp, order_id, amount_paise, notes):
+    """Razorpay Order for the web checkout. Returns (intent, created)."""
+    async def _create(expires_at):
+        return await create_order(shop_rzp.key_id, shop_rzp.key_secret, {
+            "amount": amount_paise,
+            "currency": "INR",
+            "receipt": f"order_{order_id}",
+            "notes": notes
+        })
+
+    return await _get_or_create(order_intent_key(order_id), "order", shop_rzp, int(order_id), amount_paise, _create)
+
+
+async def get_or_create_link_intent(shop_rzp, intent_key, amount_paise, link_data, order_id=None):
+    """Razorpay Payment Link for the WhatsApp flow. Returns (intent, created)."""
+    async def _create(expires_at):
+        return await create_payment_link(shop_rzp.key_id, shop_rzp.key_secret, {
+            **link_data,
+            "amount": amount_paise,
+            "expire_by": int(expires_at.timestamp())
+        })
+
+    return await _get_or_create(intent_key, "link", shop_rzp, order_id, amount_paise, _create)
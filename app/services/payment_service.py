@@ -1,9 +1,15 @@
+# ⚠️ Not wired in: nothing imports this module and it doesn't import (send_order_confirmation no longer
+# exists in order_service). The live "pay_online" path is webhook.py -> order_service.finalize_order,
+# which sends the buyer to /pay/online; that page gets its Razorpay order from
+# routers/payment.py:create_customer_order (cached credentials, pooled gateway, reused payment intent).
 
 import os
 from app.core.database import db
 from app.utils.whatsapp import send_whatsapp_message
 from app.utils.state_manager import state_manager
 from app.services.order_service import save_order_to_db, send_order_confirmation
+from app.services.razorpay_service import get_shop_razorpay
+from app.services.payment_intent_service import get_or_create_link_intent, cart_intent_key
 
 async def handle_payment_selection(phone, selection_id, current_data):
     print(f"💰 Handling Payment Selection: {selection_id} for {phone}")
@@ -45,13 +51,10 @@ async def handle_payment_selection(phone, selection_id, current_data):
         )
 
         # 2. EXECUTE RAZORPAY FLOW
-        if can_use_razorpay:
+        shop_rzp = await get_shop_razorpay(shop_id) if can_use_razorpay else None
+        if shop_rzp:
             try:
-                import razorpay
-                client = razorpay.Client(auth=(shop['razorpay_key_id'], shop['razorpay_key_secret']))
-                
                 link_data = {
-                    "amount": int(total_amount * 100), 
                     "currency": "INR",
                     "description": f"Order from {shop['name']}",
                     "customer": {"contact": phone, "name": "Valued Customer"},
@@ -60,10 +63,17 @@ async def handle_payment_selection(phone, selection_id, current_data):
                     "callback_method": "get"
                 }
                 
-                payment_link = client.payment_link.create(link_data)
+                # ♻️ Repeat taps reuse the same link until it expires or the cart total changes
+                payment_link, _ = await get_or_create_link_intent(
+                    shop_rzp,
+                    cart_intent_key(shop_id, phone),
+                    int(total_amount * 100),
+                    link_data,
+                    order_id=current_data.get("order_id")
+                )
                 short_url = payment_link['short_url']
                 
-                await state_manager.set_state(phone, {"payment_link_id": payment_link['id']})
+                await state_manager.update_state(phone, {"payment_link_id": payment_link['gateway_id']})
 
                 msg = (
                     f"💳 *Secure Payment Link*\n"
@@ -0,0 +1,92 @@
+import logging
+import os
+
+from app.core.database import db
+from app.utils.cache import TTLCache, MISSING
+from app.utils.crypto import decrypt_data
+from app.utils.whatsapp import send_whatsapp_message
+
+logger = logging.getLogger("drop_bot")
+
+RAZORPAY_CREDENTIALS_TTL_SECONDS = float(os.getenv("RAZORPAY_CREDENTIALS_TTL_SECONDS", "300"))
+# Shop key changes, from the shops trigger (migrations/017); payload = shop id
+RAZORPAY_KEYS_CHANGED_CHANNEL = "razorpay_keys_changed"
+
+
+class ShopRazorpay:
+    """Decrypted Razorpay credentials for ONE shop. Lives only in RAM."""
+
+    __slots__ = ("shop_id", "key_id", "key_secret")
+
+    def __init__(self, shop_id, key_id, key_secret):
+        self.shop_id = shop_id
+        self.key_id = key_id
+        self.key_secret = key_secret
+
+    def __repr__(self):
+        # 🔐 Never let the secret leak into logs or tracebacks
+        return f"<ShopRazorpay shop={self.shop_id} key_id={self.key_id} secret=***>"
+
+
+# shop_id -> ShopRazorpay, or None when the shop has no keys configured
+_shop_razorpay_cache = TTLCache(ttl_seconds=RAZORPAY_CREDENTIALS_TTL_SECONDS, maxsize=2000)
+
+
+async def get_shop_razorpay(shop_id: int, conn=None):
+    """
+    Returns the cached ShopRazorpay for a shop (or None if Razorpay isn't configured).
+    Fernet decryption only happens on a cache miss. Gateway calls go through
+    app.utils.razorpay_gateway, which shares one pooled HTTP client across shops.
+    """
+    shop_id = int(shop_id)
+    cached = _shop_razorpay_cache.get(shop_id)
+    if cached is not MISSING:
+        return cached
+
+    query = "SELECT razorpay_key_id, razorpay_key_secret FROM shops WHERE id = $1"
+    if conn is not None:
+        row = await conn.fetchrow(query, shop_id)
+    else:
+        async with db.pool.acquire() as c:
+            row = await c.fetchrow(query, shop_id)
+
+    creds = None
+    if row and row['razorpay_key_id'] and row['razorpay_key_secret']:
+        # 🔓 DECRYPT IN MEMORY (Safe)
+        creds = ShopRazorpay(shop_id, decrypt_data(row['razorpay_key_id']), decrypt_data(row['razorpay_key_secret']))
+
+    _shop_razorpay_cache.set(shop_id, creds)
+    return creds
+
+
+def invalidate_shop_razorpay(shop_id: int):
+    """
+    Call after a shop's Razorpay keys change. Clears this worker right away; the others
+    hear it from the shops trigger (on_razorpay_keys_changed).
+    """
+    _shop_razorpay_cache.invalidate(int(shop_id))
+    logger.info(f"🔑 Razorpay credential cache cleared for Shop {shop_id}")
+
+
+def on_razorpay_keys_changed(payload):
+    """LISTEN callback. payload = shop id; None after a (re)connect: drop everything."""
+    if payload is None:
+        _shop_razorpay_cache.clear()
+    elif payload.isdigit():
+        _shop_razorpay_cache.invalidate(int(payload))
+
+
+async def notify_payment_captured(db_order_id, customer_phone, item_name):
+    """The Single Notification System for captured payments. Never call while holding a connection."""
+    status = 'sent'
+    try:
+        purchased_item = item_name or "your item"
+        msg = f"🎉 *Payment Successful!*\n\nYour order for *{purchased_item}* (Order #{db_order_id}) has been verified and is now processing. 📦"
+        await send_whatsapp_message(customer_phone, msg)
+    except Exception as wa_error:
+        logger.error(f"WhatsApp Failed for Order {db_order_id}: {wa_error}")
+        # ⚠️ THE FAILSAFE: Mark as Failed so the Dashboard knows!
+        status = 'failed'
+
+    async with db.pool.acquire() as conn:
+        await conn.execute("UPDATE orders SET notification_status = $1 WHERE id = $2", status, db_order_id)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from app.core.database import db
+from app.services.razorpay_service import get_shop_razorpay, notify_payment_captured
+from app.services.reservation_service import commit_order_stock
+from app.utils.razorpay_gateway import list_payments
+
+logger = logging.getLogger("drop_bot")
+
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "600"))
+RECONCILE_SHOP_CONCURRENCY = int(os.getenv("RECONCILE_SHOP_CONCURRENCY", "4"))
+# First run for a shop looks back this far; later runs start at the stored cursor
+RECONCILE_INITIAL_LOOKBACK = timedelta(hours=int(os.getenv("RECONCILE_INITIAL_LOOKBACK_HOURS", "24")))
+# Razorpay can index a payment a little after capture, so windows overlap slightly
+RECONCILE_OVERLAP = timedelta(minutes=5)
+RAZORPAY_PAGE_SIZE = 100
+
+
+async def _razorpay_shops():
+    async with db.pool.acquire() as conn:
+        return await conn.fetch("""
+            SELECT s.id, c.last_synced_at
+            FROM shops s
+            LEFT JOIN payment_reconciliation_cursors c ON c.shop_id = s.id
+            WHERE s.active_payment_method = 'razorpay'
+              AND s.razorpay_key_id IS NOT NULL
+              AND s.razorpay_key_secret IS NOT NULL
+        """)
+
+
+async def _fetch_captured_payments(shop_rzp, window_start, window_end):
+    """Pages through the shop's Razorpay payments for the window, keeping captured customer orders."""
+    captured = []
+    skip = 0
+    while True:
+        page = await list_payments(
+            shop_rzp.key_id, shop_rzp.key_secret,
+            window_start.timestamp(), window_end.timestamp(),
+            count=RAZORPAY_PAGE_SIZE, skip=skip
+        )
+        items = page.get("items", [])
+        captured.extend(p for p in items if p.get("status") == "captured")
+        if len(items) < RAZORPAY_PAGE_SIZE:
+            return captured
+        skip += RAZORPAY_PAGE_SIZE
+
+
+def match_payments(pending_orders, payments):
+    """
+    Pure in-memory matching. A payment settles an order when it points at it (notes.order_id,
+    or the Razorpay order id we stored as its payment intent) AND the amount agrees.
+    Returns [(order_id, payment_id), ...].
+    """
+    by_id = {o['id']: o for o in pending_orders}
+    by_gateway_order = {o['gateway_id']: o for o in pending_orders if o['gateway_id']}
+
+    matches = {}
+    for payment in payments:
+        notes = payment.get("notes") or {}
+        order = None
+        if notes.get("type") == "customer_order" and str(notes.get("order_id", "")).isdigit():
+            order = by_id.get(int(notes["order_id"]))
+        if order is None and payment.get("order_id"):
+            order = by_gateway_order.get(payment["order_id"])
+        if order is None or order['id'] in matches:
+            continue
+        if int(round(float(order['total_amount']) * 100)) != int(payment.get("amount", -1)):
+            logger.warning(f"⚠️ Reconcile: amount mismatch for Order #{order['id']} (payment {payment.get('id')})")
+            continue
+        matches[order['id']] = payment["id"]
+    return list(matches.items())
+
+
+async def reconcile_shop(shop_id, last_synced_at=None):
+    """Reconciles ONE shop: fetch window from Razorpay, one query for pending orders, one batched update."""
+    shop_rzp = await get_shop_razorpay(shop_id)
+    if not shop_rzp:
+        return 0
+
+    window_end = datetime.now(timezone.utc)
+    window_start = (last_synced_at or window_end - RECONCILE_INITIAL_LOOKBACK) - RECONCILE_OVERLAP
+
+    payments = await _fetch_captured_payments(shop_rzp, window_start, window_end)
+
+    settled = []
+    async with db.pool.acquire() as conn:
+        if payments:
+            pending = await conn.fetch("""
+                SELECT o.id, o.total_amount, pi.gateway_id
+                FROM orders o
+                LEFT JOIN payment_intents pi ON pi.order_id = o.id AND pi.kind = 'order'
+                WHERE o.shop_id = $1
+                  AND o.payment_status IS DISTINCT FROM 'paid'
+                  AND o.created_at >= $2
+            """, shop_id, window_start - RECONCILE_INITIAL_LOOKBACK)
+
+            matches = match_payments(pending, payments)
+            if matches:
+                # Paid flag and stock sale commit together: a failed sale leaves the orders
+                # unpaid, so the next pass (or the webhook redelivery) settles them again
+                async with conn.transaction():
+                    settled = await conn.fetch("""
+                        UPDATE orders o
+                        SET payment_status = 'paid', status = 'processing', transaction_id = m.payment_id
+                        FROM unnest($1::bigint[], $2::text[]) AS m(order_id, payment_id)
+                        WHERE o.id = m.order_id AND o.payment_status IS DISTINCT FROM 'paid'
+                        RETURNING o.id, o.customer_phone, o.item_name
+                    """, [m[0] for m in matches], [m[1] for m in matches])
+                    if settled:
+                        await commit_order_stock(conn, [r['id'] for r in settled])
+
+        # Advance the cursor only after the window was fully applied
+        await conn.execute("""
+            INSERT INTO payment_reconciliation_cursors (shop_id, last_synced_at, updated_at)
+            VALUES ($1, $2, NOW())
+            ON CONFLICT (shop_id) DO UPDATE SET last_synced_at = EXCLUDED.last_synced_at, updated_at = NOW()
+        """, shop_id, window_end)
+
+    for row in settled:
+        logger.info(f"🧾 Reconciled Order #{row['id']} as PAID (missed webhook)")
+        await notify_payment_captured(row['id'], row['customer_phone'], row['item_name'])
+
+    return len(settled)
+
+
+async def run_reconciliation():
+    shops = await _razorpay_shops()
+    limit = asyncio.Semaphore(RECONCILE_SHOP_CONCURRENCY)
+
+    async def _one(shop):
+        async with limit:
+            try:
+                return await reconcile_shop(shop['id'], shop['last_synced_at'])
+            except Exception as e:
+                logger.error(f"🔥 Reconcile failed for Shop {shop['id']}: {e}")
+                return 0
+
+    settled = await asyncio.gather(*(_one(s) for s in shops))
+    logger.info(f"🧾 Reconciliation pass: shops={len(shops)} settled={sum(settled)}")
+    return sum(settled)
+
+
+async def payment_reconciliation_loop():
+    print("🧾 Payment Reconciliation Started...")
+    while True:
+        try:
+            await run_reconciliation()
+        except Exception as e:
+            print(f"🔥 Reconciliation Error: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+
+from app.core.database import db
+from app.services.storefront_cache import STOREFRONT_INVALIDATE_CHANNEL
+
+logger = logging.getLogger("drop_bot")
+
+RELATED_ITEMS_INTERVAL_SECONDS = int(os.getenv("RELATED_ITEMS_INTERVAL_SECONDS", "300"))
+# Orders folded in per pass; a full batch means there is more backlog and the next pass starts at once
+RELATED_ORDERS_BATCH = int(os.getenv("RELATED_ORDERS_BATCH", "2000"))
+# Orders younger than this aren't folded yet: an id is taken when the INSERT starts, so a lower id can
+# commit after a higher one. Must exceed the longest order-inserting transaction.
+RELATED_ORDERS_LAG_SECONDS = int(os.getenv("RELATED_ORDERS_LAG_SECONDS", "300"))
+# Neighbours are re-ranked at least this often, so stock and category changes get picked up
+RELATED_ITEMS_MAX_AGE_MINUTES = int(os.getenv("RELATED_ITEMS_MAX_AGE_MINUTES", "60"))
+RELATED_ITEMS_SWEEP_BATCH = int(os.getenv("RELATED_ITEMS_SWEEP_BATCH", "1000"))
+RELATED_ITEMS_PER_ITEM = 12
+REBUILD_CHUNK = 500
+
+# Score = 10 per customer who bought both + 3 if same category + 2 if in stock.
+# Candidates: top co-purchases, newest in the category, and the shop's first listed items as a fallback.
+# (migrations/010)
+
+# $1 = last folded order id, $2 = batch size, $3 = lag seconds. Items come from order_items (migrations/013).
+# The batch stops below the first order still inside the lag, so the cursor never passes an id
+# whose transaction may not have committed yet.
+# Inside one statement `customer_item_purchases` reads as it was BEFORE the insert in `new`,
+# so pairs are new x old (both directions) + new x new.
+FOLD_ORDERS_SQL = """
+    WITH batch AS (
+        SELECT id, shop_id, customer_phone, status
+        FROM orders
+        WHERE id > $1
+          AND id < (SELECT COALESCE(min(id), 9223372036854775807) FROM orders
+                    WHERE id > $1 AND created_at > NOW() - make_interval(secs => $3::int))
+        ORDER BY id
+        LIMIT $2
+    ),
+    lines AS (
+        SELECT DISTINCT b.id AS order_id, b.shop_id, b.customer_phone, oi.item_id
+        FROM batch b
+        JOIN order_items oi ON oi.order_id = b.id
+        JOIN items i ON i.id = oi.item_id AND i.shop_id = b.shop_id
+        WHERE b.customer_phone IS NOT NULL AND b.status IS DISTINCT FROM 'cancelled'
+    ),
+    new AS (
+        INSERT INTO customer_item_purchases (customer_phone, item_id, shop_id, first_order_id)
+        SELECT DISTINCT ON (customer_phone, item_id) customer_phone, item_id, shop_id, order_id
+        FROM lines
+        ORDER BY customer_phone, item_id, order_id
+        ON CONFLICT DO NOTHING
+        RETURNING customer_phone, item_id, shop_id
+    ),
+    pairs AS (
+        SELECT n.item_id AS a, o.item_id AS b
+        FROM new n JOIN customer_item_purchases o ON o.customer_phone = n.customer_phone AND o.shop_id = n.shop_id
+        UNION ALL
+        SELECT o.item_id, n.item_id
+        FROM new n JOIN customer_item_purchases o ON o.customer_phone = n.customer_phone AND o.shop_id = n.shop_id
+        UNION ALL
+        SELECT n1.item_id, n2.item_id
+        FROM new n1 JOIN new n2
+          ON n2.customer_phone = n1.customer_phone AND n2.shop_id = n1.shop_id AND n2.item_id <> n1.item_id
+    ),
+    bumped AS (
+        INSERT INTO item_copurchases AS c (item_id, other_id, buyers)
+        SELECT a, b, COUNT(*) FROM pairs GROUP BY a, b
+        ON CONFLICT (item_id, other_id) DO UPDATE SET buyers = c.buyers + EXCLUDED.buyers
+        RETURNING item_id
+    )
+    SELECT
+        (SELECT max(id) FROM batch) AS last_order_id,
+        (SELECT count(*) FROM batch) AS orders,
+        ARRAY(SELECT item_id FROM bumped UNION SELECT item_id FROM new) AS touched
+"""
+
+# Items never ranked (new) first, then the stalest. $1 = max age (minutes), $2 = how many
+STALE_ITEMS_SQL = """
+    (SELECT i.id FROM items i
+     WHERE NOT EXISTS (SELECT 1 FROM related_items_built b WHERE b.item_id = i.id)
+     LIMIT $2)
+    UNION ALL
+    (SELECT item_id FROM related_items_built
+     WHERE built_at < NOW() - make_interval(mins => $1)
+     ORDER BY built_at
+     LIMIT $2)
+"""
+
+# $1 = item ids, $2 = neighbours per item
+REBUILD_RELATED_SQL = """
+    INSERT INTO related_items (item_id, rank, related_id, score)
+    SELECT item_id, rank, related_id, score
+    FROM (
+        SELECT t.id AS item_id, c.related_id, c.score,
+               row_number() OVER (PARTITION BY t.id ORDER BY c.score DESC, c.related_id DESC) AS rank
+        FROM items t
+        CROSS JOIN LATERAL (
+            SELECT cand.id AS related_id,
+                   10 * SUM(cand.buyers)
+                   + CASE WHEN ri.category IS NOT DISTINCT FROM t.category THEN 3 ELSE 0 END
+                   + CASE WHEN COALESCE(ri.stock_count, 0) > 0 THEN 2 ELSE 0 END AS score
+            FROM (
+                (SELECT cp.other_id AS id, cp.buyers
+                 FROM item_copurchases cp WHERE cp.item_id = t.id
+                 ORDER BY cp.buyers DESC LIMIT 50)
+                UNION ALL
+                (SELECT i.id, 0 FROM items i
+                 WHERE i.shop_id = t.shop_id AND i.category = t.category AND i.id <> t.id
+                 ORDER BY i.id DESC LIMIT 50)
+                UNION ALL
+                (SELECT i.id, 0 FROM items i
+                 WHERE i.shop_id = t.shop_id AND i.id <> t.id
+                 ORDER BY COALESCE(i.category, ''), COALESCE(i.name, ''), i.id LIMIT 20)
+            ) cand
+            JOIN items ri ON ri.id = cand.id AND ri.shop_id = t.shop_id
+            GROUP BY cand.id, ri.category, ri.stock_count
+        ) c
+        WHERE t.id = ANY($1::bigint[])
+    ) ranked
+    WHERE rank <= $2
+"""
+
+
+async def rebuild_related(conn, item_ids):
+    """
+    Re-ranks the neighbours of `item_ids` (caller's transaction). Product pages embed these, so
+    their shops' cached storefronts are invalidated; the NOTIFY goes out when the caller commits.
+    """
+    for start in range(0, len(item_ids), REBUILD_CHUNK):
+        chunk = item_ids[start:start + REBUILD_CHUNK]
+        await conn.execute("DELETE FROM related_items WHERE item_id = ANY($1::bigint[])", chunk)
+        await conn.execute(REBUILD_RELATED_SQL, chunk, RELATED_ITEMS_PER_ITEM)
+        await conn.execute("""
+            INSERT INTO related_items_built (item_id, built_at)
+            SELECT i.id, NOW() FROM items i WHERE i.id = ANY($1::bigint[])
+            ON CONFLICT (item_id) DO UPDATE SET built_at = EXCLUDED.built_at
+        """, chunk)
+        await conn.execute("""
+            SELECT pg_notify($2, s.shop_id::text)
+            FROM (SELECT DISTINCT shop_id FROM items WHERE id = ANY($1::bigint[]) AND shop_id IS NOT NULL) s
+        """, chunk, STOREFRONT_INVALIDATE_CHANNEL)
+
+
+async def run_related_items_pass():
+    """
+    Folds the next batch of orders into the co-purchase counts, then re-ranks every item whose
+    counts moved plus a batch of new / stale items. One transaction; the cursor row lock keeps
+    workers from running passes side by side (the others skip).
+    Returns the number of orders folded in.
+    """
+    async with db.pool.acquire() as conn:
+        async with conn.transaction():
+            last_order_id = await conn.fetchval(
+                "SELECT last_order_id FROM related_items_cursor FOR UPDATE SKIP LOCKED"
+            )
+            if last_order_id is None:
+                return 0  # another worker is on it
+
+            folded = await conn.fetchrow(FOLD_ORDERS_SQL, last_order_id, RELATED_ORDERS_BATCH, RELATED_ORDERS_LAG_SECONDS)
+            if folded['last_order_id'] is not None:
+                await conn.execute(
+                    "UPDATE related_items_cursor SET last_order_id = $1, updated_at = NOW()",
+                    folded['last_order_id']
+                )
+
+            stale = await conn.fetch(STALE_ITEMS_SQL, RELATED_ITEMS_MAX_AGE_MINUTES, RELATED_ITEMS_SWEEP_BATCH)
+            item_ids = sorted(set(folded['touched']) | {r['id'] for r in stale})
+            await rebuild_related(conn, item_ids)
+
+    logger.info(f"🧩 Related items pass: orders={folded['orders']} reranked={len(item_ids)}")
+    return folded['orders']
+
+
+async def related_items_loop():
+    print("🧩 Related Items Engine Started...")
+    while True:
+        try:
+            orders = await run_related_items_pass()
+            if orders >= RELATED_ORDERS_BATCH:
+                continue  # backlog: keep folding
+        except Exception as e:
+            print(f"🔥 Related Items Error: {e}")
+        await asyncio.sleep(RELATED_ITEMS_INTERVAL_SECONDS)
+
+
+def related_items_json_sql(item_param, limit_param):
+    """
+    JSON array of an item's best in-stock neighbours (id, name, price, image_url, slug), or NULL.
+    An expression, so other statements can embed it (e.g. order finalisation).
+    """
+    return f"""(
+        SELECT json_agg(json_build_object(
+            'id', x.id, 'name', x.name, 'price', x.price, 'image_url', x.image_url, 'slug', x.slug
+        ) ORDER BY x.rank)
+        FROM (
+            SELECT i.id, i.name, i.price, i.image_url, i.slug, r.rank
+            FROM related_items r
+            JOIN items i ON i.id = r.related_id
+            WHERE r.item_id = {item_param} AND COALESCE(i.stock_count, 0) > 0
+            ORDER BY r.rank
+            LIMIT {limit_param}
+        ) x
+    )"""
+
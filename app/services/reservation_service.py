@@ -0,0 +1,397 @@
+import asyncio
+import logging
+import os
+import time
+
+from app.core.database import db
+from app.utils.metrics import Counter, Histogram
+
+logger = logging.getLogger("drop_bot")
+
+# From the WhatsApp handoff until the buyer picks a payment method
+RESERVATION_HOLD_SECONDS = int(os.getenv("RESERVATION_HOLD_SECONDS", "900"))
+# Online orders: how long the stock waits for the payment (orders awaiting seller approval are never swept)
+RESERVATION_PAYMENT_SECONDS = int(os.getenv("RESERVATION_PAYMENT_SECONDS", "1800"))
+RESERVATION_SWEEP_SECONDS = int(os.getenv("RESERVATION_SWEEP_SECONDS", "30"))
+RESERVATION_SWEEP_BATCH = int(os.getenv("RESERVATION_SWEEP_BATCH", "500"))
+
+stock_reservations = Counter(
+    "stock_reservations_total",
+    "Stock reservation lines by result (held, sold_out, sold, released, expired)",
+    labelnames=("result",),
+)
+# Conditional UPDATEs queue on the item row lock, so a hot item shows up here first
+stock_hold_seconds = Histogram(
+    "stock_hold_seconds",
+    "Time to place a buyer's holds (transaction incl. row lock waits) by result",
+    labelnames=("result",),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+class StockUnavailable(Exception):
+    """Not enough stock left for a line. Nothing was held."""
+
+    def __init__(self, item_id, variant_key, available):
+        super().__init__(f"Item {item_id} ({variant_key or 'no variant'}): only {available} left")
+        self.item_id = item_id
+        self.variant_key = variant_key
+        self.available = available
+
+
+# $1 = phone, $2 = item ids, $3 = quantities (one entry per item), $4 = hold seconds.
+# Each row is taken only if its stock covers it; the row lock serialises concurrent buyers and
+# the WHERE is re-checked against the latest stock, so the last units can't be handed out twice.
+HOLD_STOCK_SQL = """
+    WITH taken AS (
+        UPDATE items i
+        SET stock_count = i.stock_count - w.qty
+        FROM unnest($2::bigint[], $3::int[]) AS w(item_id, qty)
+        WHERE i.id = w.item_id AND COALESCE(i.stock_count, 0) >= w.qty
+        RETURNING i.id, w.qty
+    ),
+    held AS (
+        INSERT INTO stock_reservations (phone, item_id, variant_key, qty, expires_at)
+        SELECT $1, id, '', qty, NOW() + make_interval(secs => $4::int) FROM taken
+        RETURNING item_id
+    )
+    SELECT COALESCE(array_agg(item_id), '{}') FROM held
+"""
+
+# $1 = phone, $2 = item id, $3 = variant title, $4 = qty, $5 = hold seconds.
+# The variant's position is looked up first; the stock check itself reads the locked row.
+HOLD_VARIANT_STOCK_SQL = """
+    WITH pos AS (
+        SELECT (e.ord - 1)::text AS idx
+        FROM items x
+        CROSS JOIN jsonb_array_elements(
+            CASE WHEN jsonb_typeof(x.attributes -> 'variants') = 'array' THEN x.attributes -> 'variants' ELSE '[]' END
+        ) WITH ORDINALITY AS e(v, ord)
+        WHERE x.id = $2::bigint AND e.v ->> 'title' = $3::text
+        LIMIT 1
+    ),
+    taken AS (
+        UPDATE items i
+        SET attributes = jsonb_set(i.attributes, ARRAY['variants', p.idx, 'stock'], to_jsonb(
+            COALESCE((i.attributes #>> ARRAY['variants', p.idx, 'stock'])::numeric, 0)::int - $4::int))
+        FROM pos p
+        WHERE i.id = $2::bigint
+          AND i.attributes #>> ARRAY['variants', p.idx, 'title'] = $3::text
+          AND COALESCE((i.attributes #>> ARRAY['variants', p.idx, 'stock'])::numeric, 0) >= $4::int
+        RETURNING i.id
+    )
+    INSERT INTO stock_reservations (phone, item_id, variant_key, qty, expires_at)
+    SELECT $1, id, $3::text, $4::int, NOW() + make_interval(secs => $5::int) FROM taken
+    RETURNING id
+"""
+
+def _available_sql(item, variant_key):
+    """Stock on the shelf for `variant_key` ('' = the item itself) of the items row aliased `item`."""
+    return f"""CASE WHEN {variant_key} = '' THEN COALESCE({item}.stock_count, 0)
+                ELSE COALESCE((SELECT (v ->> 'stock')::numeric::int
+                               FROM jsonb_array_elements(
+                                   CASE WHEN jsonb_typeof({item}.attributes -> 'variants') = 'array'
+                                        THEN {item}.attributes -> 'variants' ELSE '[]' END) v
+                               WHERE v ->> 'title' = {variant_key} LIMIT 1), 0)
+           END"""
+
+
+AVAILABLE_STOCK_SQL = f"""
+    SELECT {_available_sql('items', '$2::text')}
+    FROM items WHERE id = $1
+"""
+
+# $1 = order id. The order's lines not covered by its held / sold stock (a cart hold that lapsed).
+ORDER_SHORTFALL_SQL = """
+    WITH covered AS (
+        SELECT item_id, variant_key, SUM(qty) AS qty
+        FROM stock_reservations
+        WHERE order_id = $1 AND status IN ('held', 'sold')
+        GROUP BY item_id, variant_key
+    ),
+    ordered AS (
+        SELECT item_id, variant_key, SUM(qty) AS qty
+        FROM order_items
+        WHERE order_id = $1 AND item_id IS NOT NULL
+        GROUP BY item_id, variant_key
+    )
+    SELECT o.item_id, o.variant_key, (o.qty - COALESCE(c.qty, 0))::int AS qty
+    FROM ordered o
+    LEFT JOIN covered c USING (item_id, variant_key)
+    WHERE o.qty > COALESCE(c.qty, 0)
+"""
+
+# $1 = order ids. Locks the items the orders' lines point at, so the stock read below is the latest.
+LOCK_ORDER_ITEMS_SQL = """
+    SELECT 1 FROM items
+    WHERE id IN (SELECT item_id FROM order_items WHERE order_id = ANY($1::bigint[]))
+    ORDER BY id
+    FOR NO KEY UPDATE
+"""
+
+
+def _stock_delta_sql(source):
+    """
+    CTEs ending in `touched` (the item ids updated): adds `qty` of every (item_id, variant_key, qty)
+    row in `source` back to stock (negative qty takes). One UPDATE per item, so the same item may
+    appear many times, with and without variants.
+    """
+    return f"""
+    delta_variant AS (
+        SELECT item_id, variant_key, SUM(qty)::int AS qty FROM {source} GROUP BY item_id, variant_key
+    ),
+    delta_item AS (
+        SELECT item_id,
+               COALESCE(SUM(qty) FILTER (WHERE variant_key = ''), 0)::int AS plain_qty,
+               jsonb_object_agg(variant_key, qty) FILTER (WHERE variant_key <> '') AS variant_qty
+        FROM delta_variant
+        GROUP BY item_id
+    ),
+    touched AS (
+        UPDATE items i
+        SET stock_count = COALESCE(i.stock_count, 0) + d.plain_qty,
+            attributes = CASE
+                WHEN d.variant_qty IS NULL OR jsonb_typeof(i.attributes -> 'variants') IS DISTINCT FROM 'array'
+                    THEN i.attributes
+                ELSE jsonb_set(i.attributes, '{{variants}}', (
+                    SELECT jsonb_agg(
+                        CASE WHEN d.variant_qty ? (v ->> 'title')
+                             THEN jsonb_set(v, '{{stock}}', to_jsonb(
+                                  COALESCE((v ->> 'stock')::numeric, 0)::int + (d.variant_qty ->> (v ->> 'title'))::int))
+                             ELSE v END
+                        ORDER BY e.ord)
+                    FROM jsonb_array_elements(i.attributes -> 'variants') WITH ORDINALITY AS e(v, ord)
+                ))
+            END
+        FROM delta_item d
+        WHERE i.id = d.item_id
+        RETURNING i.id
+    )"""
+
+
+# $1 = phone. The buyer's open cart (holds not attached to an order yet)
+RELEASE_CART_SQL = f"""
+    WITH released AS (
+        UPDATE stock_reservations
+        SET status = 'released', updated_at = NOW()
+        WHERE phone = $1 AND status = 'held' AND order_id IS NULL
+        RETURNING item_id, variant_key, qty
+    ),
+    {_stock_delta_sql('released')}
+    SELECT count(*) FROM released
+"""
+
+# $1 = order ids (payment rejected / order cancelled)
+RELEASE_ORDERS_SQL = f"""
+    WITH released AS (
+        UPDATE stock_reservations
+        SET status = 'released', updated_at = NOW()
+        WHERE order_id = ANY($1::bigint[]) AND status = 'held'
+        RETURNING item_id, variant_key, qty
+    ),
+    {_stock_delta_sql('released')}
+    SELECT count(*) FROM released
+"""
+
+# $1 = batch size. Orders waiting on the seller to approve a payment proof keep their stock.
+SWEEP_EXPIRED_SQL = f"""
+    WITH expired AS (
+        UPDATE stock_reservations r
+        SET status = 'released', updated_at = NOW()
+        WHERE r.id IN (
+            SELECT x.id FROM stock_reservations x
+            LEFT JOIN orders o ON o.id = x.order_id
+            WHERE x.status = 'held' AND x.expires_at < NOW()
+              AND o.payment_status IS DISTINCT FROM 'needs_approval'
+            ORDER BY x.expires_at
+            LIMIT $1
+            FOR UPDATE OF x SKIP LOCKED
+        )
+        RETURNING r.item_id, r.variant_key, r.qty
+    ),
+    {_stock_delta_sql('expired')}
+    SELECT (SELECT count(*) FROM expired) AS released, (SELECT count(*) FROM touched) AS items
+"""
+
+# $1 = order ids. Holds become sales; order lines without a live hold (expired, or never held)
+# are taken from stock now and recorded as sold too, so running it again changes nothing.
+# A paid sale can't be refused: what the shelf doesn't cover is not taken (stock never goes
+# below zero) and the order is flagged oversold (migrations/016). Needs LOCK_ORDER_ITEMS_SQL first.
+COMMIT_ORDERS_SQL = f"""
+    WITH converted AS (
+        UPDATE stock_reservations
+        SET status = 'sold', updated_at = NOW()
+        WHERE order_id = ANY($1::bigint[]) AND status = 'held'
+        RETURNING order_id, item_id, variant_key, qty
+    ),
+    covered AS (
+        SELECT order_id, item_id, variant_key, SUM(qty) AS qty
+        FROM (
+            SELECT order_id, item_id, variant_key, qty FROM converted
+            UNION ALL
+            SELECT order_id, item_id, variant_key, qty FROM stock_reservations
+            WHERE order_id = ANY($1::bigint[]) AND status = 'sold'
+        ) c
+        GROUP BY order_id, item_id, variant_key
+    ),
+    ordered AS (
+        SELECT order_id, item_id, variant_key, SUM(qty) AS qty
+        FROM order_items
+        WHERE order_id = ANY($1::bigint[]) AND item_id IS NOT NULL
+        GROUP BY order_id, item_id, variant_key
+    ),
+    missing AS (
+        SELECT o.order_id, o.item_id, o.variant_key, (o.qty - COALESCE(c.qty, 0))::int AS qty
+        FROM ordered o
+        LEFT JOIN covered c USING (order_id, item_id, variant_key)
+        WHERE o.qty > COALESCE(c.qty, 0)
+    ),
+    recorded AS (
+        INSERT INTO stock_reservations (phone, item_id, variant_key, qty, status, order_id, expires_at)
+        SELECT ord.customer_phone, m.item_id, m.variant_key, m.qty, 'sold', m.order_id, NOW()
+        FROM missing m
+        JOIN orders ord ON ord.id = m.order_id
+    ),
+    wanted AS (
+        SELECT m.item_id, m.variant_key, SUM(m.qty)::int AS qty,
+               GREATEST(MAX({_available_sql('i', 'm.variant_key')}), 0) AS available
+        FROM missing m
+        JOIN items i ON i.id = m.item_id
+        GROUP BY m.item_id, m.variant_key
+    ),
+    taken AS (
+        SELECT item_id, variant_key, -LEAST(qty, available) AS qty FROM wanted WHERE available > 0
+    ),
+    oversold AS (
+        UPDATE orders o SET oversold = TRUE
+        FROM missing m
+        JOIN wanted w USING (item_id, variant_key)
+        WHERE o.id = m.order_id AND w.qty > w.available
+        RETURNING o.id
+    ),
+    {_stock_delta_sql('taken')}
+    SELECT (SELECT count(*) FROM converted) AS converted, (SELECT count(*) FROM missing) AS taken,
+           ARRAY(SELECT DISTINCT id FROM oversold) AS oversold
+"""
+
+
+async def hold_stock(phone, lines):
+    """
+    Replaces the buyer's open holds with holds for `lines` (dicts of item_id, variant, qty).
+    All or nothing: raises StockUnavailable for the first line that can't be covered.
+    """
+    started = time.perf_counter()
+    try:
+        async with db.pool.acquire() as conn:
+            async with conn.transaction():
+                released = await conn.fetchval(RELEASE_CART_SQL, phone)
+                count = await _hold_lines(conn, phone, lines, RESERVATION_HOLD_SECONDS)
+    except StockUnavailable:
+        stock_hold_seconds.observe(time.perf_counter() - started, result="sold_out")
+        stock_reservations.inc(len(lines), result="sold_out")
+        raise
+
+    stock_hold_seconds.observe(time.perf_counter() - started, result="held")
+    stock_reservations.inc(count, result="held")
+    if released:
+        stock_reservations.inc(released, result="released")
+
+
+async def _hold_lines(conn, phone, lines, hold_seconds):
+    """Holds `lines` for `phone` (caller's transaction). Raises StockUnavailable; returns the holds placed."""
+    plain = {}
+    variants = []
+    for line in lines:
+        if line.get('variant'):
+            variants.append(line)
+        else:
+            plain[int(line['item_id'])] = plain.get(int(line['item_id']), 0) + int(line['qty'])
+
+    if plain:
+        held = set(await conn.fetchval(HOLD_STOCK_SQL, phone, list(plain), list(plain.values()), hold_seconds))
+        short = next((i for i in plain if i not in held), None)
+        if short is not None:
+            available = await conn.fetchval(AVAILABLE_STOCK_SQL, short, "")
+            raise StockUnavailable(short, "", available or 0)
+
+    for line in variants:
+        held = await conn.fetchval(
+            HOLD_VARIANT_STOCK_SQL, phone, int(line['item_id']), line['variant'], int(line['qty']), hold_seconds
+        )
+        if held is None:
+            available = await conn.fetchval(AVAILABLE_STOCK_SQL, int(line['item_id']), line['variant'])
+            raise StockUnavailable(int(line['item_id']), line['variant'], available or 0)
+    return len(plain) + len(variants)
+
+
+async def hold_order_shortfall(conn, phone, order_id, hold_seconds):
+    """
+    Holds the lines of a fresh order that its (lapsed) cart hold no longer covers, attached to the order.
+    Caller's transaction: StockUnavailable means the stock is gone, roll the order back.
+    """
+    lines = [
+        {"item_id": r['item_id'], "variant": r['variant_key'], "qty": r['qty']}
+        for r in await conn.fetch(ORDER_SHORTFALL_SQL, order_id)
+    ]
+    if not lines:
+        return 0
+    count = await _hold_lines(conn, phone, lines, hold_seconds)
+    await conn.execute(
+        "UPDATE stock_reservations SET order_id = $2 WHERE phone = $1 AND status = 'held' AND order_id IS NULL",
+        phone, order_id
+    )
+    stock_reservations.inc(count, result="held")
+    return count
+
+
+async def release_cart(phone):
+    """Returns the buyer's open (not yet ordered) holds to stock, e.g. when the cart is emptied."""
+    async with db.pool.acquire() as conn:
+        released = await conn.fetchval(RELEASE_CART_SQL, phone)
+    if released:
+        stock_reservations.inc(released, result="released")
+
+
+async def commit_order_stock(conn, order_ids):
+    """
+    Turns the orders' stock into sales (on payment; COD at confirmation). Idempotent.
+    Runs on the caller's connection; the order rows are locked so concurrent calls take turns.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT 1 FROM orders WHERE id = ANY($1::bigint[]) ORDER BY id FOR UPDATE", order_ids)
+        await conn.execute(LOCK_ORDER_ITEMS_SQL, order_ids)
+        row = await conn.fetchrow(COMMIT_ORDERS_SQL, order_ids)
+    if row['converted']:
+        stock_reservations.inc(row['converted'], result="sold")
+    if row['taken']:
+        logger.info(f"📦 Orders {order_ids}: {row['taken']} line(s) had no live hold, taken from stock at payment")
+    if row['oversold']:
+        logger.warning(f"⚠️ Orders {list(row['oversold'])} paid for more than the stock left: flagged oversold")
+
+
+async def release_order_stock(conn, order_ids):
+    """Returns the held stock of rejected / cancelled orders. Sold stock is kept."""
+    released = await conn.fetchval(RELEASE_ORDERS_SQL, order_ids)
+    if released:
+        stock_reservations.inc(released, result="released")
+
+
+async def sweep_expired_holds():
+    """Returns the next batch of expired holds to stock. Returns how many holds were released."""
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(SWEEP_EXPIRED_SQL, RESERVATION_SWEEP_BATCH)
+    if row['released']:
+        stock_reservations.inc(row['released'], result="expired")
+        logger.info(f"⏳ Released {row['released']} expired stock hold(s) on {row['items']} item(s)")
+    return row['released']
+
+
+async def reservation_sweeper_loop():
+    print("⏳ Stock Reservation Sweeper Started...")
+    while True:
+        try:
+            if await sweep_expired_holds() >= RESERVATION_SWEEP_BATCH:
+                continue  # backlog: keep sweeping
+        except Exception as e:
+            print(f"🔥 Reservation Sweeper Error: {e}")
+        await asyncio.sleep(RESERVATION_SWEEP_SECONDS)
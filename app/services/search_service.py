@@ -0,0 +1,297 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from app.core.database import db
+from app.services.order_service import handle_web_handoff
+from app.utils.metrics import Histogram
+from app.utils.state_manager import state_manager
+from app.utils.whatsapp import send_whatsapp_message
+
+logger = logging.getLogger("drop_bot")
+
+SEARCH_DEFAULT_LIMIT = 20
+TYPEAHEAD_DEFAULT_LIMIT = 8
+# How many shops keep a typeahead index in memory (LRU). Only shops people actually search.
+SEARCH_INDEX_MAX_SHOPS = int(os.getenv("SEARCH_INDEX_MAX_SHOPS", "200"))
+# Upper bound on candidates examined per term ("a" on a 20k-item shop)
+TYPEAHEAD_MAX_CANDIDATES = 2000
+
+ITEMS_CHANGED_CHANNEL = "items_changed"
+
+typeahead_latency = Histogram(
+    "search_typeahead_seconds",
+    "In-process typeahead lookup latency (index refresh included)",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _tokens(*texts):
+    """'Black Tee (Oversized)' -> {'black', 'tee', 'oversized'}"""
+    return {t for text in texts if text for t in _TOKEN_RE.findall(text.casefold())}
+
+
+# ==============================================================================
+# 1. POSTGRES SEARCH (pg_trgm, see migrations/007)
+# Name, category AND description, typo tolerant. Used by the search endpoint
+# and the WhatsApp bot.
+# ==============================================================================
+
+# Must match the idx_items_search_trgm expression exactly, or the index is not used
+_SEARCH_TEXT = "(COALESCE(i.name, '') || ' ' || COALESCE(i.category, '') || ' ' || COALESCE(i.description, ''))"
+
+SEARCH_ITEMS_SQL = f"""
+    SELECT i.id, i.name, i.price, i.image_url, i.category, i.slug, COALESCE(i.stock_count, 0) AS stock_count
+    FROM items i
+    WHERE i.shop_id = $1
+      AND ($2 <% {_SEARCH_TEXT} OR {_SEARCH_TEXT} ILIKE $3)
+    ORDER BY word_similarity($2, COALESCE(i.name, '')) DESC, word_similarity($2, {_SEARCH_TEXT}) DESC, i.name
+    LIMIT $4
+"""
+
+
+def _like_pattern(q):
+    return "%" + re.sub(r"([\\%_])", r"\\\1", q) + "%"
+
+
+async def search_items(shop_id, q, limit=SEARCH_DEFAULT_LIMIT):
+    """Best matches first. Returns a list of dicts (id, name, price, image_url, category, slug, stock_count)."""
+    q = q.strip()
+    if not q:
+        return []
+    async with db.pool.acquire() as conn:
+        rows = await conn.fetch(SEARCH_ITEMS_SQL, int(shop_id), q, _like_pattern(q), limit)
+    return [{**dict(r), "price": float(r['price'] or 0)} for r in rows]
+
+
+# ==============================================================================
+# 2. IN-PROCESS PREFIX INDEX (typeahead)
+# Sorted (token, item_id) list per hot shop: a prefix lookup is two bisects.
+# Kept fresh incrementally: the items trigger NOTIFYs the changed ids, and they
+# are re-read in ONE query the next time the shop is searched.
+# ==============================================================================
+
+class ShopPrefixIndex:
+    """Typeahead index for one shop. Tokens come from item name + category."""
+
+    def __init__(self, shop_id):
+        self.shop_id = shop_id
+        self.items = {}        # item_id -> public fields
+        self._item_tokens = {} # item_id -> set of tokens
+        self._folded = {}      # item_id -> casefolded name, for ranking
+        self._tokens = []      # sorted [(token, item_id)]
+        self.dirty = set()     # item ids changed since the last refresh
+        self.loaded = False
+
+    def load(self, rows):
+        """Full build: one sort instead of an insort per token."""
+        self.items, self._item_tokens, self._folded = {}, {}, {}
+        for row in rows:
+            self._store(row)
+        self._tokens = sorted((t, i) for i, tokens in self._item_tokens.items() for t in tokens)
+        self.loaded = True
+
+    def upsert(self, row):
+        self.remove(row['id'])
+        for token in self._store(row):
+            insort(self._tokens, (token, row['id']))
+
+    def _store(self, row):
+        item_id = row['id']
+        tokens = _tokens(row['name'], row['category'])
+        self.items[item_id] = {
+            "id": item_id,
+            "name": row['name'],
+            "price": float(row['price'] or 0),
+            "image_url": row['image_url'],
+            "category": row['category'],
+            "slug": row['slug'],
+        }
+        self._item_tokens[item_id] = tokens
+        self._folded[item_id] = (row['name'] or "").casefold()
+        return tokens
+
+    def remove(self, item_id):
+        for token in self._item_tokens.pop(item_id, ()):
+            idx = bisect_left(self._tokens, (token, item_id))
+            if idx < len(self._tokens) and self._tokens[idx] == (token, item_id):
+                del self._tokens[idx]
+        self.items.pop(item_id, None)
+        self._folded.pop(item_id, None)
+
+    def _ids_with_prefix(self, prefix):
+        ids = set()
+        idx = bisect_left(self._tokens, (prefix,))
+        while idx < len(self._tokens) and len(ids) < TYPEAHEAD_MAX_CANDIDATES:
+            token, item_id = self._tokens[idx]
+            if not token.startswith(prefix):
+                break
+            ids.add(item_id)
+            idx += 1
+        return ids
+
+    def search(self, q, limit=TYPEAHEAD_DEFAULT_LIMIT):
+        """Every typed word must prefix-match a word of the item ("bl te" -> "Black Tee")."""
+        terms = _TOKEN_RE.findall(q.casefold())
+        if not terms:
+            return []
+        matches = None
+        for term in sorted(set(terms), key=len, reverse=True):  # longest = most selective first
+            ids = self._ids_with_prefix(term)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+
+        # Names starting with the query first, then shortest, then alphabetical
+        q_folded = q.strip().casefold()
+        folded = self._folded
+        best = heapq.nsmallest(
+            limit, matches, key=lambda i: (not folded[i].startswith(q_folded), len(folded[i]), folded[i])
+        )
+        return [self.items[i] for i in best]
+
+
+class PrefixIndexRegistry:
+    """LRU of ShopPrefixIndex. Loading a shop is coalesced: one query no matter how many keystrokes."""
+
+    def __init__(self, max_shops):
+        self.max_shops = max_shops
+        self._indexes = OrderedDict()  # shop_id -> ShopPrefixIndex
+        self._locks = {}               # shop_id -> asyncio.Lock
+
+    async def get(self, shop_id):
+        index = self._indexes.get(shop_id)
+        if index is not None and index.loaded and not index.dirty:
+            self._indexes.move_to_end(shop_id)
+            return index
+
+        lock = self._locks.setdefault(shop_id, asyncio.Lock())
+        async with lock:
+            index = self._indexes.get(shop_id)
+            if index is None or not index.loaded:
+                index = await self._load(shop_id)
+            elif index.dirty:
+                await self._refresh(index)
+        return index
+
+    async def _load(self, shop_id):
+        index = ShopPrefixIndex(shop_id)
+        self._indexes[shop_id] = index  # visible before the query so NOTIFYs during the load mark it dirty
+        async with db.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, name, price, image_url, category, slug FROM items WHERE shop_id = $1", shop_id
+            )
+        # ~150ms for a 20k-item shop: keep it off the event loop
+        await asyncio.to_thread(index.load, rows)
+        self._indexes.move_to_end(shop_id)
+        while len(self._indexes) > self.max_shops:
+            self._indexes.popitem(last=False)
+        logger.info(f"🔎 Typeahead index built for Shop {shop_id}: {len(rows)} items")
+        return index
+
+    async def _refresh(self, index):
+        ids, index.dirty = list(index.dirty), set()
+        async with db.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, name, price, image_url, category, slug FROM items
+                WHERE shop_id = $1 AND id = ANY($2::bigint[])
+            """, index.shop_id, ids)
+        found = set()
+        for row in rows:
+            index.upsert(row)
+            found.add(row['id'])
+        for item_id in ids:
+            if item_id not in found:
+                index.remove(item_id)  # deleted, or moved to another shop
+
+    def drop(self, shop_id):
+        self._indexes.pop(shop_id, None)
+
+    def on_notify(self, payload):
+        """
+        LISTEN callback for 'items_changed'. payload = 'shop_id:id,id,...' or 'shop_id:*' (too many
+        to list -> rebuild). None after a (re)connect: we may have missed changes, drop everything.
+        """
+        if payload is None:
+            self._indexes.clear()
+            return
+        shop_part, _, ids_part = payload.partition(":")
+        if not shop_part.isdigit():
+            return
+        index = self._indexes.get(int(shop_part))
+        if index is None:
+            return
+        if ids_part == "*" or not ids_part:
+            self.drop(index.shop_id)
+        else:
+            index.dirty.update(int(i) for i in ids_part.split(",") if i.isdigit())
+
+
+prefix_indexes = PrefixIndexRegistry(SEARCH_INDEX_MAX_SHOPS)
+
+
+async def typeahead(shop_id, q, limit=TYPEAHEAD_DEFAULT_LIMIT):
+    started = time.perf_counter()
+    try:
+        index = await prefix_indexes.get(int(shop_id))
+        return index.search(q, limit)
+    finally:
+        typeahead_latency.observe(time.perf_counter() - started)
+
+
+# ==============================================================================
+# 3. WHATSAPP: customer types a product name while chatting with a shop
+# ==============================================================================
+WHATSAPP_SEARCH_RESULTS = 5
+# Search is opt-in: "search red tee" / "find red tee". Plain replies ("5", "thanks") go to whatever
+# the bot asked last, never to the catalog.
+WHATSAPP_SEARCH_PATTERN = re.compile(r"^(?:search|find|🔎)\s*:?\s+(.+)$", re.IGNORECASE | re.DOTALL)
+# Prompts whose replies must not turn into a search, even with the prefix
+SEARCH_BLOCKED_STATES = {
+    "awaiting_screenshot", "payment_processing", "awaiting_qty", "awaiting_address",
+    "awaiting_upsell_decision", "awaiting_review_rating",
+}
+
+
+def whatsapp_search_query(text, state):
+    """The product name to search for, or None when the message isn't a search."""
+    if state in SEARCH_BLOCKED_STATES:
+        return None
+    match = WHATSAPP_SEARCH_PATTERN.match(text)
+    if match:
+        return match.group(1).strip()
+    # Looking at results: a new name (not a pick number) refines the search
+    if state == "awaiting_search_pick" and not text.isdigit():
+        return text
+    return None
+
+
+async def handle_catalog_search(phone, shop_id, text):
+    results = await search_items(shop_id, text[:100], limit=WHATSAPP_SEARCH_RESULTS)
+    if not results:
+        await send_whatsapp_message(phone, f"🔎 No products found for *{text[:100]}*. Try another name, e.g. *search tee*.")
+        return
+
+    lines = [f"{n}. *{r['name']}* — ₹{r['price']:g}" for n, r in enumerate(results, 1)]
+    await state_manager.update_state(phone, {
+        "state": "awaiting_search_pick",
+        "search_results": [r['id'] for r in results]
+    })
+    await send_whatsapp_message(
+        phone, f"🔎 Results for *{text[:100]}*:\n\n" + "\n".join(lines) + "\n\n👉 Reply with a number to order."
+    )
+
+
+async def handle_search_pick(phone, choice, current_data):
+    ids = current_data.get("search_results") or []
+    if not 1 <= choice <= len(ids):
+        await send_whatsapp_message(phone, f"❌ Please reply with a number between 1 and {len(ids)}.")
+        return
+    await handle_web_handoff(phone, ids[choice - 1])
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+
+from app.core.database import db
+from app.utils.crypto import decrypt_data
+from app.utils.shiprocket import get_shiprocket_token, create_shiprocket_order, generate_shipping_label
+from app.utils.whatsapp import send_whatsapp_message
+
+logger = logging.getLogger("drop_bot")
+
+# 🚦 Shiprocket rate-limits per account, so bulk shipping is bounded per seller
+BULK_SHIP_SELLER_CONCURRENCY = int(os.getenv("BULK_SHIP_SELLER_CONCURRENCY", "5"))
+BULK_SHIP_JOB_TTL_SECONDS = 3600
+
+
+# ==============================================================================
+# 1. SHARED SHIPROCKET HELPERS (Single + Bulk)
+# ==============================================================================
+# Select-list entry: the order's line items as a JSON array (NULL if it has none). Needs `orders o`.
+ORDER_LINES_JSON = """(
+    SELECT json_agg(json_build_object(
+        'item_id', oi.item_id, 'variant_key', oi.variant_key, 'name', oi.name,
+        'qty', oi.qty, 'unit_price', oi.unit_price
+    ) ORDER BY oi.line_no)
+    FROM order_items oi WHERE oi.order_id = o.id
+) AS lines"""
+
+
+def _line_sku(line):
+    if not line.get('item_id'):
+        return line['name'][:10]
+    return f"{line['item_id']}-{line['variant_key']}" if line.get('variant_key') else str(line['item_id'])
+
+
+def build_ship_data(order, weight):
+    """
+    Format an order row (selected with ORDER_LINES_JSON) for Shiprocket: one entry per line item.
+    Orders without lines fall back to the flat item_name.
+    """
+    ship_data = dict(order)
+    lines = ship_data.pop('lines', None)
+    if lines:
+        ship_data['items'] = [{
+            "name": line['name'],
+            "sku": _line_sku(line),
+            "qty": line['qty'],
+            "price": line['unit_price'],
+            "weight": weight
+        } for line in lines]
+    else:
+        ship_data['items'] = [{
+            "name": order['item_name'],
+            "qty": order['quantity'],
+            "price": order['total_amount'] / order['quantity'] if order['quantity'] > 0 else order['total_amount'],
+            "weight": weight
+        }]
+    ship_data['pickup_location_name'] = order['pickup_address'] or "Primary"
+    ship_data['customer_name'] = "Customer" # Can be updated if you collect names later
+    return ship_data
+
+
+def describe_shiprocket_error(sr_response):
+    """Returns (http_status, message) if Shiprocket rejected the order, else None."""
+    if sr_response.get("status_code") in [400, 422] or "error" in sr_response:
+        # Extract Shiprocket's exact complaint (e.g., "Insufficient balance")
+        error_msg = sr_response.get("message") or sr_response.get("error") or "Shiprocket rejected the order."
+
+        if "balance" in error_msg.lower():
+            return 402, "⚠️ Insufficient Shiprocket Wallet Balance. Please recharge your Shiprocket account."
+        elif "pincode" in error_msg.lower():
+            return 400, "⚠️ Unserviceable Pincode. Courier cannot deliver here."
+        return 400, f"Shiprocket Error: {error_msg}"
+    return None
+
+
+def shipped_message(order, tracking_url):
+    return (
+        f"🎉 *Great news! Your order has been shipped.*\n\n"
+        f"📦 *Item:* {order['item_name']}\n"
+        f"🏪 *From:* {order['shop_name']}\n\n"
+        f"📍 *Track your package live here:*\n{tracking_url}\n\n"
+        f"🛍️ *Shop again:*\n"
+        f"https://copit.in/shop/{order['shop_slug']}"
+    )
+
+
+# ==============================================================================
+# 2. BULK SHIPPING JOBS
+# ==============================================================================
+class BulkShipJob:
+    """In-memory progress tracker so the dashboard can poll large batches cheaply."""
+
+    def __init__(self, order_ids):
+        self.id = uuid.uuid4().hex
+        self.order_ids = order_ids
+        self.results = {}
+        self.done = False
+        self.created_at = time.time()
+
+    def record(self, order_id, **result):
+        self.results[order_id] = {"order_id": order_id, **result}
+
+    def snapshot(self, include_results=True):
+        shipped = sum(1 for r in self.results.values() if r["status"] == "success")
+        label_failed = sum(1 for r in self.results.values() if r["status"] == "label_failed")
+        data = {
+            "job_id": self.id,
+            "done": self.done,
+            "total": len(self.order_ids),
+            "processed": len(self.results),
+            "shipped": shipped,
+            "label_failed": label_failed,
+            "failed": len(self.results) - shipped - label_failed,
+        }
+        if include_results:
+            data["results"] = list(self.results.values())
+        return data
+
+
+bulk_ship_jobs = {}
+# Strong references: the event loop only keeps weak ones, a running job must not be collected
+_running_tasks = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return task
+
+
+def get_bulk_ship_job(job_id):
+    return bulk_ship_jobs.get(job_id)
+
+
+def _prune_jobs():
+    cutoff = time.time() - BULK_SHIP_JOB_TTL_SECONDS
+    for job_id in [j for j, job in bulk_ship_jobs.items() if job.done and job.created_at < cutoff]:
+        del bulk_ship_jobs[job_id]
+
+
+async def _ship_seller_orders(job, email, password, orders, weight):
+    """
+    Logs in once per seller, then creates orders + labels with bounded concurrency.
+    Never raises: every order ends up recorded, so the other sellers' results are kept.
+    """
+    try:
+        token = await asyncio.to_thread(get_shiprocket_token, email, decrypt_data(password))
+    except Exception as e:
+        logger.error(f"🔥 Bulk ship: Shiprocket login for {email} failed: {e}")
+        token = None
+    if not token:
+        for order in orders:
+            job.record(order['id'], status="error", message="Shiprocket Login Failed. Check credentials.")
+        return []
+
+    limit = asyncio.Semaphore(BULK_SHIP_SELLER_CONCURRENCY)
+
+    async def _ship_one(order):
+        async with limit:
+            # A previous attempt may already have created the shipment: only the label is missing then
+            shipment_id = order['shiprocket_shipment_id']
+            awb_code = order['awb_code']
+            if not shipment_id:
+                try:
+                    sr_response = await asyncio.to_thread(create_shiprocket_order, token, build_ship_data(order, weight))
+                    failure = describe_shiprocket_error(sr_response)
+                    if failure:
+                        job.record(order['id'], status="error", message=failure[1])
+                        return None
+
+                    shipment_id = sr_response.get("shipment_id")
+                    awb_code = sr_response.get("awb_code")
+                    if not shipment_id:
+                        job.record(order['id'], status="error", message="Shiprocket did not return a Shipment ID.")
+                        return None
+
+                    await save_created_shipment(order['id'], shipment_id, awb_code)
+                except Exception as e:
+                    logger.error(f"🔥 Bulk ship failed for Order #{order['id']}: {e}")
+                    job.record(order['id'], status="error", awb=awb_code, message="Shiprocket request failed.")
+                    return None
+
+            try:
+                label_res = await asyncio.to_thread(generate_shipping_label, token, shipment_id)
+            except Exception as e:
+                label_res = None
+                logger.error(f"🔥 Label generation failed for Order #{order['id']} (shipment {shipment_id}): {e}")
+            if not (label_res and label_res.get("label_created") == 1):
+                # Shipment exists and is saved; the order stays 'processing' so a retry only fetches the label
+                job.record(order['id'], status="label_failed", awb=awb_code,
+                           message="Shipment created but the label failed. Retry to fetch the label.")
+                return None
+            label_url = label_res.get("label_url")
+
+        tracking_url = f"https://shiprocket.co/tracking/{awb_code}" if awb_code else None
+        job.record(order['id'], status="success", awb=awb_code, label_url=label_url, tracking_url=tracking_url)
+        return {
+            "order": order, "shipment_id": shipment_id, "awb": awb_code,
+            "label_url": label_url, "tracking_url": tracking_url
+        }
+
+    shipped = await asyncio.gather(*(_ship_one(o) for o in orders), return_exceptions=True)
+    for order, result in zip(orders, shipped):
+        if isinstance(result, Exception):
+            logger.error(f"🔥 Bulk ship failed for Order #{order['id']}: {result}")
+            job.record(order['id'], status="error", message="Bulk shipping failed. Please retry.")
+    return [s for s in shipped if s and not isinstance(s, Exception)]
+
+
+async def save_created_shipment(order_id, shipment_id, awb_code):
+    """Stored the moment Shiprocket creates the shipment, so a retry reuses it instead of creating a duplicate."""
+    async with db.pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE orders
+            SET shiprocket_shipment_id = $2, awb_code = $3, shipping_provider = 'Shiprocket'
+            WHERE id = $1
+        """, order_id, int(shipment_id), awb_code)
+
+
+async def _send_shipped_notifications(shipments):
+    """Queued after the batch is committed; never blocks the shipping job."""
+    for s in shipments:
+        if not s["tracking_url"]:
+            continue
+        try:
+            await send_whatsapp_message(s["order"]['customer_phone'], shipped_message(s["order"], s["tracking_url"]))
+        except Exception as e:
+            print(f"🔥 WhatsApp tracking dispatch failed: {e}")
+
+
+async def _save_shipments(shipments):
+    async with db.pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE orders o
+            SET delivery_status = 'shipped',
+                awb_code = u.awb,
+                tracking_url = u.tracking_url,
+                shipping_label_url = u.label_url,
+                shipping_provider = 'Shiprocket',
+                shiprocket_shipment_id = u.shipment_id,
+                shipped_at = NOW()
+            FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::bigint[])
+                 AS u(id, awb, tracking_url, label_url, shipment_id)
+            WHERE o.id = u.id
+        """,
+        [s["order"]['id'] for s in shipments],
+        [s["awb"] for s in shipments],
+        [s["tracking_url"] for s in shipments],
+        [s["label_url"] for s in shipments],
+        [int(s["shipment_id"]) for s in shipments])
+
+
+async def run_bulk_ship_job(job, weight):
+    try:
+        # 1. ONE query for every order + its shop credentials
+        async with db.pool.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT o.*, s.shiprocket_email, s.shiprocket_password, s.pickup_address, s.name as shop_name, s.slug as shop_slug,
+                       {ORDER_LINES_JSON}
+                FROM orders o
+                JOIN shops s ON o.shop_id = s.id
+                WHERE o.id = ANY($1::bigint[])
+            """, job.order_ids)
+
+        found = {r['id']: r for r in rows}
+        by_seller = defaultdict(list)
+        for order_id in job.order_ids:
+            order = found.get(order_id)
+            if not order:
+                job.record(order_id, status="error", message="Order not found")
+            elif not order['shiprocket_email'] or not order['shiprocket_password']:
+                job.record(order_id, status="error", message="Seller has not configured Shiprocket credentials.")
+            elif order['delivery_status'] != 'processing':
+                job.record(order_id, status="error", message="Order is already shipped or not ready.")
+            else:
+                by_seller[(order['shiprocket_email'], order['shiprocket_password'])].append(order)
+
+        # 2. Create Shiprocket orders + labels, sellers in parallel. Every seller settles before the
+        #    write-back: one seller failing must not finish the job under the others' feet.
+        seller_batches = await asyncio.gather(*(
+            _ship_seller_orders(job, email, password, orders, weight)
+            for (email, password), orders in by_seller.items()
+        ), return_exceptions=True)
+        shipments = []
+        for orders, batch in zip(by_seller.values(), seller_batches):
+            if isinstance(batch, Exception):
+                logger.error(f"🔥 Bulk Ship Job {job.id}: seller batch failed: {batch}")
+                for order in orders:
+                    if order['id'] not in job.results:
+                        job.record(order['id'], status="error", message="Bulk shipping failed. Please retry.")
+            else:
+                shipments.extend(batch)
+
+        # 3. ONE batched write-back for every AWB + label
+        if shipments:
+            try:
+                await _save_shipments(shipments)
+            except Exception as e:
+                logger.error(f"🔥 Bulk Ship Job {job.id}: Shiprocket succeeded but DB save failed: {e}")
+                for s in shipments:
+                    job.record(s["order"]['id'], status="error", awb=s["awb"],
+                               message="Shipped on Shiprocket but failed to save. Contact support.")
+                return
+
+            # 4. Queue customer notifications
+            _spawn(_send_shipped_notifications(shipments))
+
+    except Exception as e:
+        logger.error(f"🔥 Bulk Ship Job {job.id} crashed: {e}", exc_info=True)
+        for order_id in job.order_ids:
+            if order_id not in job.results:
+                job.record(order_id, status="error", message="Bulk shipping failed. Please retry.")
+    finally:
+        job.done = True
+
+
+def start_bulk_ship_job(order_ids, weight):
+    _prune_jobs()
+    # Preserve request order, drop duplicate ids
+    job = BulkShipJob(list(dict.fromkeys(order_ids)))
+    bulk_ship_jobs[job.id] = job
+    task = _spawn(run_bulk_ship_job(job, weight))
+    return job, task
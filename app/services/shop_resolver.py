@@ -0,0 +1,92 @@
+import logging
+import os
+
+from app.core.database import db
+from app.utils.cache import TTLCache, MISSING
+from app.utils.metrics import Counter
+
+logger = logging.getLogger("drop_bot")
+
+# Known slugs live until a NOTIFY drops them; the TTL is only a safety net for missed NOTIFYs
+SHOP_SLUG_CACHE_TTL_SECONDS = float(os.getenv("SHOP_SLUG_CACHE_TTL_SECONDS", "600"))
+SHOP_SLUG_CACHE_MAX_ENTRIES = int(os.getenv("SHOP_SLUG_CACHE_MAX_ENTRIES", "10000"))
+# Unknown slugs (typos, bots probing random URLs): short, and bounded so a scan can't grow memory
+SHOP_SLUG_NEGATIVE_TTL_SECONDS = float(os.getenv("SHOP_SLUG_NEGATIVE_TTL_SECONDS", "60"))
+SHOP_SLUG_NEGATIVE_MAX_ENTRIES = int(os.getenv("SHOP_SLUG_NEGATIVE_MAX_ENTRIES", "20000"))
+
+SHOP_SLUGS_CHANGED_CHANNEL = "shop_slugs_changed"
+
+shop_resolver_requests = Counter(
+    "shop_resolver_total",
+    "Slug -> shop id lookups by result (hit, negative_hit, miss)",
+    labelnames=("result",),
+)
+
+# Two single-index lookups instead of `slug = $1 OR username = $1` (see migrations/008).
+# UNION ALL runs in order and LIMIT stops early: a slug match wins over a username match.
+RESOLVE_SHOP_SQL = """
+    (SELECT id FROM shops WHERE slug = $1 LIMIT 1)
+    UNION ALL
+    (SELECT id FROM shops WHERE username = $1 LIMIT 1)
+    LIMIT 1
+"""
+
+
+class ShopResolver:
+    """
+    Per-worker map of storefront slug / username -> shop id, with negative caching.
+    Invalidated by the 'shop_slugs_changed' trigger: the changed shop's aliases are dropped,
+    and so is every negative entry (the new slug may be one we answered "unknown" for).
+    """
+
+    def __init__(self):
+        self._ids = TTLCache(ttl_seconds=SHOP_SLUG_CACHE_TTL_SECONDS, maxsize=SHOP_SLUG_CACHE_MAX_ENTRIES)
+        self._unknown = TTLCache(ttl_seconds=SHOP_SLUG_NEGATIVE_TTL_SECONDS, maxsize=SHOP_SLUG_NEGATIVE_MAX_ENTRIES)
+        self._slugs_by_shop = {}  # shop_id -> {slugs}
+        self._generation = 0      # bumped on every invalidation
+
+    async def resolve(self, slug):
+        """Shop id for a slug or username, or None if there is no such shop."""
+        shop_id = self._ids.get(slug)
+        if shop_id is not MISSING:
+            shop_resolver_requests.inc(result="hit")
+            return shop_id
+        if self._unknown.get(slug) is not MISSING:
+            shop_resolver_requests.inc(result="negative_hit")
+            return None
+
+        shop_resolver_requests.inc(result="miss")
+        generation = self._generation
+        async with db.pool.acquire() as conn:
+            shop_id = await conn.fetchval(RESOLVE_SHOP_SQL, slug)
+
+        # A NOTIFY that arrived during the query may concern this very slug: answer, don't store
+        if generation == self._generation:
+            if shop_id is None:
+                self._unknown.set(slug, True)
+            else:
+                self._ids.set(slug, shop_id)
+                self._slugs_by_shop.setdefault(shop_id, set()).add(slug)
+        return shop_id
+
+    def invalidate_shop(self, shop_id):
+        self._generation += 1
+        for slug in self._slugs_by_shop.pop(shop_id, ()):
+            self._ids.invalidate(slug)
+        self._unknown.clear()
+
+    def clear(self):
+        self._generation += 1
+        self._ids.clear()
+        self._unknown.clear()
+        self._slugs_by_shop.clear()
+
+    def on_notify(self, payload):
+        """LISTEN callback. payload = shop id; None after a (re)connect, when anything may have changed."""
+        if payload is None:
+            self.clear()
+        elif payload.isdigit():
+            self.invalidate_shop(int(payload))
+
+
+shop_resolver = ShopResolver()
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from app.utils.cache import TTLCache, MISSING
+from app.utils.metrics import Counter
+
+logger = logging.getLogger("drop_bot")
+
+# Entries live until a write invalidates them; the TTL is only a safety net for missed NOTIFYs
+STOREFRONT_CACHE_TTL_SECONDS = float(os.getenv("STOREFRONT_CACHE_TTL_SECONDS", "300"))
+STOREFRONT_CACHE_MAX_ENTRIES = int(os.getenv("STOREFRONT_CACHE_MAX_ENTRIES", "2000"))
+# What browsers / the CDN are told
+STOREFRONT_MAX_AGE_SECONDS = int(os.getenv("STOREFRONT_MAX_AGE_SECONDS", "15"))
+STOREFRONT_SWR_SECONDS = int(os.getenv("STOREFRONT_SWR_SECONDS", "120"))
+
+STOREFRONT_INVALIDATE_CHANNEL = "storefront_invalidate"
+STOREFRONT_CACHE_CONTROL = f"public, max-age={STOREFRONT_MAX_AGE_SECONDS}, stale-while-revalidate={STOREFRONT_SWR_SECONDS}"
+
+storefront_cache_requests = Counter(
+    "storefront_cache_total",
+    "Storefront page lookups by result (hit, miss, coalesced, not_modified)",
+    labelnames=("result",),
+)
+
+
+class CachedPage:
+    """An already-serialized storefront response plus its content-hash ETag."""
+    __slots__ = ("shop_id", "body", "etag")
+
+    def __init__(self, shop_id, body: bytes):
+        self.shop_id = shop_id
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """RFC 9110 weak comparison for If-None-Match (handles lists, W/ prefixes and '*')."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class StorefrontCache:
+    """
+    Per-worker cache of serialized storefront pages, keyed by whatever the page is looked up by
+    (shop slug). Invalidated per shop, so every alias of a shop is dropped together.
+
+    Concurrent misses for the same key share ONE rebuild. A rebuild that started before an
+    invalidation for its shop is returned to its waiters but never stored.
+    """
+
+    def __init__(self, ttl_seconds, maxsize):
+        self._pages = TTLCache(ttl_seconds=ttl_seconds, maxsize=maxsize)
+        self._keys_by_shop = {}     # shop_id -> {keys}
+        self._inflight = {}         # key -> Task
+        self._invalidated_at = {}   # shop_id -> monotonic time of last invalidation
+        self._cleared_at = 0.0
+
+    async def get_or_build(self, key, build):
+        """
+        build() -> CachedPage or None (not found, never cached).
+        Returns the cached page, or the result of a (shared) rebuild.
+        """
+        page = self._pages.get(key)
+        if page is not MISSING:
+            storefront_cache_requests.inc(result="hit")
+            return page
+
+        task = self._inflight.get(key)
+        if task is not None:
+            storefront_cache_requests.inc(result="coalesced")
+        else:
+            storefront_cache_requests.inc(result="miss")
+            task = asyncio.ensure_future(self._build(key, build))
+            self._inflight[key] = task
+        # shield: one client hanging up must not cancel the rebuild for everyone else
+        return await asyncio.shield(task)
+
+    async def _build(self, key, build):
+        started = time.monotonic()
+        try:
+            page = await build()
+            if page is not None and max(self._cleared_at, self._invalidated_at.get(page.shop_id, 0.0)) < started:
+                self._pages.set(key, page)
+                self._keys_by_shop.setdefault(page.shop_id, set()).add(key)
+            return page
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate_shop(self, shop_id):
+        self._invalidated_at[shop_id] = time.monotonic()
+        for key in self._keys_by_shop.pop(shop_id, ()):
+            self._pages.invalidate(key)
+
+    def clear(self):
+        self._cleared_at = time.monotonic()
+        self._pages.clear()
+        self._keys_by_shop.clear()
+
+    def on_notify(self, payload):
+        """LISTEN callback. payload is the shop id, or None after a (re)connect."""
+        if payload is None:
+            self.clear()
+        elif payload.isdigit():
+            self.invalidate_shop(int(payload))
+
+
+storefront_cache = StorefrontCache(STOREFRONT_CACHE_TTL_SECONDS, STOREFRONT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,284 @@
+import base64
+import json
+
+from app.core.database import db
+from app.services.shop_resolver import shop_resolver
+from app.services.storefront_cache import CachedPage
+
+PRODUCT_PAGE_DEFAULT_LIMIT = 24
+PRODUCT_PAGE_MAX_LIMIT = 100
+
+
+class PageNotFound(Exception):
+    """Raised by page builders; the message says what was missing ("Shop" / "Item")."""
+
+
+# ==============================================================================
+# ONE ROUND TRIP PER PAGE
+# Postgres assembles the whole response with json_build_object / json_agg and hands
+# back a single text value. No per-row Records, dicts or json.loads in Python.
+# ==============================================================================
+
+_STOREFRONT_SHOP_CTE = """
+    shop AS (
+        SELECT id, name, phone_number, plan_type, logo_url, slug, username, return_policy, instagram_handle
+        FROM shops
+        WHERE id = $1
+    )
+"""
+
+# ONLY public reviews, best first: the ids are kept ranked in review_summaries (migrations/009)
+_STOREFRONT_REVIEWS_JSON = """
+    COALESCE((
+        SELECT json_agg(json_build_object(
+            'rating', r.rating, 'comment', r.comment, 'customer_name', r.customer_name, 'created_at', r.created_at
+        ) ORDER BY t.pos)
+        FROM review_summaries rs
+        CROSS JOIN LATERAL unnest(rs.top_public_ids) WITH ORDINALITY AS t(id, pos)
+        JOIN reviews r ON r.id = t.id
+        WHERE rs.shop_id = s.id
+    ), '[]'::json)
+"""
+
+STOREFRONT_PAGE_SQL = f"""
+    WITH {_STOREFRONT_SHOP_CTE}
+    SELECT s.id AS shop_id, json_build_object(
+        'status', 'success',
+        'shop', row_to_json(s),
+        -- No stock filter: complex items with 0 base stock but variant stock must stay visible
+        'products', COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', i.id,
+                'name', i.name,
+                'price', i.price,
+                'image_url', i.image_url,
+                'category', i.category,
+                'description', i.description,
+                'stock_count', COALESCE(i.stock_count, 0),
+                'attributes', COALESCE(i.attributes::jsonb, '{{}}'::jsonb)
+            ) ORDER BY i.category, i.name)
+            FROM items i
+            WHERE i.shop_id = s.id
+        ), '[]'::json),
+        'reviews', {_STOREFRONT_REVIEWS_JSON}
+    )::text AS body
+    FROM shop s
+"""
+
+PRODUCT_PAGE_SQL = """
+    WITH shop AS (
+        SELECT id, name, phone_number, logo_url, slug, instagram_handle
+        FROM shops
+        WHERE id = $1
+    ),
+    item AS (
+        -- Explicitly named public columns. Never SELECT *.
+        SELECT i.id, i.name, i.price, i.description, i.category, i.image_url,
+               COALESCE(i.stock_count, 0) AS stock_count,
+               COALESCE(i.attributes::jsonb, '{}'::jsonb) AS attributes,
+               i.slug
+        FROM items i
+        JOIN shop s ON s.id = i.shop_id
+        WHERE i.slug = $2
+        LIMIT 1
+    )
+    SELECT s.id AS shop_id, it.id AS item_id, json_build_object(
+        'status', 'success',
+        'shop', row_to_json(s),
+        'item', row_to_json(it),
+        -- 4 "More from this shop" items: precomputed neighbours (related_service), best first.
+        -- Items not ranked yet fall back to any 4 others.
+        'more_items', COALESCE((
+            SELECT json_agg(json_build_object(
+                'id', i.id, 'name', i.name, 'price', i.price, 'image_url', i.image_url, 'slug', i.slug
+            ) ORDER BY r.rank)
+            FROM (SELECT related_id, rank FROM related_items WHERE item_id = it.id ORDER BY rank LIMIT 4) r
+            JOIN items i ON i.id = r.related_id
+        ), (
+            SELECT json_agg(m)
+            FROM (
+                SELECT id, name, price, image_url, slug
+                FROM items
+                WHERE shop_id = s.id AND id != it.id
+                LIMIT 4
+            ) m
+        ), '[]'::json)
+    )::text AS body
+    FROM shop s
+    LEFT JOIN item it ON TRUE
+"""
+
+
+# ==============================================================================
+# PAGINATED LISTING
+# Keyset pagination on (category, name, id), served by idx_items_shop_listing.
+# NULL category / name sort as '' so the row comparison stays index-friendly.
+# ==============================================================================
+
+# Public item fields a client may ask for via ?fields=, in response order
+PRODUCT_FIELDS = {
+    "id": "i.id",
+    "name": "i.name",
+    "price": "i.price",
+    "image_url": "i.image_url",
+    "category": "i.category",
+    "description": "i.description",
+    "stock_count": "COALESCE(i.stock_count, 0)",
+    "attributes": "COALESCE(i.attributes::jsonb, '{}'::jsonb)",
+    "slug": "i.slug",
+}
+
+_LISTING_KEY = "COALESCE(i.category, ''), COALESCE(i.name, ''), i.id"
+
+# $2 categories (NULL = all), $3/$4/$5 cursor key (NULL = first page)
+_PRODUCT_LIST_WHERE = f"""
+            ($2::text[] IS NULL OR i.category = ANY($2::text[]))
+            AND ($3::text IS NULL OR ({_LISTING_KEY}) > ($3::text, $4::text, $5::bigint))
+"""
+
+# Opaque cursor: url-safe base64 of [category, name, id], unpadded. Read back by decode_cursor()
+_CURSOR_SQL = r"""
+    rtrim(translate(encode(convert_to(
+        json_build_array(p.k_category, p.k_name, p.id)::text, 'UTF8'), 'base64'), E'+/\n', '-_'), '=')
+"""
+
+
+def parse_fields(fields):
+    """'id,name,price' -> ('id', 'name', 'price') in canonical order. None = every field."""
+    if not fields:
+        return tuple(PRODUCT_FIELDS)
+    wanted = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = wanted - PRODUCT_FIELDS.keys()
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(f for f in PRODUCT_FIELDS if f in wanted)
+
+
+def decode_cursor(cursor):
+    """Returns (category, name, id). Raises ValueError on anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        category, name, item_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(category, str) or not isinstance(name, str) or not isinstance(item_id, int):
+        raise ValueError("Invalid cursor")
+    return category, name, item_id
+
+
+def _listing_page_cte(fields, where, limit_param):
+    """
+    `page` CTE: up to limit+1 items (the extra row only tells us there IS a next page).
+    Expects a `shop` CTE before it.
+    """
+    product = "json_build_object(" + ", ".join(f"'{f}', {PRODUCT_FIELDS[f]}" for f in fields) + ")"
+    return f"""
+    page AS (
+        SELECT i.id, COALESCE(i.category, '') AS k_category, COALESCE(i.name, '') AS k_name,
+               {product} AS product,
+               row_number() OVER (ORDER BY {_LISTING_KEY}) AS rn
+        FROM items i
+        -- Scalar subquery (not a JOIN) so the planner walks the index in order and stops early
+        WHERE i.shop_id = (SELECT id FROM shop) AND {where}
+        ORDER BY {_LISTING_KEY}
+        LIMIT {limit_param} + 1
+    )
+    """
+
+
+def _listing_json(limit_param):
+    """'products' + 'next_cursor' members for json_build_object, read from the `page` CTE."""
+    return f"""
+        'products', COALESCE((SELECT json_agg(p.product ORDER BY p.rn) FROM page p WHERE p.rn <= {limit_param}), '[]'::json),
+        'next_cursor', (
+            SELECT {_CURSOR_SQL} FROM page p
+            WHERE p.rn = {limit_param} AND EXISTS (SELECT 1 FROM page WHERE rn > {limit_param})
+        )
+    """
+
+
+def _product_list_sql(fields):
+    # $1 shop id, $2..$5 see _PRODUCT_LIST_WHERE, $6 limit
+    return f"""
+    WITH shop AS (
+        SELECT id FROM shops WHERE id = $1
+    ),
+    {_listing_page_cte(fields, _PRODUCT_LIST_WHERE, '$6')}
+    SELECT s.id AS shop_id, json_build_object(
+        'status', 'success',
+        {_listing_json('$6')}
+    )::text AS body
+    FROM shop s
+    """
+
+
+def _storefront_first_page_sql(fields):
+    # $1 shop id, $2 page size
+    return f"""
+    WITH {_STOREFRONT_SHOP_CTE},
+    {_listing_page_cte(fields, 'TRUE', '$2')}
+    SELECT s.id AS shop_id, json_build_object(
+        'status', 'success',
+        'shop', row_to_json(s),
+        {_listing_json('$2')},
+        'categories', COALESCE((
+            SELECT json_agg(json_build_object('category', c.category, 'count', c.n) ORDER BY c.category)
+            FROM (SELECT category, COUNT(*) AS n FROM items WHERE shop_id = s.id GROUP BY category) c
+        ), '[]'::json),
+        'reviews', {_STOREFRONT_REVIEWS_JSON}
+    )::text AS body
+    FROM shop s
+    """
+
+
+async def build_storefront_page(slug: str):
+    """Whole storefront in one query. Returns a CachedPage, or None if the shop doesn't exist."""
+    shop_id = await shop_resolver.resolve(slug)
+    if shop_id is None:
+        return None
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(STOREFRONT_PAGE_SQL, shop_id)
+    if not row:
+        return None
+    return CachedPage(row['shop_id'], row['body'].encode())
+
+
+async def build_product_page(shop_slug: str, product_slug: str):
+    """Product page + "more from this shop" in one query. Raises PageNotFound for unknown shop / item."""
+    shop_id = await shop_resolver.resolve(shop_slug)
+    if shop_id is None:
+        raise PageNotFound("Shop")
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(PRODUCT_PAGE_SQL, shop_id, product_slug)
+    if not row:
+        raise PageNotFound("Shop")
+    if row['item_id'] is None:
+        raise PageNotFound("Item")
+    return CachedPage(row['shop_id'], row['body'].encode())
+
+
+async def build_product_list_page(slug: str, fields, categories=None, after=None, limit=PRODUCT_PAGE_DEFAULT_LIMIT):
+    """One page of a shop's catalog. `after` is a decoded cursor. Returns None if the shop doesn't exist."""
+    shop_id = await shop_resolver.resolve(slug)
+    if shop_id is None:
+        return None
+    after_category, after_name, after_id = after or (None, None, None)
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(
+            _product_list_sql(fields), shop_id, categories, after_category, after_name, after_id, limit
+        )
+    if not row:
+        return None
+    return CachedPage(row['shop_id'], row['body'].encode())
+
+
+async def build_storefront_first_page(slug: str, fields, limit=PRODUCT_PAGE_DEFAULT_LIMIT):
+    """Storefront with only the first product page + per-category counts. Returns None if the shop doesn't exist."""
+    shop_id = await shop_resolver.resolve(slug)
+    if shop_id is None:
+        return None
+    async with db.pool.acquire() as conn:
+        row = await conn.fetchrow(_storefront_first_page_sql(fields), shop_id, limit)
+    if not row:
+        return None
+    return CachedPage(row['shop_id'], row['body'].encode())
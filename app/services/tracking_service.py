@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from app.core.database import db
+from app.utils.whatsapp import send_whatsapp_message
+
+logger = logging.getLogger("drop_bot")
+
+TRACKING_FLUSH_SECONDS = float(os.getenv("TRACKING_FLUSH_SECONDS", "2"))
+TRACKING_FLUSH_MAX_EVENTS = int(os.getenv("TRACKING_FLUSH_MAX_EVENTS", "500"))
+
+# Forward order of our delivery lifecycle. Terminal states are never overwritten by a late scan.
+STATUS_RANK = {"processing": 0, "shipped": 1, "out_for_delivery": 2, "delivered": 3, "returned": 3}
+TERMINAL_STATUSES = ("delivered", "returned")
+
+# Shiprocket sends a few different timestamp layouts depending on the courier
+_TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%d %m %Y %H:%M:%S", "%d-%m-%Y %H:%M:%S")
+
+
+def map_shiprocket_status(current_status: str) -> str:
+    """Map Shiprocket statuses to our Supabase schema."""
+    status_lower = current_status.strip().lower()
+    if status_lower == 'delivered':
+        return 'delivered'
+    if status_lower in ['rto initiated', 'rto delivered', 'returned']:
+        return 'returned'
+    if status_lower in ['out for delivery']:
+        return 'out_for_delivery'
+    return 'shipped'
+
+
+def _parse_event_time(raw):
+    if raw:
+        for fmt in _TIMESTAMP_FORMATS:
+            try:
+                return datetime.strptime(str(raw).strip(), fmt)
+            except ValueError:
+                continue
+    return None
+
+
+class TrackingEventBuffer:
+    """
+    Collapses bursts of Shiprocket pushes into ONE pending status per AWB.
+    Repeats and older scans are dropped in memory; the flush loop applies the survivors in bulk.
+    """
+
+    def __init__(self):
+        self.pending = {}  # awb -> (event_time, arrival_seq, db_status)
+        self._seq = 0
+        self.wakeup = asyncio.Event()
+
+    def add(self, awb, current_status, event_timestamp=None):
+        self._seq += 1
+        db_status = map_shiprocket_status(current_status)
+        event_time = _parse_event_time(event_timestamp)
+        key = (event_time or datetime.min, self._seq)
+
+        existing = self.pending.get(awb)
+        if existing and existing[:2] > key and event_time is not None:
+            return  # Out-of-order scan: we already hold a newer event for this AWB
+        if existing and existing[2] in TERMINAL_STATUSES and db_status not in TERMINAL_STATUSES:
+            return  # Never let an intermediate scan mask a terminal one
+        self.pending[awb] = (*key, db_status)
+
+        if len(self.pending) >= TRACKING_FLUSH_MAX_EVENTS:
+            self.wakeup.set()
+
+    def requeue(self, batch):
+        """Puts a failed flush back without clobbering anything newer that arrived meanwhile."""
+        for awb, db_status in batch.items():
+            self.pending.setdefault(awb, (datetime.min, 0, db_status))
+
+    def drain(self):
+        batch = {awb: entry[2] for awb, entry in self.pending.items()}
+        self.pending = {}
+        self.wakeup.clear()
+        return batch
+
+
+tracking_buffer = TrackingEventBuffer()
+
+
+async def _notify_transition(row):
+    # Optional: Send WhatsApp when Out for Delivery!
+    if row['new_status'] == 'out_for_delivery':
+        wa_msg = f"🚚 *Out for Delivery!*\n\nYour order '{row['item_name']}' is out for delivery today. Please keep your phone reachable."
+        try:
+            await send_whatsapp_message(row['customer_phone'], wa_msg)
+        except Exception:
+            pass  # Silent fail for tracking updates
+
+
+async def flush_tracking_events():
+    """
+    Applies every buffered AWB status with a single statement.
+    The stored status only moves forward (STATUS_RANK); notifications fire only on real forward transitions.
+    """
+    batch = tracking_buffer.drain()
+    if not batch:
+        return 0
+
+    awbs = list(batch.keys())
+    statuses = [batch[a] for a in awbs]
+
+    try:
+        async with db.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                WITH rank AS (
+                    SELECT * FROM unnest($3::text[], $4::int[]) AS k(status, rank)
+                ),
+                ev AS (
+                    SELECT e.awb, e.status, COALESCE(r.rank, 0) AS rank
+                    FROM unnest($1::text[], $2::text[]) AS e(awb, status)
+                    LEFT JOIN rank r ON r.status = e.status
+                ),
+                prev AS (
+                    SELECT o.id, o.delivery_status AS old_status
+                    FROM orders o JOIN ev ON o.awb_code = ev.awb
+                    FOR UPDATE OF o
+                )
+                UPDATE orders o
+                -- Only ever forward: a late scan, even one flushed after a newer status, can't lower it
+                SET delivery_status = CASE
+                        WHEN ev.rank > COALESCE((SELECT rank FROM rank WHERE status = prev.old_status), 0) THEN ev.status
+                        ELSE prev.old_status
+                    END,
+                    last_tracking_event_at = NOW()
+                FROM ev, prev
+                WHERE o.id = prev.id AND o.awb_code = ev.awb
+                RETURNING o.id, o.customer_phone, o.item_name, prev.old_status, o.delivery_status AS new_status
+            """, awbs, statuses, list(STATUS_RANK), list(STATUS_RANK.values()))
+    except Exception:
+        tracking_buffer.requeue(batch)
+        raise
+
+    # Connection released: only now talk to Meta
+    forward = [
+        r for r in rows
+        if STATUS_RANK.get(r['new_status'], 0) > STATUS_RANK.get(r['old_status'], 0)
+    ]
+    await asyncio.gather(*(_notify_transition(r) for r in forward))
+
+    logger.info(f"📡 Tracking flush: events={len(batch)} matched={len(rows)} transitions={len(forward)}")
+    return len(rows)
+
+
+async def tracking_flush_loop():
+    print("📡 Tracking Event Flusher Started...")
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(tracking_buffer.wakeup.wait(), timeout=TRACKING_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await flush_tracking_events()
+            except Exception as e:
+                print(f"🔥 Tracking Flush Error: {e}")
+    finally:
+        # Graceful shutdown: don't drop what Shiprocket already handed us
+        if tracking_buffer.pending and db.pool:
+            await flush_tracking_events()
@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+
+# Sentinel so callers can cache a legitimate None (e.g. "shop has no keys")
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Tiny in-process LRU cache with per-entry expiry.
+    Single event loop = no locking needed. Each worker keeps its own copy.
+    """
+
+    def __init__(self, ttl_seconds: float, maxsize: int = 1024):
+        self.ttl = ttl_seconds
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=MISSING):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl_seconds: float = None):
+        ttl = self.ttl if ttl_seconds is None else ttl_seconds
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
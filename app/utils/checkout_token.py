@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+
+from app.utils.cache import TTLCache, MISSING
+from app.utils.vault import _load_master_keys
+
+logger = logging.getLogger("drop_bot")
+
+CHECKOUT_TOKEN_TTL_SECONDS = int(os.getenv("CHECKOUT_TOKEN_TTL_SECONDS", "600"))
+# Tolerated clock difference between the worker that issued a link and the one checking it
+CHECKOUT_TOKEN_CLOCK_SKEW_SECONDS = 60
+CHECKOUT_TOKEN_REVOKED_CHANNEL = "checkout_token_revoked"
+
+_SIGNATURE_BYTES = 16
+
+
+class CheckoutTokenError(Exception):
+    """Base class: the link can't be used."""
+
+
+class CheckoutTokenInvalid(CheckoutTokenError):
+    """Malformed, forged, or already used."""
+
+
+class CheckoutTokenExpired(CheckoutTokenError):
+    pass
+
+
+def _load_signing_keys():
+    """
+    CHECKOUT_TOKEN_SECRETS = "new,old,..." (first one signs, all of them verify).
+    Without it, a key is derived from the vault master key(s), so no new env var is needed.
+    """
+    raw = os.getenv("CHECKOUT_TOKEN_SECRETS") or os.getenv("CHECKOUT_TOKEN_SECRET") or ""
+    keys = [k.strip().encode() for k in raw.split(",") if k.strip()]
+    if not keys:
+        keys = [hmac.new(k.encode(), b"copit-checkout-token", hashlib.sha256).digest() for k in _load_master_keys()]
+    if not keys:
+        # Links then only verify on the worker that issued them, until it restarts
+        logger.warning("🔥 CRITICAL: CHECKOUT_TOKEN_SECRETS is missing! Checkout links will not survive restarts.")
+        keys = [secrets.token_bytes(32)]
+    return keys
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class CheckoutTokens:
+    """
+    Stateless checkout links: "<base64 phone:issued_at:nonce>.<base64 HMAC-SHA256>".
+    Issuing and verifying never touch the DB. Single use is enforced where the token is
+    spent (confirm-address writes the nonce to checkout_token_revocations); every worker
+    also keeps the spent nonces in memory until they would have expired anyway.
+    """
+
+    def __init__(self, keys, ttl_seconds):
+        self.keys = keys
+        self.ttl = ttl_seconds
+        self._revoked = TTLCache(ttl_seconds=ttl_seconds + CHECKOUT_TOKEN_CLOCK_SKEW_SECONDS, maxsize=50000)
+
+    def _sign(self, key, payload: bytes) -> bytes:
+        return hmac.new(key, payload, hashlib.sha256).digest()[:_SIGNATURE_BYTES]
+
+    def issue(self, phone: str) -> str:
+        payload = f"{phone}:{int(time.time())}:{secrets.token_hex(8)}".encode()
+        return _b64encode(payload) + "." + _b64encode(self._sign(self.keys[0], payload))
+
+    def verify(self, token: str):
+        """Returns (phone, nonce, expires_at epoch seconds). Raises CheckoutTokenInvalid / CheckoutTokenExpired."""
+        try:
+            payload_part, signature_part = token.split(".")
+            payload = _b64decode(payload_part)
+            signature = _b64decode(signature_part)
+            phone, issued_at, nonce = payload.decode().split(":")
+            issued_at = int(issued_at)
+        except Exception:
+            raise CheckoutTokenInvalid("Malformed token")
+
+        if not any(hmac.compare_digest(signature, self._sign(k, payload)) for k in self.keys):
+            raise CheckoutTokenInvalid("Bad signature")
+
+        now = time.time()
+        expires_at = issued_at + self.ttl
+        if now > expires_at or issued_at > now + CHECKOUT_TOKEN_CLOCK_SKEW_SECONDS:
+            raise CheckoutTokenExpired("Token expired")
+        if self._revoked.get(nonce) is not MISSING:
+            raise CheckoutTokenInvalid("Token already used")
+        return phone, nonce, expires_at
+
+    def revoke(self, nonce: str):
+        self._revoked.set(nonce, True)
+
+    def on_notify(self, payload):
+        """LISTEN callback: payload = spent nonce (None after a reconnect: nothing to do, the DB is authoritative)."""
+        if payload:
+            self.revoke(payload)
+
+
+checkout_tokens = CheckoutTokens(_load_signing_keys(), CHECKOUT_TOKEN_TTL_SECONDS)
@@ -0,0 +1,103 @@
+import hashlib
+import hmac
+import logging
+import os
+import time
+
+import httpx
+
+from app.utils.metrics import Histogram
+
+logger = logging.getLogger("drop_bot")
+
+# Overridable so tests / local dev can point at a Razorpay stub
+RAZORPAY_API_BASE = os.getenv("RAZORPAY_API_BASE", "https://api.razorpay.com/v1")
+RAZORPAY_TIMEOUT_SECONDS = float(os.getenv("RAZORPAY_TIMEOUT_SECONDS", "10"))
+RAZORPAY_MAX_CONNECTIONS = int(os.getenv("RAZORPAY_MAX_CONNECTIONS", "50"))
+
+gateway_latency = Histogram(
+    "razorpay_gateway_latency_seconds",
+    "Latency of Razorpay API calls",
+    labelnames=("operation", "outcome"),
+)
+
+
+class RazorpayGatewayError(Exception):
+    def __init__(self, status_code, description):
+        super().__init__(f"Razorpay {status_code}: {description}")
+        self.status_code = status_code
+        self.description = description
+
+
+_http_client = None
+
+
+def _client() -> httpx.AsyncClient:
+    """ONE pooled keep-alive client for every shop; auth is passed per request."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=RAZORPAY_API_BASE,
+            timeout=RAZORPAY_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=RAZORPAY_MAX_CONNECTIONS, max_keepalive_connections=20),
+        )
+    return _http_client
+
+
+async def close_gateway():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _request(operation, method, path, auth, payload=None, params=None):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        response = await _client().request(method, path, auth=auth, json=payload, params=params)
+        outcome = "ok" if response.status_code < 400 else "rejected"
+    finally:
+        gateway_latency.observe(time.perf_counter() - started, operation=operation, outcome=outcome)
+
+    if response.status_code >= 400:
+        try:
+            description = response.json().get("error", {}).get("description", response.text)
+        except ValueError:
+            description = response.text
+        raise RazorpayGatewayError(response.status_code, description)
+    return response.json()
+
+
+# ==============================================================================
+# PUBLIC API
+# ==============================================================================
+async def create_order(key_id, key_secret, order_data):
+    """POST /orders without blocking the event loop."""
+    return await _request("order_create", "POST", "/orders", (key_id, key_secret), payload=order_data)
+
+
+async def create_payment_link(key_id, key_secret, link_data):
+    """POST /payment_links without blocking the event loop."""
+    return await _request("payment_link_create", "POST", "/payment_links", (key_id, key_secret), payload=link_data)
+
+
+def verify_webhook_signature(body, signature, secret) -> bool:
+    """
+    Local HMAC-SHA256 check of the X-Razorpay-Signature header. Pure CPU, no network.
+    """
+    if not signature or not secret:
+        return False
+    if isinstance(body, str):
+        body = body.encode()
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    # Compare bytes: str compare_digest raises TypeError on a non-ASCII header
+    return hmac.compare_digest(expected.encode(), signature.encode())
+
+
+async def list_payments(key_id, key_secret, from_ts, to_ts, count=100, skip=0):
+    """GET /payments for a unix-time window (Razorpay caps count at 100 per page)."""
+    return await _request(
+        "payment_list", "GET", "/payments", (key_id, key_secret),
+        params={"from": int(from_ts), "to": int(to_ts), "count": count, "skip": skip}
+    )
@@ -169,7 +169,6 @@
 
 
 import os
-import json
 import requests
 from datetime import datetime
 
@@ -216,11 +215,7 @@ def create_shiprocket_order(token, order_data):
     items_payload = []
     total_weight = 0.0
     
-    raw_items = order_data['items']
-    if isinstance(raw_items, str):
-        raw_items = json.loads(raw_items)
-    
-    for item in raw_items:
+    for item in order_data['items']:
         qty = int(item.get('qty', 1))
         w = float(item.get('weight', 0.5)) 
         total_weight += w * qty
@@ -0,0 +1,106 @@
+import logging
+import os
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+from app.utils.cache import TTLCache, MISSING
+from app.utils.metrics import Counter
+
+logger = logging.getLogger("drop_bot")
+
+VAULT_CACHE_TTL_SECONDS = float(os.getenv("VAULT_CACHE_TTL_SECONDS", "300"))
+VAULT_CACHE_MAX_ENTRIES = int(os.getenv("VAULT_CACHE_MAX_ENTRIES", "2048"))
+
+vault_decrypts = Counter(
+    "vault_decrypt_total",
+    "Secret decrypt requests by result (cache hit vs real Fernet decrypt)",
+    labelnames=("result",),
+)
+
+
+def _load_master_keys():
+    """
+    ENCRYPTION_MASTER_KEYS = "new_key,old_key,..." (first one encrypts, all of them decrypt).
+    Falls back to the single legacy ENCRYPTION_MASTER_KEY.
+    """
+    raw = os.getenv("ENCRYPTION_MASTER_KEYS") or os.getenv("ENCRYPTION_MASTER_KEY") or ""
+    return [k.strip() for k in raw.split(",") if k.strip()]
+
+
+class SecretVault:
+    """
+    Fernet encryption for seller secrets with key rotation (MultiFernet) and a short-TTL,
+    size-bounded cache of decrypted values.
+
+    The cache is keyed by ciphertext. Saving a new secret produces a new ciphertext, so an
+    update can never be served a stale plaintext; old entries simply age out.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self._primary = Fernet(keys[0].encode()) if keys else None
+        self._multi = MultiFernet([Fernet(k.encode()) for k in keys]) if keys else None
+        self._cache = TTLCache(ttl_seconds=VAULT_CACHE_TTL_SECONDS, maxsize=VAULT_CACHE_MAX_ENTRIES)
+
+    @property
+    def enabled(self):
+        return self._multi is not None
+
+    def encrypt(self, plain_text: str) -> str:
+        """Encrypts with the PRIMARY key. Returns the original if no key is set."""
+        if not plain_text or not self.enabled:
+            return plain_text
+        return self._primary.encrypt(plain_text.encode()).decode()
+
+    def decrypt(self, cipher_text: str) -> str:
+        """Decrypts with any configured key. Returns the original if decryption fails."""
+        if not cipher_text or not self.enabled:
+            return cipher_text
+
+        cached = self._cache.get(cipher_text)
+        if cached is not MISSING:
+            vault_decrypts.inc(result="hit")
+            return cached
+
+        vault_decrypts.inc(result="miss")
+        try:
+            plain_text = self._multi.decrypt(cipher_text.encode()).decode()
+        except Exception as e:
+            # Never log the value itself, only that it failed
+            logger.error(f"Decryption failed (Key changed or corrupt data): {type(e).__name__}")
+            return cipher_text # Fallback (useful if you have old unencrypted keys in DB)
+
+        self._cache.set(cipher_text, plain_text)
+        return plain_text
+
+    def needs_rotation(self, cipher_text: str) -> bool:
+        """True if the value decrypts with an OLD key but not with the primary one."""
+        if not cipher_text or not self.enabled or len(self.keys) < 2:
+            return False
+        try:
+            self._primary.decrypt(cipher_text.encode())
+            return False
+        except InvalidToken:
+            pass
+        try:
+            self._multi.decrypt(cipher_text.encode())
+            return True
+        except InvalidToken:
+            return False  # Legacy plaintext or unknown key: leave it alone
+
+    def rotate(self, cipher_text: str) -> str:
+        """Re-encrypts an old-key ciphertext under the primary key."""
+        return self._multi.rotate(cipher_text.encode()).decode()
+
+    def invalidate(self, cipher_text: str):
+        self._cache.invalidate(cipher_text)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+_keys = _load_master_keys()
+if not _keys:
+    logger.warning("🔥 CRITICAL: ENCRYPTION_MASTER_KEY is missing! Keys will not be encrypted.")
+
+vault = SecretVault(_keys)
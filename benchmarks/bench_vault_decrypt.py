@@ -0,0 +1,56 @@
+"""
+Decrypt cost per request, before vs after the SecretVault cache.
+
+A "request" here mirrors the hot paths: pay_online / customer order creation decrypt the
+Razorpay key id + secret, pincode checks and shipping decrypt the Shiprocket password.
+
+Run: python benchmarks/bench_vault_decrypt.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cryptography.fernet import Fernet  # noqa: E402
+
+from app.utils.vault import SecretVault, vault_decrypts  # noqa: E402
+
+REQUESTS = 5000
+SHOPS = 50
+
+
+def main():
+    key = Fernet.generate_key().decode()
+    legacy = Fernet(key.encode())
+    v = SecretVault([key])
+
+    shops = [
+        [v.encrypt(f"rzp_key_{i}"), v.encrypt(f"rzp_secret_{i}"), v.encrypt(f"sr_pass_{i}")]
+        for i in range(SHOPS)
+    ]
+
+    # BEFORE: every request pays full Fernet decrypts
+    started = time.perf_counter()
+    fernet_calls = 0
+    for n in range(REQUESTS):
+        for token in shops[n % SHOPS]:
+            legacy.decrypt(token.encode())
+            fernet_calls += 1
+    before = time.perf_counter() - started
+
+    # AFTER: SecretVault with its decrypt cache
+    started = time.perf_counter()
+    for n in range(REQUESTS):
+        for token in shops[n % SHOPS]:
+            v.decrypt(token)
+    after = time.perf_counter() - started
+    misses = vault_decrypts.value(result="miss")
+
+    print(f"requests={REQUESTS} shops={SHOPS}")
+    print(f"before: {fernet_calls / REQUESTS:.2f} Fernet decrypts/request, {before * 1e6 / REQUESTS:.1f} us/request")
+    print(f"after:  {misses / REQUESTS:.4f} Fernet decrypts/request, {after * 1e6 / REQUESTS:.1f} us/request")
+
+
+if __name__ == "__main__":
+    main()
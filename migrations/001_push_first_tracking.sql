@@ -0,0 +1,14 @@
+-- ==============================================================================
+-- 001: Push-first delivery tracking
+-- Shiprocket webhooks stamp last_tracking_event_at. The watchdog only reconciles
+-- shipments that have gone quiet, on an interval that adapts to shipment age.
+-- ==============================================================================
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS shipped_at TIMESTAMPTZ;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS last_tracking_event_at TIMESTAMPTZ;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS last_tracking_poll_at TIMESTAMPTZ;
+
+-- Partial index: the watchdog only ever scans in-transit Shiprocket parcels
+CREATE INDEX IF NOT EXISTS idx_orders_shiprocket_in_transit
+    ON orders (last_tracking_event_at)
+    WHERE delivery_status IN ('shipped', 'out_for_delivery')
+      AND shipping_provider = 'Shiprocket';
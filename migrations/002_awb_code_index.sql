@@ -0,0 +1,6 @@
+-- ==============================================================================
+-- 002: AWB lookups for the coalesced Shiprocket webhook flush
+-- ==============================================================================
+CREATE INDEX IF NOT EXISTS idx_orders_awb_code
+    ON orders (awb_code)
+    WHERE awb_code IS NOT NULL;
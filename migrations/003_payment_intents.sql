@@ -0,0 +1,18 @@
+-- ==============================================================================
+-- 003: Reusable payment intents
+-- One live Razorpay order / payment link per checkout. Repeat taps reuse it
+-- until it expires or the amount changes.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS payment_intents (
+    intent_key    TEXT PRIMARY KEY,          -- 'order:<order_id>' or 'cart:<shop_id>:<phone>'
+    kind          TEXT NOT NULL,             -- 'order' | 'link'
+    shop_id       BIGINT NOT NULL,
+    order_id      BIGINT,
+    gateway_id    TEXT NOT NULL,             -- Razorpay order_xxx / plink_xxx
+    amount_paise  BIGINT NOT NULL,
+    short_url     TEXT,
+    expires_at    TIMESTAMPTZ NOT NULL,
+    created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_payment_intents_order ON payment_intents (order_id) WHERE order_id IS NOT NULL;
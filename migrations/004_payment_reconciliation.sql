@@ -0,0 +1,9 @@
+-- ==============================================================================
+-- 004: Incremental Razorpay reconciliation
+-- One cursor per shop so each run only pages through new captured payments.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS payment_reconciliation_cursors (
+    shop_id         BIGINT PRIMARY KEY,
+    last_synced_at  TIMESTAMPTZ NOT NULL,
+    updated_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,70 @@
+-- ==============================================================================
+-- 005: Storefront cache invalidation
+-- Any write that changes what a storefront shows NOTIFYs 'storefront_invalidate'
+-- with the shop id, so every API worker drops its cached copy. Triggers catch
+-- writes from the dashboard (Supabase) as well as from this API.
+-- Statement-level triggers: a bulk upload sends one notification per shop, not
+-- one per row (Postgres also collapses duplicate payloads within a transaction).
+-- ==============================================================================
+CREATE OR REPLACE FUNCTION notify_storefront_rows() RETURNS trigger AS $$
+DECLARE
+    sid BIGINT;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        FOR sid IN SELECT DISTINCT shop_id FROM new_rows WHERE shop_id IS NOT NULL LOOP
+            PERFORM pg_notify('storefront_invalidate', sid::text);
+        END LOOP;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        FOR sid IN SELECT DISTINCT shop_id FROM old_rows WHERE shop_id IS NOT NULL LOOP
+            PERFORM pg_notify('storefront_invalidate', sid::text);
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_storefront_shop() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('storefront_invalidate', NEW.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- items
+DROP TRIGGER IF EXISTS items_storefront_ins ON items;
+CREATE TRIGGER items_storefront_ins AFTER INSERT ON items
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_storefront_rows();
+
+DROP TRIGGER IF EXISTS items_storefront_upd ON items;
+CREATE TRIGGER items_storefront_upd AFTER UPDATE ON items
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_storefront_rows();
+
+DROP TRIGGER IF EXISTS items_storefront_del ON items;
+CREATE TRIGGER items_storefront_del AFTER DELETE ON items
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_storefront_rows();
+
+-- reviews (public toggle, new reviews, deletes)
+DROP TRIGGER IF EXISTS reviews_storefront_ins ON reviews;
+CREATE TRIGGER reviews_storefront_ins AFTER INSERT ON reviews
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_storefront_rows();
+
+DROP TRIGGER IF EXISTS reviews_storefront_upd ON reviews;
+CREATE TRIGGER reviews_storefront_upd AFTER UPDATE ON reviews
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_storefront_rows();
+
+DROP TRIGGER IF EXISTS reviews_storefront_del ON reviews;
+CREATE TRIGGER reviews_storefront_del AFTER DELETE ON reviews
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_storefront_rows();
+
+-- shops: only the columns the storefront renders (wallet / key updates stay quiet)
+DROP TRIGGER IF EXISTS shops_storefront_upd ON shops;
+CREATE TRIGGER shops_storefront_upd
+    AFTER UPDATE OF name, phone_number, plan_type, logo_url, slug, username, return_policy, instagram_handle ON shops
+    FOR EACH ROW EXECUTE FUNCTION notify_storefront_shop();
@@ -0,0 +1,7 @@
+-- ==============================================================================
+-- 006: Keyset pagination for the product listing
+-- Matches ORDER BY COALESCE(category, ''), COALESCE(name, ''), id within a shop,
+-- so every page (first or deep) is an index range scan of `limit + 1` rows.
+-- ==============================================================================
+CREATE INDEX IF NOT EXISTS idx_items_shop_listing
+    ON items (shop_id, (COALESCE(category, '')), (COALESCE(name, '')), id);
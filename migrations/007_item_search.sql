@@ -0,0 +1,63 @@
+-- ==============================================================================
+-- 007: Catalog search
+-- 1. Trigram index over name + category + description for the search endpoint
+--    and the WhatsApp bot (word_similarity `<%` for typos, ILIKE for substrings).
+-- 2. 'items_changed' NOTIFY with the changed item ids, so the in-process
+--    typeahead index refreshes only those rows. More than 200 ids in one
+--    statement (bulk upload) sends 'shop_id:*' and the index is rebuilt.
+-- ==============================================================================
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Expression must stay identical to _SEARCH_TEXT in app/services/search_service.py
+CREATE INDEX IF NOT EXISTS idx_items_search_trgm ON items USING gin (
+    (COALESCE(name, '') || ' ' || COALESCE(category, '') || ' ' || COALESCE(description, '')) gin_trgm_ops
+);
+
+CREATE OR REPLACE FUNCTION notify_items_changed_ids(sid BIGINT, ids BIGINT[]) RETURNS void AS $$
+BEGIN
+    PERFORM pg_notify('items_changed', sid || ':' ||
+        CASE WHEN cardinality(ids) > 200 THEN '*' ELSE array_to_string(ids, ',') END);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_items_changed() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+BEGIN
+    -- Transition tables only exist for the matching operation, hence one branch each
+    IF TG_OP = 'INSERT' THEN
+        FOR r IN SELECT shop_id, array_agg(id) AS ids FROM new_rows WHERE shop_id IS NOT NULL GROUP BY shop_id LOOP
+            PERFORM notify_items_changed_ids(r.shop_id, r.ids);
+        END LOOP;
+    ELSIF TG_OP = 'DELETE' THEN
+        FOR r IN SELECT shop_id, array_agg(id) AS ids FROM old_rows WHERE shop_id IS NOT NULL GROUP BY shop_id LOOP
+            PERFORM notify_items_changed_ids(r.shop_id, r.ids);
+        END LOOP;
+    ELSE
+        FOR r IN
+            SELECT shop_id, array_agg(id) AS ids
+            FROM (SELECT shop_id, id FROM new_rows UNION SELECT shop_id, id FROM old_rows) changed
+            WHERE shop_id IS NOT NULL
+            GROUP BY shop_id
+        LOOP
+            PERFORM notify_items_changed_ids(r.shop_id, r.ids);
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS items_changed_ins ON items;
+CREATE TRIGGER items_changed_ins AFTER INSERT ON items
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_items_changed();
+
+DROP TRIGGER IF EXISTS items_changed_upd ON items;
+CREATE TRIGGER items_changed_upd AFTER UPDATE ON items
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_items_changed();
+
+DROP TRIGGER IF EXISTS items_changed_del ON items;
+CREATE TRIGGER items_changed_del AFTER DELETE ON items
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_items_changed();
@@ -0,0 +1,26 @@
+-- ==============================================================================
+-- 008: Shop slug / username lookup
+-- Storefront URLs carry either the shop slug or the username. The resolver looks
+-- them up as `slug = $1 UNION ALL username = $1` (one index each) instead of
+-- `slug = $1 OR username = $1`, and caches the result per worker.
+-- 'shop_slugs_changed' (payload = shop id) tells every worker to forget a shop's
+-- aliases, and that previously unknown slugs may exist now.
+-- ==============================================================================
+CREATE INDEX IF NOT EXISTS idx_shops_slug ON shops (slug);
+CREATE INDEX IF NOT EXISTS idx_shops_username ON shops (username);
+
+CREATE OR REPLACE FUNCTION notify_shop_slugs() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('shop_slugs_changed', OLD.id::text);
+    ELSE
+        PERFORM pg_notify('shop_slugs_changed', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS shops_slugs_changed ON shops;
+CREATE TRIGGER shops_slugs_changed
+    AFTER INSERT OR DELETE OR UPDATE OF slug, username ON shops
+    FOR EACH ROW EXECUTE FUNCTION notify_shop_slugs();
@@ -0,0 +1,108 @@
+-- ==============================================================================
+-- 009: Per-shop review summary
+-- Count / rating sum / positive count and the ids of the top 5 public reviews,
+-- kept up to date by a row trigger on reviews, so the stats endpoint and the
+-- storefront read one row instead of aggregating / sorting every review.
+-- Reviews are written by the bot, the dashboard (Supabase) and
+-- /api/reviews/toggle-public: the trigger catches all of them.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS review_summaries (
+    shop_id BIGINT PRIMARY KEY,
+    review_count INT NOT NULL DEFAULT 0,
+    rated_count INT NOT NULL DEFAULT 0,       -- reviews with a rating (AVG ignores NULLs)
+    rating_sum BIGINT NOT NULL DEFAULT 0,
+    positive_count INT NOT NULL DEFAULT 0,    -- rating >= 4
+    top_public_ids BIGINT[] NOT NULL DEFAULT '{}',  -- best first: rating DESC, created_at DESC, id DESC
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Refilling the top 5 is a 5-row range scan, however many reviews the shop has
+CREATE INDEX IF NOT EXISTS idx_reviews_shop_top_public
+    ON reviews (shop_id, rating DESC, created_at DESC, id DESC)
+    WHERE is_public = TRUE;
+
+CREATE OR REPLACE FUNCTION review_summary_add(p_shop BIGINT, p_sign INT, p_rating INT) RETURNS void AS $$
+BEGIN
+    INSERT INTO review_summaries AS s (shop_id, review_count, rated_count, rating_sum, positive_count)
+    VALUES (
+        p_shop,
+        p_sign,
+        CASE WHEN p_rating IS NULL THEN 0 ELSE p_sign END,
+        p_sign * COALESCE(p_rating, 0),
+        CASE WHEN p_rating >= 4 THEN p_sign ELSE 0 END
+    )
+    ON CONFLICT (shop_id) DO UPDATE SET
+        review_count = s.review_count + EXCLUDED.review_count,
+        rated_count = s.rated_count + EXCLUDED.rated_count,
+        rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+        positive_count = s.positive_count + EXCLUDED.positive_count,
+        updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION review_summary_refill_top(p_shop BIGINT) RETURNS void AS $$
+BEGIN
+    UPDATE review_summaries SET top_public_ids = COALESCE((
+        SELECT array_agg(t.id ORDER BY t.rating DESC, t.created_at DESC, t.id DESC)
+        FROM (
+            SELECT id, rating, created_at FROM reviews
+            WHERE shop_id = p_shop AND is_public = TRUE
+            ORDER BY rating DESC, created_at DESC, id DESC
+            LIMIT 5
+        ) t
+    ), '{}'), updated_at = NOW()
+    WHERE shop_id = p_shop;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION maintain_review_summary() RETURNS trigger AS $$
+DECLARE
+    counts_changed BOOLEAN := TG_OP <> 'UPDATE'
+        OR (OLD.shop_id, OLD.rating) IS DISTINCT FROM (NEW.shop_id, NEW.rating);
+    rank_changed BOOLEAN := TG_OP <> 'UPDATE'
+        OR (OLD.shop_id, OLD.rating, OLD.is_public, OLD.created_at)
+           IS DISTINCT FROM (NEW.shop_id, NEW.rating, NEW.is_public, NEW.created_at);
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.shop_id IS NOT NULL THEN
+        IF counts_changed THEN
+            PERFORM review_summary_add(OLD.shop_id, -1, OLD.rating);
+        END IF;
+        -- A public review left (or moved): refill only if it was in the top 5
+        IF rank_changed AND OLD.is_public IS TRUE AND EXISTS (
+            SELECT 1 FROM review_summaries WHERE shop_id = OLD.shop_id AND OLD.id = ANY(top_public_ids)
+        ) THEN
+            PERFORM review_summary_refill_top(OLD.shop_id);
+        END IF;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.shop_id IS NOT NULL THEN
+        IF counts_changed THEN
+            PERFORM review_summary_add(NEW.shop_id, 1, NEW.rating);
+        END IF;
+        IF rank_changed AND NEW.is_public IS TRUE THEN
+            PERFORM review_summary_refill_top(NEW.shop_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS reviews_summary ON reviews;
+CREATE TRIGGER reviews_summary
+    AFTER INSERT OR DELETE OR UPDATE OF shop_id, rating, is_public, created_at ON reviews
+    FOR EACH ROW EXECUTE FUNCTION maintain_review_summary();
+
+-- Backfill (re-runnable: recomputes every shop from scratch)
+INSERT INTO review_summaries (shop_id, review_count, rated_count, rating_sum, positive_count)
+SELECT shop_id, COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0), COUNT(*) FILTER (WHERE rating >= 4)
+FROM reviews
+WHERE shop_id IS NOT NULL
+GROUP BY shop_id
+ON CONFLICT (shop_id) DO UPDATE SET
+    review_count = EXCLUDED.review_count,
+    rated_count = EXCLUDED.rated_count,
+    rating_sum = EXCLUDED.rating_sum,
+    positive_count = EXCLUDED.positive_count,
+    updated_at = NOW();
+
+SELECT review_summary_refill_top(shop_id) FROM review_summaries;
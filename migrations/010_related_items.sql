@@ -0,0 +1,51 @@
+-- ==============================================================================
+-- 010: Related items ("more from this shop" + WhatsApp cross-sell)
+-- Built by related_service.related_items_loop, incrementally:
+--   customer_item_purchases  who bought what (distinct), fed from new orders
+--   item_copurchases         per item pair: how many customers bought both
+--   related_items            ranked neighbours per item, read by the product page
+--   related_items_built      when each item's neighbours were last ranked
+-- related_items_cursor remembers the last order folded in.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS customer_item_purchases (
+    customer_phone TEXT NOT NULL,
+    item_id BIGINT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    shop_id BIGINT NOT NULL,
+    first_order_id BIGINT NOT NULL,
+    PRIMARY KEY (customer_phone, item_id)
+);
+CREATE INDEX IF NOT EXISTS idx_customer_item_purchases_item ON customer_item_purchases (item_id);
+
+CREATE TABLE IF NOT EXISTS item_copurchases (
+    item_id BIGINT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    other_id BIGINT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    buyers INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (item_id, other_id)
+);
+CREATE INDEX IF NOT EXISTS idx_item_copurchases_other ON item_copurchases (other_id);
+
+CREATE TABLE IF NOT EXISTS related_items (
+    item_id BIGINT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    rank SMALLINT NOT NULL,
+    related_id BIGINT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    score REAL NOT NULL,
+    PRIMARY KEY (item_id, rank)
+);
+CREATE INDEX IF NOT EXISTS idx_related_items_related ON related_items (related_id);
+
+CREATE TABLE IF NOT EXISTS related_items_built (
+    item_id BIGINT PRIMARY KEY REFERENCES items(id) ON DELETE CASCADE,
+    built_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+-- The refresh sweep picks the stalest items first
+CREATE INDEX IF NOT EXISTS idx_related_items_built_at ON related_items_built (built_at);
+
+CREATE TABLE IF NOT EXISTS related_items_cursor (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_order_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+INSERT INTO related_items_cursor (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+-- Same-category candidates (newest first)
+CREATE INDEX IF NOT EXISTS idx_items_shop_category ON items (shop_id, category, id);
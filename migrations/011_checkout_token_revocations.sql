@@ -0,0 +1,12 @@
+-- ==============================================================================
+-- 011: Single use for signed checkout links
+-- Links are HMAC-signed (app/utils/checkout_token.py) and no longer stored in
+-- users.magic_token. Spending one inserts its nonce here; the primary key makes
+-- a second confirm-address with the same link fail. Rows are only needed until
+-- the link would have expired anyway and are purged by confirm-address.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS checkout_token_revocations (
+    nonce TEXT PRIMARY KEY,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_checkout_token_revocations_expires ON checkout_token_revocations (expires_at);
@@ -0,0 +1,16 @@
+-- ==============================================================================
+-- 012: Deduplicated addresses + default-address pointer
+-- address_service.save_address() stores a content hash of the normalised address;
+-- re-submitting the same address reuses its row instead of inserting a new one.
+-- users.default_address_id is the address the bot offers first. Rows saved
+-- before this migration have no hash and are never deduplicated against.
+-- ==============================================================================
+ALTER TABLE addresses ADD COLUMN IF NOT EXISTS content_hash TEXT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS default_address_id BIGINT;
+
+-- Latest address per phone (fallback when there is no default pointer yet)
+CREATE INDEX IF NOT EXISTS idx_addresses_user_created ON addresses (user_id, created_at DESC);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_addresses_user_hash
+    ON addresses (user_id, content_hash)
+    WHERE content_hash IS NOT NULL;
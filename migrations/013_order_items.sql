@@ -0,0 +1,50 @@
+-- ==============================================================================
+-- 013: Order line items
+-- One row per cart line, written by order_service.finalize_order in the same
+-- statement as the order. orders.item_name stays as the human-readable summary
+-- ("Name (x2), Other (x1)") for messages; stock, analytics, Shiprocket and the
+-- related-items engine read the lines.
+-- variant_key is the variant title from items.attributes->'variants' ('' = none).
+-- name / unit_price are what the buyer saw at checkout.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS order_items (
+    order_id BIGINT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+    line_no SMALLINT NOT NULL,
+    item_id BIGINT REFERENCES items(id) ON DELETE SET NULL,
+    variant_key TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL,
+    qty INT NOT NULL CHECK (qty > 0),
+    unit_price NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (order_id, line_no)
+);
+CREATE INDEX IF NOT EXISTS idx_order_items_item ON order_items (item_id);
+
+-- Backfill, best effort: older orders only carry item_name.
+-- Cart orders are "Name (xN), ..." and are split; anything else is one line of orders.quantity.
+-- A trailing "(...)" that is not a quantity is taken as the variant. Unmatched names keep item_id NULL.
+INSERT INTO order_items (order_id, line_no, item_id, variant_key, name, qty, unit_price)
+SELECT o.id, p.line_no, i.id,
+       CASE WHEN i.name = p.base_name AND i.name <> p.name THEN p.variant_key ELSE '' END,
+       p.name, p.qty,
+       CASE WHEN p.is_cart THEN COALESCE(i.price, 0)
+            ELSE ROUND(COALESCE(o.total_amount, 0) / p.qty, 2) END
+FROM orders o
+CROSS JOIN LATERAL (
+    SELECT u.ord AS line_no,
+           o.item_name ~ ' \(x\d+\)$' AS is_cart,
+           regexp_replace(u.part, ' \(x\d+\)$', '') AS name,
+           regexp_replace(regexp_replace(u.part, ' \(x\d+\)$', ''), ' \([^()]*\)$', '') AS base_name,
+           COALESCE((regexp_match(regexp_replace(u.part, ' \(x\d+\)$', ''), ' \(([^()]*)\)$'))[1], '') AS variant_key,
+           GREATEST(COALESCE((regexp_match(u.part, ' \(x(\d+)\)$'))[1]::int, o.quantity, 1), 1) AS qty
+    FROM unnest(
+        CASE WHEN o.item_name ~ ' \(x\d+\)$' THEN string_to_array(o.item_name, ', ') ELSE ARRAY[o.item_name] END
+    ) WITH ORDINALITY AS u(part, ord)
+) p
+LEFT JOIN LATERAL (
+    SELECT it.id, it.name, it.price FROM items it
+    WHERE it.shop_id = o.shop_id AND it.name IN (p.name, p.base_name)
+    ORDER BY (it.name = p.name) DESC, it.id
+    LIMIT 1
+) i ON TRUE
+WHERE o.item_name IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM order_items x WHERE x.order_id = o.id);
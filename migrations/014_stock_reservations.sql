@@ -0,0 +1,37 @@
+-- ==============================================================================
+-- 014: Stock reservations (TTL holds)
+-- reservation_service takes stock off items.stock_count (or the variant's stock
+-- in items.attributes->'variants') with a conditional UPDATE the moment a buyer
+-- starts checkout, and records the hold here:
+--   held      stock is taken; returned by the sweeper once expires_at passes
+--   sold      converted on payment (COD: at order confirmation)
+--   released  returned to stock (expired, cart emptied, payment rejected)
+-- order_id is NULL until finalize_order attaches the buyer's holds to the order.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS stock_reservations (
+    id BIGSERIAL PRIMARY KEY,
+    phone TEXT NOT NULL,
+    item_id BIGINT NOT NULL REFERENCES items(id) ON DELETE CASCADE,
+    variant_key TEXT NOT NULL DEFAULT '',
+    qty INT NOT NULL CHECK (qty > 0),
+    status TEXT NOT NULL DEFAULT 'held' CHECK (status IN ('held', 'sold', 'released')),
+    order_id BIGINT REFERENCES orders(id) ON DELETE SET NULL,
+    expires_at TIMESTAMPTZ NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Sweeper: live holds by expiry
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_expiry
+    ON stock_reservations (expires_at)
+    WHERE status = 'held';
+
+-- A buyer's open cart (released on a new handoff / "Empty Cart", attached at finalize)
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_open_cart
+    ON stock_reservations (phone)
+    WHERE status = 'held' AND order_id IS NULL;
+
+-- Payment / rejection of an order
+CREATE INDEX IF NOT EXISTS idx_stock_reservations_order
+    ON stock_reservations (order_id)
+    WHERE order_id IS NOT NULL;
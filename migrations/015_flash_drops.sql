@@ -0,0 +1,49 @@
+-- ==============================================================================
+-- 015: Flash drops
+-- An item in drop mode is sold from per-worker in-memory counters
+-- (app/services/flash_drop_service.py). Workers lease units off items.stock_count
+-- in chunks of lease_size under the items row lock, then hand them out from
+-- memory; the lease row is decremented in the same statement that records the
+-- buyer's stock hold (migrations/014), so at every moment
+--   items.stock_count + SUM(flash_drop_leases.units) + live holds = drop stock.
+-- Idle leases are written back to items; a worker that stops heartbeating has
+-- its lease returned by the others.
+-- admit_per_second turns on the waiting room: shoppers get a queue position
+-- (handed out in blocks off queue_tail) and are let in at that rate from starts_at.
+-- 'flash_drops_changed' (payload = item id) tells every worker to reload the drop.
+-- ==============================================================================
+CREATE TABLE IF NOT EXISTS flash_drops (
+    item_id BIGINT PRIMARY KEY REFERENCES items(id) ON DELETE CASCADE,
+    starts_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    ends_at TIMESTAMPTZ,
+    lease_size INT NOT NULL DEFAULT 5 CHECK (lease_size > 0),
+    max_per_buyer INT NOT NULL DEFAULT 1 CHECK (max_per_buyer > 0),
+    admit_per_second REAL CHECK (admit_per_second IS NULL OR admit_per_second > 0),
+    queue_tail BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS flash_drop_leases (
+    item_id BIGINT NOT NULL REFERENCES flash_drops(item_id) ON DELETE CASCADE,
+    worker_id TEXT NOT NULL,
+    units INT NOT NULL CHECK (units >= 0),
+    heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (item_id, worker_id)
+);
+
+CREATE OR REPLACE FUNCTION notify_flash_drops() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('flash_drops_changed', OLD.item_id::text);
+    ELSE
+        PERFORM pg_notify('flash_drops_changed', NEW.item_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Not on queue_tail: handing out queue positions is no config change
+DROP TRIGGER IF EXISTS flash_drops_changed ON flash_drops;
+CREATE TRIGGER flash_drops_changed
+    AFTER INSERT OR DELETE OR UPDATE OF starts_at, ends_at, lease_size, max_per_buyer, admit_per_second ON flash_drops
+    FOR EACH ROW EXECUTE FUNCTION notify_flash_drops();
@@ -0,0 +1,9 @@
+-- ==============================================================================
+-- 016: Oversold orders
+-- A paid order whose stock hold had lapsed takes its lines from stock at payment.
+-- If the shelf no longer covers them the sale can't be refused: stock is taken
+-- down to zero (never below) and the order is flagged for the seller to sort out.
+-- ==============================================================================
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS oversold BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_orders_oversold ON orders (shop_id) WHERE oversold;
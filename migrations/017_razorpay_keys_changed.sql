@@ -0,0 +1,22 @@
+-- ==============================================================================
+-- 017: Razorpay credential changes reach every worker
+-- razorpay_service caches each shop's decrypted keys per worker. A key change
+-- (dashboard, key rotation, or a direct write) NOTIFYs 'razorpay_keys_changed'
+-- (payload = shop id) so no worker keeps signing or verifying with old keys.
+-- ==============================================================================
+CREATE OR REPLACE FUNCTION notify_razorpay_keys() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('razorpay_keys_changed', OLD.id::text);
+    ELSIF OLD.razorpay_key_id IS DISTINCT FROM NEW.razorpay_key_id
+       OR OLD.razorpay_key_secret IS DISTINCT FROM NEW.razorpay_key_secret THEN
+        PERFORM pg_notify('razorpay_keys_changed', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS shops_razorpay_keys_changed ON shops;
+CREATE TRIGGER shops_razorpay_keys_changed
+    AFTER DELETE OR UPDATE OF razorpay_key_id, razorpay_key_secret ON shops
+    FOR EACH ROW EXECUTE FUNCTION notify_razorpay_keys();
@@ -0,0 +1,8 @@
+-- ==============================================================================
+-- 018: Payment intents remember which Razorpay account made them
+-- An intent created under a shop's old keys belongs to the old account: its
+-- webhooks are signed with the old secret and payments land there. Intents are
+-- only reused while key_id still matches the shop's current key; rows from
+-- before this migration (key_id NULL) are simply replaced on the next checkout.
+-- ==============================================================================
+ALTER TABLE payment_intents ADD COLUMN IF NOT EXISTS key_id TEXT;
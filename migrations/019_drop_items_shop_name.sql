@@ -0,0 +1,7 @@
+-- ==============================================================================
+-- 019: Drop idx_items_shop_name
+-- Created by 010 for mapping orders to items by name, but the related-items fold
+-- reads order_items (013) and nothing else looks items up by (shop_id, name).
+-- It only cost writes on every item insert / rename.
+-- ==============================================================================
+DROP INDEX IF EXISTS idx_items_shop_name;